@@ -133,6 +133,14 @@ def show_downloads(window, *args, **kwargs):
     return True
 
 
+def show_history(window, *args, **kwargs):
+    from .history import HISTORY_URL
+    tab = window.get_tab_for_load(in_current_tab=False)
+    tab.load(HISTORY_URL)
+    window.show_tab(tab)
+    return True
+
+
 def copy_url(window, *args, **kwargs):
     if window.current_tab is not None:
         qurl = window.current_tab.url()
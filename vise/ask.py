@@ -3,7 +3,12 @@
 # License: GPL v3 Copyright: 2015, Kovid Goyal <kovid at kovidgoyal.net>
 
 import sys
+import traceback
+from collections import OrderedDict
 from gettext import gettext as _
+from functools import partial
+from queue import Queue, Empty
+from threading import Thread
 
 from PyQt5.Qt import (
     QWidget, QVBoxLayout, QLineEdit, QListView, QAbstractListModel,
@@ -16,6 +21,8 @@ from .config import color
 from .utils import make_highlighted_text
 
 sorted_command_names = sorted(all_command_names)
+# Number of completions shown before the rest of the results are available
+FIRST_PAGE_SIZE = 10
 
 
 class Completions(QAbstractListModel):
@@ -28,9 +35,25 @@ class Completions(QAbstractListModel):
         return len(self.items)
 
     def set_items(self, items):
-        self.beginResetModel()
-        self.items = items
-        self.endResetModel()
+        # Only the rows after the prefix shared with the current items change,
+        # so that the view does not have to re-layout rows it already has
+        common = 0
+        for old, new in zip(self.items, items):
+            if old.value != new.value:
+                break
+            common += 1
+        if common:
+            # Same rows, but the highlighting may differ
+            self.items[:common] = items[:common]
+            self.dataChanged.emit(self.index(0), self.index(common - 1))
+        if common < len(self.items):
+            self.beginRemoveRows(QModelIndex(), common, len(self.items) - 1)
+            del self.items[common:]
+            self.endRemoveRows()
+        if common < len(items):
+            self.beginInsertRows(QModelIndex(), common, len(items) - 1)
+            self.items.extend(items[common:])
+            self.endInsertRows()
 
     def data(self, index, role=Qt.DisplayRole):
         if role == Qt.UserRole:
@@ -45,6 +68,55 @@ class Completions(QAbstractListModel):
                 pass
 
 
+class CompletionWorker(Thread):
+
+    ''' Runs completion queries, skipping the ones that have been superseded
+    by the time the worker gets to them '''
+
+    def __init__(self):
+        Thread.__init__(self, name='Completions')
+        self.daemon = True
+        self.queue = Queue()
+
+    def __call__(self, owner, generation, is_stale, func, callback):
+        self.queue.put((owner, generation, is_stale, func, callback))
+
+    def run(self):
+        while True:
+            jobs = OrderedDict()
+            job = self.queue.get()
+            while True:
+                jobs[job[0]] = job
+                try:
+                    job = self.queue.get_nowait()
+                except Empty:
+                    break
+            for owner, generation, is_stale, func, callback in jobs.values():
+                if not is_stale():
+                    self.run_job(generation, is_stale, func, callback)
+
+    def run_job(self, generation, is_stale, func, callback):
+        items = []
+        try:
+            for item in func(abort=is_stale):
+                items.append(item)
+                if len(items) == FIRST_PAGE_SIZE:
+                    callback(generation, list(items))
+        except Exception:
+            if not is_stale():
+                traceback.print_exc()
+            return
+        if not is_stale():
+            callback(generation, items)
+
+
+def completion_worker():
+    if not hasattr(completion_worker, 'ans'):
+        completion_worker.ans = CompletionWorker()
+        completion_worker.ans.start()
+    return completion_worker.ans
+
+
 class Delegate(QStyledItemDelegate):
 
     def __init__(self, parent=None):
@@ -148,11 +220,15 @@ class Ask(QWidget):
 
     run_command = pyqtSignal(object)
     hidden = pyqtSignal()
+    completions_ready = pyqtSignal(object, object)
 
     def __init__(self, parent=None):
         self.complete_pos = 0
         self.callback = None
+        self.completion_generation = self.shown_generation = 0
+        self.typed_text = ''
         QWidget.__init__(self, parent)
+        self.completions_ready.connect(self.on_completions_ready, type=Qt.QueuedConnection)
         self.l = l = QVBoxLayout(self)
         self.edit = e = LineEdit(self)
         e.textEdited.connect(self.update_completions)
@@ -181,7 +257,11 @@ class Ask(QWidget):
         self.edit.setFocus(Qt.OtherFocusReason)
 
     def update_completions(self):
+        self.completion_generation += 1
         text = self.edit.text()
+        # Only fill in completions while the user is typing at the end
+        typing = len(text) > len(self.typed_text) and text.startswith(self.typed_text) and self.edit.cursorPosition() == len(text)
+        self.typed_text = text
         parts = text.strip().split(' ')
         completions = []
         self.complete_pos = 0
@@ -192,8 +272,43 @@ class Ask(QWidget):
             cmd, rest = parts[0], text[idx:]
             obj = command_map.get(cmd)
             if obj is not None:
+                if typing:
+                    self.complete_inline(obj, cmd, rest)
+                if obj.completions_in_worker:
+                    generation = self.completion_generation
+                    completion_worker()(
+                        id(self), generation, lambda: generation != self.completion_generation,
+                        partial(obj.completions, cmd, rest), self.send_completions)
+                    return
                 completions = obj.completions(cmd, rest)
-        self.model.set_items(completions)
+        self.show_completions(list(completions))
+
+    def complete_inline(self, obj, cmd, prefix):
+        # The filled in text is selected, so that typing replaces it
+        completion = obj.inline_completion(cmd, prefix)
+        if completion and len(completion) > len(prefix) and completion.lower().startswith(prefix.lower()):
+            text = self.edit.text()
+            self.edit.setText(text + completion[len(prefix):])
+            self.edit.setSelection(len(text), len(completion) - len(prefix))
+
+    def send_completions(self, generation, items):
+        # Called in the worker thread
+        try:
+            self.completions_ready.emit(generation, items)
+        except RuntimeError:
+            pass  # Ask was deleted
+
+    def on_completions_ready(self, generation, items):
+        if generation != self.completion_generation:
+            return
+        if self.shown_generation == generation:
+            self.model.set_items(items)
+        else:
+            self.show_completions(items)
+            self.shown_generation = generation
+
+    def show_completions(self, items):
+        self.model.set_items(items)
         self.candidates.setCurrentIndex(QModelIndex())
 
     def command_completions(self, prefix):
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# vim:fileencoding=utf-8
+# License: GPL v3 Copyright: 2017, Kovid Goyal <kovid at kovidgoyal.net>
+
+from urllib.parse import unquote_plus, urlsplit, urlunsplit
+
+DEFAULT_PORTS = {'http': 80, 'https': 443, 'ftp': 21, 'ws': 80, 'wss': 443}
+
+# Used when the tracking_parameters config option is not set. Only the names
+# used by known trackers, generic names such as sid are used by some sites
+# for other purposes.
+DEFAULT_TRACKING_PARAMETERS = (
+    'utm_*', 'fbclid', 'gclid', 'dclid', 'msclkid', 'yclid', 'mc_cid', 'mc_eid', 'igshid', '_hsenc', '_hsmi', 'mkt_tok',
+)
+
+
+def tracking_parameters():
+    ''' Return the names of tracking parameters and the prefixes of the names
+    of tracking parameters, lower cased '''
+    if not hasattr(tracking_parameters, 'ans'):
+        from .config import misc_config
+        names = misc_config('tracking_parameters', default=DEFAULT_TRACKING_PARAMETERS)
+        if isinstance(names, str):
+            names = names.split()
+        names = [x.lower() for x in names]
+        tracking_parameters.ans = frozenset(x for x in names if not x.endswith('*')), tuple(x[:-1] for x in names if x.endswith('*'))
+    return tracking_parameters.ans
+
+
+def reset_tracking_parameters():
+    ''' Re-read the tracking_parameters config option when it is next used,
+    see Places.start_url_cleanup() '''
+    from .config import load_config, misc_config
+    load_config.cache_clear(), misc_config.cache_clear()
+    tracking_parameters.__dict__.pop('ans', None)
+
+
+def is_tracking_parameter(name, names, prefixes):
+    name = unquote_plus(name).lower()
+    return name in names or name.startswith(prefixes)
+
+
+def canonicalize(url):
+    ''' Return the canonical form of url, used to avoid storing the many
+    variants of a URL as separate places: tracking parameters are removed,
+    the query is sorted by parameter name, default ports are dropped as are
+    fragments, except those used for routing by single page applications,
+    which start with / or !. Returns (changed, canonical url). '''
+    try:
+        parts = urlsplit(url)
+        port = parts.port
+    except ValueError:
+        return False, url
+    if parts.scheme not in DEFAULT_PORTS:
+        return False, url
+    netloc, query, fragment = parts.netloc, parts.query, parts.fragment
+    if port is not None and port == DEFAULT_PORTS[parts.scheme]:
+        netloc = netloc.rpartition(':')[0]
+    if query:
+        names, prefixes = tracking_parameters()
+        params = [x for x in query.split('&') if x and not is_tracking_parameter(x.partition('=')[0], names, prefixes)]
+        # The sort is stable, so repeated parameters keep their order
+        params.sort(key=lambda x: x.partition('=')[0])
+        query = '&'.join(params)
+    if fragment[:1] not in ('/', '!'):
+        fragment = ''
+    ans = urlunsplit((parts.scheme, netloc, parts.path, query, fragment))
+    return ans != url, ans
+
+
+def test():
+    for url, expected in {
+        'https://example.com/a?utm_source=x&b=2&a=1&fbclid=y': 'https://example.com/a?a=1&b=2',
+        'https://example.com:443/?UTM_Medium=x': 'https://example.com/',
+        'http://example.com:8080/a#section': 'http://example.com:8080/a',
+        'https://example.com/app#/inbox': 'https://example.com/app#/inbox',
+        'https://example.com/?q=1&q=0&p': 'https://example.com/?p&q=1&q=0',
+        'about:blank#x': 'about:blank#x',
+        'https://example.com/a': 'https://example.com/a',
+    }.items():
+        changed, ans = canonicalize(url)
+        assert ans == expected, '%s: %s != %s' % (url, ans, expected)
+        assert changed == (url != expected)
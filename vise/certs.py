@@ -14,7 +14,7 @@ from PyQt5.Qt import (
 from .constants import config_dir
 from .message_box import error_dialog
 from .settings import gprefs
-from .utils import Dialog, ascii_lowercase
+from .utils import Dialog, ascii_lowercase, forget_domain
 
 
 class Ask(Dialog):
@@ -69,6 +69,10 @@ class CertExceptions:
             c.close()
         return self._conn
 
+    def forget(self, domain):
+        ' Remove the certificate exceptions for domain and all its sub-domains '
+        forget_domain(domain, self.temporary, self.conn, 'exceptions')
+
     def add_exception(self, domain, etype, permanent=True):
         domain = ascii_lowercase(domain)
         etype = code_map[etype]
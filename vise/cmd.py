@@ -96,6 +96,43 @@ class Export(Command):
         window.show_status_message(_('Exported session to: %s') % rest, 5, 'success')
 
 
+class Forget(Command):
+
+    names = {'forget'}
+
+    def __call__(self, cmd, rest, window):
+        from PyQt5.Qt import QUrl
+        from .certs import cert_exceptions
+        from .places import places
+        from .site_permissions import site_permissions
+        rest = rest.strip()
+        if rest:
+            host = QUrl(rest).host() if '://' in rest else rest
+        else:
+            host = window.current_tab.url().host() if window.current_tab else ''
+        host = host.lower()
+        if not host:
+            window.show_status_message(_('No site to forget'), 5, 'error')
+            return
+        # The history of host is recorded as pending until it is deleted, so
+        # it is certain to be forgotten, even if it cannot be done now
+        if places.start_forget(host):
+            window.show_status_message(_('Forgetting the history of %s') % host, 5, 'success')
+        else:
+            window.show_status_message(_('History is being cleaned up, the history of %s will be forgotten afterwards') % host, 5, 'success')
+        site_permissions.forget(host)
+        cert_exceptions.forget(host)
+
+
+class History(Command):
+
+    names = {'history'}
+
+    def __call__(self, cmd, rest, window):
+        from .actions import show_history
+        show_history(window)
+
+
 class Print(Command):
 
     names = {'print'}
@@ -6,6 +6,10 @@
 class Command:
 
     names = set()
+    # If True, completions() is run in a worker thread and must not use any
+    # GUI objects. It is passed an abort callable that returns True once the
+    # results are no longer needed and it can return a generator.
+    completions_in_worker = False
 
     def __call__(self, cmd, rest, window):
         raise NotImplementedError('This command is not implemented')
@@ -15,3 +19,9 @@ class Command:
 
     def completions(self, cmd, prefix):
         return ()
+
+    def inline_completion(self, cmd, prefix):
+        ''' Return the best completion of prefix, to be filled in as the user
+        types, or None. Runs in the GUI thread on every key press, so it must
+        be fast. '''
+        return None
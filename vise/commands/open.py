@@ -2,14 +2,21 @@
 # vim:fileencoding=utf-8
 # License: GPL v3 Copyright: 2015, Kovid Goyal <kovid at kovidgoyal.net>
 
-from contextlib import closing
+from itertools import islice
 
 from PyQt5.Qt import QPoint, QApplication, QIcon, QPixmap, QUrl, QUrlQuery
 
 from . import Command
+from ..favicons import decoded_icons
 from ..places import places
 from ..utils import make_highlighted_text, parse_url
 
+# Number of completion candidates whose favicons are looked up together
+ICON_PAGE_SIZE = 10
+# Prefix of the text to complete that requests searching the archive of old
+# history as well, which is not indexed
+ARCHIVE_PREFIX = '!'
+
 
 def search_engine(q):
     ans = QUrl('https://google.com/search')
@@ -21,22 +28,38 @@ def search_engine(q):
 
 class CompletionCandidate:
 
-    def __init__(self, place_id, url, title, substrings):
+    # Candidates are created in a worker thread, along with the decoded
+    # favicon image, the highlighted text and icon are created in the GUI
+    # thread, only when the candidate is drawn
+
+    def __init__(self, place_id, url, title, substrings, image=None):
         self.value = url
         self.place_id = place_id
+        self.title = title
+        self.substrings = substrings
+        self.image = image
+        self._icon = self._left = self._right = None
+
+    def get_positions(self, text):
+        ans = set()
+        text = text.lower()
+        for ss in self.substrings:
+            idx = text.find(ss.lower())
+            if idx > -1:
+                ans |= set(range(idx, idx + len(ss)))
+        return sorted(ans)
 
-        def get_positions(text):
-            ans = set()
-            text = text.lower()
-            for ss in substrings:
-                idx = text.find(ss.lower())
-                if idx > -1:
-                    ans |= set(range(idx, idx + len(ss)))
-            return sorted(ans)
+    @property
+    def left(self):
+        if self._left is None:
+            self._left = make_highlighted_text(self.value, self.get_positions(self.value))
+        return self._left
 
-        self.left = make_highlighted_text(url, get_positions(url))
-        self.right = make_highlighted_text(title, get_positions(title))
-        self._icon = None
+    @property
+    def right(self):
+        if self._right is None:
+            self._right = make_highlighted_text(self.title, self.get_positions(self.title))
+        return self._right
 
     def adjust_size_hint(self, option, ans):
         ans.setHeight(max(option.decorationSize.height() + 6, ans.height()))
@@ -45,16 +68,8 @@ class CompletionCandidate:
     def icon(self):
         if self._icon is None:
             self._icon = QIcon()
-            url = places.favicon_url(self.place_id)
-            if url is not None:
-                f = QApplication.instance().disk_cache.data(QUrl(url))
-                if f is not None:
-                    with closing(f):
-                        raw = f.readAll()
-                    p = QPixmap()
-                    p.loadFromData(raw)
-                    if not p.isNull():
-                        self._icon.addPixmap(p)
+            if self.image is not None and not self.image.isNull():
+                self._icon.addPixmap(QPixmap.fromImage(self.image))
         return self._icon
 
     def __repr__(self):
@@ -79,14 +94,37 @@ class CompletionCandidate:
         painter.drawStaticText(QPoint(x, y), self.right)
 
 
+def candidates(page, substrings):
+    favicon_urls = places.favicon_urls(place_id for place_id, url, title in page)
+    images = decoded_icons(set(favicon_urls.values()))
+    for place_id, url, title in page:
+        yield CompletionCandidate(place_id, url, title, substrings, images.get(favicon_urls.get(place_id)))
+
+
 class Open(Command):
 
     names = {'open', 'tabopen', 'topen', 'wopen', 'winopen', 'popen', 'privateopen', 'copyurl'}
+    completions_in_worker = True
 
-    def completions(self, cmd, prefix):
+    def completions(self, cmd, prefix, abort=None):
+        search_archive = prefix.startswith(ARCHIVE_PREFIX)
+        if search_archive:
+            prefix = prefix[len(ARCHIVE_PREFIX):]
         substrings = prefix.split(' ')
-        items = [CompletionCandidate(place_id, url, title, substrings) for place_id, url, title in places.substring_matches(substrings)]
-        return items
+        rows = places.substring_matches(substrings, abort=abort)
+        # Lookup and decode the favicons one page of results at a time, as
+        # the results are read
+        while True:
+            page = tuple(islice(rows, ICON_PAGE_SIZE))
+            yield from candidates(page, substrings)
+            if len(page) < ICON_PAGE_SIZE:
+                break
+        if search_archive and any(substrings):
+            yield from candidates(tuple(places.archived_matches(substrings, limit=ICON_PAGE_SIZE, abort=abort)), substrings)
+
+    def inline_completion(self, cmd, prefix):
+        if prefix and ' ' not in prefix and '/' not in prefix:
+            return places.inline_completion(prefix)
 
     def __call__(self, cmd, rest, window):
         if cmd == 'copyurl':
@@ -23,6 +23,7 @@ isbsd = isfreebsd or isnetbsd or isdragonflybsd
 islinux = not(iswindows or isosx or isbsd)
 DOWNLOADS_URL = 'vise:downloads'
 WELCOME_URL = 'vise:welcome'
+HISTORY_URL = 'vise:history'
 hostname = os.environ.get('VISE_HOSTNAME', socket.gethostname())
 STATUS_BAR_HEIGHT = 24
 FOLLOW_LINK_KEY_MAP = {getattr(Qt, 'Key_' + x.upper()): x for x in string.ascii_lowercase + string.digits}
@@ -2,8 +2,10 @@
 # vim:fileencoding=utf-8
 # License: GPL v3 Copyright: 2015, Kovid Goyal <kovid at kovidgoyal.net>
 
+import time
 from ctypes import (CDLL, CFUNCTYPE, POINTER, c_char_p, c_int, c_size_t,
-                    c_ubyte, c_ulonglong, c_void_p, cast, create_string_buffer)
+                    c_ubyte, c_ulonglong, c_void_p, byref, cast, create_string_buffer,
+                    memmove, string_at)
 from threading import Lock
 
 try:
@@ -16,6 +18,11 @@ INPUT = 1
 OUTPUT = 2
 INPUTZ = 4
 c_ubyte_p = POINTER(c_ubyte)
+# The versions of the encryption used by encrypt_many() and decrypt_many()
+SECRETBOX, AES256GCM = 1, 2
+# The version of the key derivation parameter blocks created by kdf_params()
+KDF_VERSION = 2
+SCRYPT, ARGON2ID = 'scryptsalsa208sha256', 'argon2id13'
 
 
 def arg(name, atype, default=None, io=INPUT):
@@ -36,6 +43,32 @@ with init_lock:
 
 try:
     crypto_aead_aes256gcm_is_available = bind('crypto_aead_aes256gcm_is_available', c_int)
+    crypto_aead_aes256gcm_npubbytes = bind('crypto_aead_aes256gcm_npubbytes', c_size_t)
+    crypto_aead_aes256gcm_abytes = bind('crypto_aead_aes256gcm_abytes', c_size_t)
+    crypto_aead_aes256gcm_encrypt = bind(
+        'crypto_aead_aes256gcm_encrypt', c_int,
+        arg('c', c_ubyte_p),
+        arg('clen_p', POINTER(c_ulonglong)),
+        arg('m', c_ubyte_p),
+        arg('mlen', c_ulonglong),
+        arg('ad', c_ubyte_p),
+        arg('adlen', c_ulonglong),
+        arg('nsec', c_void_p),
+        arg('npub', c_ubyte_p),
+        arg('k', c_ubyte_p)
+    )
+    crypto_aead_aes256gcm_decrypt = bind(
+        'crypto_aead_aes256gcm_decrypt', c_int,
+        arg('m', c_ubyte_p),
+        arg('mlen_p', POINTER(c_ulonglong)),
+        arg('nsec', c_void_p),
+        arg('c', c_ubyte_p),
+        arg('clen', c_ulonglong),
+        arg('ad', c_ubyte_p),
+        arg('adlen', c_ulonglong),
+        arg('npub', c_ubyte_p),
+        arg('k', c_ubyte_p)
+    )
 except AttributeError:
     def crypto_aead_aes256gcm_is_available():
         return 0
@@ -61,6 +94,70 @@ randombytes_buf = bind(
     arg('size', c_size_t, default=crypto_pwhash_scryptsalsa208sha256_saltbytes())
 )
 
+try:
+    crypto_pwhash_alg_argon2id13 = bind('crypto_pwhash_alg_argon2id13', c_int)
+    crypto_pwhash_saltbytes = bind('crypto_pwhash_saltbytes', c_size_t)
+    crypto_pwhash_opslimit_min = bind('crypto_pwhash_opslimit_min', c_size_t)
+    crypto_pwhash_opslimit_max = bind('crypto_pwhash_opslimit_max', c_size_t)
+    crypto_pwhash_opslimit_moderate = bind('crypto_pwhash_opslimit_moderate', c_size_t)
+    crypto_pwhash_memlimit_min = bind('crypto_pwhash_memlimit_min', c_size_t)
+    crypto_pwhash_memlimit_moderate = bind('crypto_pwhash_memlimit_moderate', c_size_t)
+    crypto_pwhash = bind(
+        'crypto_pwhash', c_int,
+        arg('out', c_ubyte_p),
+        arg('outlen', c_ulonglong),
+        arg('passwd', c_char_p),
+        arg('pwlen', c_ulonglong),
+        arg('salt', c_ubyte_p),
+        arg('opslimit', c_ulonglong),
+        arg('memlimit', c_size_t),
+        arg('alg', c_int)
+    )
+except AttributeError:
+    crypto_pwhash = None
+
+try:
+    crypto_secretstream_xchacha20poly1305_statebytes = bind('crypto_secretstream_xchacha20poly1305_statebytes', c_size_t)
+    crypto_secretstream_xchacha20poly1305_headerbytes = bind('crypto_secretstream_xchacha20poly1305_headerbytes', c_size_t)
+    crypto_secretstream_xchacha20poly1305_abytes = bind('crypto_secretstream_xchacha20poly1305_abytes', c_size_t)
+    crypto_secretstream_xchacha20poly1305_tag_final = bind('crypto_secretstream_xchacha20poly1305_tag_final', c_ubyte)
+    crypto_secretstream_xchacha20poly1305_init_push = bind(
+        'crypto_secretstream_xchacha20poly1305_init_push', c_int,
+        arg('state', c_void_p),
+        arg('header', c_ubyte_p),
+        arg('k', c_ubyte_p)
+    )
+    crypto_secretstream_xchacha20poly1305_push = bind(
+        'crypto_secretstream_xchacha20poly1305_push', c_int,
+        arg('state', c_void_p),
+        arg('c', c_ubyte_p),
+        arg('clen_p', POINTER(c_ulonglong)),
+        arg('m', c_ubyte_p),
+        arg('mlen', c_ulonglong),
+        arg('ad', c_ubyte_p),
+        arg('adlen', c_ulonglong),
+        arg('tag', c_ubyte)
+    )
+    crypto_secretstream_xchacha20poly1305_init_pull = bind(
+        'crypto_secretstream_xchacha20poly1305_init_pull', c_int,
+        arg('state', c_void_p),
+        arg('header', c_ubyte_p),
+        arg('k', c_ubyte_p)
+    )
+    crypto_secretstream_xchacha20poly1305_pull = bind(
+        'crypto_secretstream_xchacha20poly1305_pull', c_int,
+        arg('state', c_void_p),
+        arg('m', c_ubyte_p),
+        arg('mlen_p', POINTER(c_ulonglong)),
+        arg('tag_p', c_ubyte_p),
+        arg('c', c_ubyte_p),
+        arg('clen', c_ulonglong),
+        arg('ad', c_ubyte_p),
+        arg('adlen', c_ulonglong)
+    )
+except AttributeError:
+    crypto_secretstream_xchacha20poly1305_init_push = None
+
 crypto_box_seedbytes = bind('crypto_box_seedbytes', c_size_t)
 crypto_secretbox_keybytes = bind('crypto_secretbox_keybytes', c_size_t)
 crypto_secretbox_macbytes = bind('crypto_secretbox_macbytes', c_size_t)
@@ -102,6 +199,11 @@ sodium_mlock = bind(
     arg('len', c_size_t)
 )
 
+sodium_malloc = bind('sodium_malloc', c_void_p, arg('size', c_size_t))
+sodium_free = bind('sodium_free', None, arg('addr', c_void_p))
+sodium_mprotect_noaccess = bind('sodium_mprotect_noaccess', c_int, arg('addr', c_void_p))
+sodium_mprotect_readonly = bind('sodium_mprotect_readonly', c_int, arg('addr', c_void_p))
+
 
 def random_bytes(num):
     x = create_string_buffer(num)
@@ -118,25 +220,125 @@ def lock_python_bytes(data):
         raise RuntimeError('Failed to lock memory')
 
 
-def derive_key_v1(passwd, salt=None):
+def pwhash(passwd, salt, opslimit, memlimit, algorithm=SCRYPT):
     key_len = crypto_secretbox_keybytes()
     if key_len != 32:
         raise RuntimeError('secretbox key length has changed')
-    if salt is None:
-        salt = generate_salt_v1()
     if not isinstance(passwd, bytes):
         passwd = passwd.encode('utf-8')
     out = create_string_buffer(key_len)
     sbuf = cast(salt, c_ubyte_p)
-    if crypto_pwhash_scryptsalsa208sha256(
-            cast(out, c_ubyte_p), key_len, passwd, len(passwd), sbuf,
-            crypto_pwhash_scryptsalsa208sha256_opslimit_sensitive(), crypto_pwhash_scryptsalsa208sha256_memlimit_sensitive()) != 0:
+    if algorithm == SCRYPT:
+        ret = crypto_pwhash_scryptsalsa208sha256(cast(out, c_ubyte_p), key_len, passwd, len(passwd), sbuf, opslimit, memlimit)
+    elif algorithm == ARGON2ID:
+        if crypto_pwhash is None:
+            raise RuntimeError('This version of libsodium does not support Argon2id')
+        ret = crypto_pwhash(cast(out, c_ubyte_p), key_len, passwd, len(passwd), sbuf, opslimit, memlimit, crypto_pwhash_alg_argon2id13())
+    else:
+        raise ValueError('Unknown key derivation algorithm: {}'.format(algorithm))
+    if ret != 0:
         raise MemoryError('Out of memory deriving key from password')
     key = out.raw
     lock_python_bytes(key)
+    return key
+
+
+class GuardedBytes:
+
+    ''' A copy of data in memory allocated by sodium_malloc(), which is
+    locked, surrounded by guard pages and inaccessible except while being
+    read by get(). free() wipes it. '''
+
+    def __init__(self, data):
+        self.size = len(data)
+        self.addr = sodium_malloc(max(1, self.size))
+        if not self.addr:
+            raise MemoryError('Failed to allocate guarded memory')
+        memmove(self.addr, data, self.size)
+        sodium_mprotect_noaccess(self.addr)
+
+    def get(self):
+        if not self.addr:
+            raise ValueError('Guarded memory has been freed')
+        sodium_mprotect_readonly(self.addr)
+        try:
+            return string_at(self.addr, self.size)
+        finally:
+            sodium_mprotect_noaccess(self.addr)
+
+    def free(self):
+        if self.addr:
+            sodium_free(self.addr)
+            self.addr = None
+    __del__ = free
+
+
+def derive_key_v1(passwd, salt=None):
+    if salt is None:
+        salt = generate_salt_v1()
+    key = pwhash(
+        passwd, salt, crypto_pwhash_scryptsalsa208sha256_opslimit_sensitive(), crypto_pwhash_scryptsalsa208sha256_memlimit_sensitive())
     return key, salt
 
 
+def kdf_params(opslimit, memlimit, algorithm=ARGON2ID):
+    ''' A versioned block of key derivation parameters, suitable for storing
+    as JSON. '''
+    return {'version': KDF_VERSION, 'algorithm': algorithm, 'opslimit': opslimit, 'memlimit': memlimit}
+
+
+def default_kdf():
+    ''' The key derivation parameters for new vaults, None if only the v1
+    key derivation is supported '''
+    if crypto_pwhash is None:
+        return None
+    return kdf_params(crypto_pwhash_opslimit_moderate(), crypto_pwhash_memlimit_moderate())
+
+
+def generate_salt(kdf=None):
+    if kdf is None or kdf['algorithm'] == SCRYPT:
+        return generate_salt_v1()
+    return random_bytes(crypto_pwhash_saltbytes())
+
+
+def derive_key(passwd, salt, kdf=None):
+    ''' Derive a key from passwd using the parameters from kdf_params(),
+    or the v1 parameters if kdf is None '''
+    if kdf is None:
+        return derive_key_v1(passwd, salt)[0]
+    if kdf.get('version') != KDF_VERSION:
+        raise ValueError('Unsupported version of the key derivation parameters: {}'.format(kdf.get('version')))
+    return pwhash(passwd, salt, kdf['opslimit'], kdf['memlimit'], kdf['algorithm'])
+
+
+def calibrate_kdf(target_seconds=1, max_memory=None):
+    ''' Find the Argon2id parameters for which deriving a key takes about
+    target_seconds on this machine, using at most max_memory bytes
+    (default: 256MB). The memory is reduced if even a single pass takes too
+    long. Returns the parameters and the time taken by a derivation with
+    them. '''
+    if crypto_pwhash is None:
+        raise RuntimeError('This version of libsodium does not support Argon2id')
+    passwd, salt = random_bytes(16), random_bytes(crypto_pwhash_saltbytes())
+    memlimit = max(max_memory or crypto_pwhash_memlimit_moderate(), crypto_pwhash_memlimit_min())
+    opslimit = crypto_pwhash_opslimit_min()
+
+    def timed(opslimit, memlimit):
+        st = time.monotonic()
+        pwhash(passwd, salt, opslimit, memlimit, ARGON2ID)
+        return time.monotonic() - st
+
+    taken = timed(opslimit, memlimit)
+    while taken > target_seconds and memlimit // 2 >= crypto_pwhash_memlimit_min():
+        memlimit //= 2
+        taken = timed(opslimit, memlimit)
+    while taken < target_seconds * 0.9 and opslimit < crypto_pwhash_opslimit_max():
+        # The time taken is roughly proportional to the number of passes
+        opslimit = min(crypto_pwhash_opslimit_max(), max(opslimit + 1, int(opslimit * target_seconds / max(taken, 1e-6))))
+        taken = timed(opslimit, memlimit)
+    return kdf_params(opslimit, memlimit), taken
+
+
 def nonce_size_v1():
     return crypto_secretbox_noncebytes()
 
@@ -158,6 +360,163 @@ class MessageForged(ValueError):
     pass
 
 
+def check_secretbox_primitive():
+    if crypto_secretbox_primitive() != b'xsalsa20poly1305':
+        raise RuntimeError('libsodium cryptobox primitive has changed')
+
+
+def buffer_pointer(data):
+    ''' A pointer to the contents of data, without copying it. data must be
+    bytes or a writable, contiguous buffer such as a bytearray or a
+    memoryview of one. '''
+    if isinstance(data, bytes):
+        return cast(data, c_ubyte_p)
+    # byref() is much faster than cast(), which matters for small messages
+    return byref(c_ubyte.from_buffer(data if len(data) else bytearray(1)))
+
+
+def aes256gcm_available():
+    ''' AES-256-GCM is only available on CPUs with AES instructions, where it
+    is much faster than XSalsa20-Poly1305 '''
+    return crypto_aead_aes256gcm_is_available() == 1
+
+
+def check_aes256gcm():
+    if not aes256gcm_available():
+        raise RuntimeError('AES-256-GCM is not supported on this computer')
+
+
+def nonce_size(version=SECRETBOX):
+    return crypto_aead_aes256gcm_npubbytes() if version == AES256GCM else crypto_secretbox_noncebytes()
+
+
+def encrypt_many(messages, key, version=SECRETBOX):
+    ''' Encrypt every message in messages with key, yielding (ciphertext,
+    nonce). ciphertext is a memoryview of a buffer that is reused for the
+    next message, so it must be used before the next message is
+    encrypted. version is SECRETBOX for XSalsa20-Poly1305 or AES256GCM.
+    The nonces are random, which is safe for AES-256-GCM for up to 2**32
+    messages per key. '''
+    kbuf = buffer_pointer(key)
+    if version == AES256GCM:
+        check_aes256gcm()
+        macbytes = crypto_aead_aes256gcm_abytes()
+
+        def seal(out, data, size, nonce):
+            crypto_aead_aes256gcm_encrypt(out, None, data, size, None, 0, None, nonce, kbuf)
+    else:
+        check_secretbox_primitive()
+        macbytes = crypto_secretbox_macbytes()
+
+        def seal(out, data, size, nonce):
+            crypto_secretbox_easy(out, data, size, nonce, kbuf)
+    noncebytes = nonce_size(version)
+    nonce = bytearray(noncebytes)
+    nbuf = buffer_pointer(nonce)
+    out = bytearray()
+    for data in messages:
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        size = len(data) + macbytes
+        if len(out) < size:
+            out = bytearray(max(size, 2 * len(out)))
+        randombytes_buf(nbuf, noncebytes)
+        seal(buffer_pointer(out), buffer_pointer(data), len(data), nbuf)
+        yield memoryview(out)[:size], bytes(nonce)
+
+
+def decrypt_many(messages, key, out=None, version=SECRETBOX):
+    ''' Decrypt every (ciphertext, nonce) in messages with key, yielding a
+    memoryview of the plaintext, or None if the message was forged. The
+    plaintext is written into out, a writable buffer, which is reused for
+    the next message and replaced by a larger bytearray when it is too
+    small. version is as for encrypt_many(). '''
+    kbuf = buffer_pointer(key)
+    if version == AES256GCM:
+        check_aes256gcm()
+        macbytes = crypto_aead_aes256gcm_abytes()
+
+        def open_(out, data, size, nonce):
+            return crypto_aead_aes256gcm_decrypt(out, None, None, data, size, None, 0, nonce, kbuf)
+    else:
+        check_secretbox_primitive()
+        macbytes = crypto_secretbox_macbytes()
+
+        def open_(out, data, size, nonce):
+            return crypto_secretbox_open_easy(out, data, size, nonce, kbuf)
+    out = bytearray() if out is None else out
+    for data, nonce in messages:
+        size = len(data) - macbytes
+        if size < 0:
+            yield None
+            continue
+        if len(out) < size:
+            out = bytearray(max(size, 2 * len(out)))
+        if open_(buffer_pointer(out), buffer_pointer(data), len(data), buffer_pointer(nonce)) != 0:
+            yield None
+        else:
+            yield memoryview(out)[:size]
+
+
+class SecretStream:
+
+    ''' Encrypts (if header is None) or decrypts a stream of messages with
+    key, using crypto_secretstream_xchacha20poly1305, which detects messages
+    that are reordered, dropped or truncated. The header must be stored
+    before the encrypted messages. The state is kept in guarded memory. '''
+
+    def __init__(self, key, header=None):
+        if crypto_secretstream_xchacha20poly1305_init_push is None:
+            raise RuntimeError('This version of libsodium does not support crypto_secretstream')
+        self.abytes = crypto_secretstream_xchacha20poly1305_abytes()
+        self.tag_final = crypto_secretstream_xchacha20poly1305_tag_final()
+        self.state = sodium_malloc(crypto_secretstream_xchacha20poly1305_statebytes())
+        if not self.state:
+            raise MemoryError('Failed to allocate guarded memory')
+        self.out = bytearray()
+        if header is None:
+            header = bytearray(crypto_secretstream_xchacha20poly1305_headerbytes())
+            crypto_secretstream_xchacha20poly1305_init_push(self.state, buffer_pointer(header), buffer_pointer(key))
+            self.header = bytes(header)
+        else:
+            self.header = header
+            if len(header) != crypto_secretstream_xchacha20poly1305_headerbytes() or crypto_secretstream_xchacha20poly1305_init_pull(
+                    self.state, buffer_pointer(header), buffer_pointer(key)) != 0:
+                raise MessageForged('Invalid stream header')
+
+    def buffer(self, size):
+        if len(self.out) < size:
+            self.out = bytearray(max(size, 2 * len(self.out)))
+        return self.out
+
+    def push(self, data, final=False):
+        ''' Return the encrypted message as a memoryview of a buffer that is
+        reused by the next call '''
+        size = len(data) + self.abytes
+        out = self.buffer(size)
+        crypto_secretstream_xchacha20poly1305_push(
+            self.state, buffer_pointer(out), None, buffer_pointer(data), len(data), None, 0, self.tag_final if final else 0)
+        return memoryview(out)[:size]
+
+    def pull(self, data):
+        ''' Return (message, is_final) with message a memoryview of a buffer
+        that is reused by the next call '''
+        size = len(data) - self.abytes
+        if size < 0:
+            raise MessageForged('Truncated message')
+        out, tag = self.buffer(size), c_ubyte(0)
+        if crypto_secretstream_xchacha20poly1305_pull(
+                self.state, buffer_pointer(out), None, byref(tag), buffer_pointer(data), len(data), None, 0) != 0:
+            raise MessageForged('Message forged!')
+        return memoryview(out)[:size], tag.value == self.tag_final
+
+    def free(self):
+        if self.state:
+            sodium_free(self.state)
+            self.state = None
+    __del__ = free
+
+
 def decrypt_v1(encrypted_data, nonce, key):
     if crypto_secretbox_primitive() != b'xsalsa20poly1305':
         raise RuntimeError('libsodium cryptobox primitive has changed')
@@ -181,6 +540,36 @@ def test():
         raise AssertionError('Bad data was decrypted!')
     except MessageForged:
         pass
+    messages = [data, b'', b'x' * 1000, 'text']
+    for version in (SECRETBOX, AES256GCM) if aes256gcm_available() else (SECRETBOX,):
+        encrypted = [(bytearray(c), bytearray(n)) for c, n in encrypt_many(messages, key, version)]
+        assert len(encrypted[0][1]) == nonce_size(version)
+        encrypted[1][0][0] ^= 1
+        out = bytearray(4)
+        assert [None if x is None else bytes(x) for x in decrypt_many(encrypted, key, out, version)] == [data, None, b'x' * 1000, b'text']
+        assert out[:len(data)] != data
+        assert next(decrypt_many(encrypted[:1], random_bytes(32), version=version)) is None
+    if crypto_secretstream_xchacha20poly1305_init_push is not None:
+        s = SecretStream(key)
+        encrypted = [bytes(s.push(b'one')), bytes(s.push(b'', final=True))]
+        s = SecretStream(key, s.header)
+        assert [(bytes(m), final) for m, final in map(s.pull, encrypted)] == [(b'one', False), (b'', True)]
+        s = SecretStream(key, s.header)
+        try:
+            s.pull(encrypted[1])
+            raise AssertionError('Reordered stream was decrypted!')
+        except MessageForged:
+            pass
+    g = GuardedBytes(data)
+    assert g.get() == data
+    g.free()
+    if crypto_pwhash is not None:
+        kdf, taken = calibrate_kdf(0.05, crypto_pwhash_memlimit_min() * 1024)
+        assert kdf['memlimit'] <= crypto_pwhash_memlimit_min() * 1024 and kdf['opslimit'] >= crypto_pwhash_opslimit_min()
+        salt = generate_salt(kdf)
+        key = derive_key(passwd, salt, kdf)
+        assert len(key) == 32 and derive_key(passwd, salt, kdf) == key and derive_key(passwd + 'x', salt, kdf) != key
+        assert derive_key(passwd, salt, dict(kdf, opslimit=kdf['opslimit'] + 1)) != key
 
 
 if __name__ == '__main__':
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# vim:fileencoding=utf-8
+# License: GPL v3 Copyright: 2017, Kovid Goyal <kovid at kovidgoyal.net>
+
+import os
+from collections import OrderedDict
+from contextlib import closing
+from threading import Lock, local
+
+from PyQt5.Qt import QImage, QNetworkDiskCache, QUrl
+
+from .constants import cache_dir
+
+# Number of decoded favicons kept in memory
+DECODED_ICONS_CACHE_SIZE = 512
+
+
+def create_favicon_cache(max_size=25 * 1024 * 1024):
+    c = QNetworkDiskCache()
+    c.setCacheDirectory(os.path.join(cache_dir, 'favicons'))
+    if max_size is not None:
+        c.setMaximumCacheSize(max_size)
+    return c
+
+
+class DecodedIcons:
+
+    ''' LRU cache of favicons decoded into QImages, keyed by favicon URL.
+    Since QImage, unlike QPixmap, can be used outside the GUI thread, icons
+    are read from the disk cache and decoded in whichever thread needs them,
+    typically the completion worker. '''
+
+    def __init__(self, limit=DECODED_ICONS_CACHE_SIZE):
+        self.limit = limit
+        self.items = OrderedDict()
+        self.lock = Lock()
+        self.tls = local()
+
+    @property
+    def disk_cache(self):
+        # QNetworkDiskCache is not thread safe, so use a read only instance
+        # per thread
+        ans = getattr(self.tls, 'disk_cache', None)
+        if ans is None:
+            ans = self.tls.disk_cache = create_favicon_cache(max_size=None)
+        return ans
+
+    def read(self, url):
+        ans = QImage()
+        f = self.disk_cache.data(QUrl(url))
+        if f is not None:
+            with closing(f):
+                raw = f.readAll()
+            ans.loadFromData(raw)
+        return ans
+
+    def __call__(self, urls):
+        ''' Return a map of url to QImage for the specified favicon urls. The
+        image is null if the favicon is not available. '''
+        ans, missing = {}, []
+        with self.lock:
+            for url in urls:
+                img = self.items.get(url)
+                if img is None:
+                    missing.append(url)
+                else:
+                    self.items.move_to_end(url)
+                    ans[url] = img
+        for url in missing:
+            ans[url] = img = self.read(url)
+            with self.lock:
+                self.items[url] = img
+                while len(self.items) > self.limit:
+                    self.items.popitem(last=False)
+        return ans
+
+    def discard(self, url):
+        with self.lock:
+            self.items.pop(url, None)
+
+
+decoded_icons = DecodedIcons()
+
+
+def remove_favicons(urls):
+    ''' Remove favicons from the disk cache and the decoded icons. Can be
+    used in any thread. '''
+    cache = create_favicon_cache(max_size=None)
+    for url in urls:
+        cache.remove(QUrl(url))
+        decoded_icons.discard(url)
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# vim:fileencoding=utf-8
+# License: GPL v3 Copyright: 2017, Kovid Goyal <kovid at kovidgoyal.net>
+
+import traceback
+import weakref
+from gettext import gettext as _
+from queue import Queue
+from threading import Thread
+
+import sip
+from PyQt5.Qt import QUrl, QByteArray, QObject, Qt, pyqtSignal
+
+from .constants import HISTORY_URL as HU
+from .places import places
+from .resources import get_data
+
+HISTORY_URL = QUrl(HU)
+
+
+def get_history_html():
+    if not hasattr(get_history_html, 'html'):
+        get_history_html.html = QByteArray(get_data('history.html').decode('utf-8').replace('_TITLE_', _('History')).encode('utf-8'))
+    return get_history_html.html
+
+
+def position(val):
+    if isinstance(val, list) and len(val) == 3:
+        return tuple(map(int, val))
+
+
+class HistoryWorker(Thread):
+
+    ''' Reads pages of history, which can need a scan of the visits table, out
+    of the GUI thread '''
+
+    def __init__(self, callback):
+        Thread.__init__(self, name='HistoryPages')
+        self.daemon = True
+        self.callback = callback
+        self.queue = Queue()
+
+    def __call__(self, tab, data):
+        self.queue.put((weakref.ref(tab), data))
+
+    def run(self):
+        while True:
+            tabref, data = self.queue.get()
+            try:
+                rows = places.history(
+                    before=position(data.get('before')), after=position(data.get('after')), substrings=str(data.get('query') or '').split())
+            except Exception:
+                traceback.print_exc()
+                continue
+            self.callback(tabref, data.get('request_id'), [
+                (date, kind, entry_id, url, title, count) for date, kind, entry_id, place_id, url, title, count in rows])
+
+
+class HistoryPages(QObject):
+
+    page_ready = pyqtSignal(object, object, object)
+
+    def __init__(self):
+        QObject.__init__(self)
+        self.page_ready.connect(self.on_page_ready, type=Qt.QueuedConnection)
+        self.worker = HistoryWorker(self.page_ready.emit)
+        self.worker.start()
+
+    def on_page_ready(self, tabref, request_id, rows):
+        tab = tabref()
+        if tab is not None and not sip.isdeleted(tab) and tab.url() == HISTORY_URL:
+            tab.js_func('window.history_page', request_id, rows)
+
+
+def history_pages():
+    if not hasattr(history_pages, 'ans'):
+        history_pages.ans = HistoryPages()
+    return history_pages.ans
+
+
+def history_callback(tab, data):
+    # The page asks for the page of history before or after the position of
+    # the first or last row it has, the rows far from the visible ones are
+    # dropped by the page, so its memory use does not grow as it is scrolled
+    if tab.url() != HISTORY_URL or data.get('cmd') != 'page':
+        return
+    history_pages().worker(tab, data)
@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+# vim:fileencoding=utf-8
+# License: GPL v3 Copyright: 2017, Kovid Goyal <kovid at kovidgoyal.net>
+
+import os
+import time
+from glob import glob
+
+import apsw
+
+from .canonical_url import canonicalize
+from .places import VisitType, normalize, now
+
+# Offset between the Chromium epoch (1601-01-01) and the unix epoch in microseconds
+CHROMIUM_EPOCH_OFFSET = 11644473600 * 1000000
+
+
+def place_url(url):
+    ''' The url under which a url from another browser is stored in places '''
+    return canonicalize(normalize(url))[1]
+
+
+def print_progress(importer, stage, done, total):
+    print('\rImporting %s: %d of %d' % (stage, done, total), end='\n' if done >= total else '', flush=True)
+
+
+class Importer:
+
+    ''' Imports history from another browser's database into places in chunks
+    of chunk_size rows, each in its own transaction. The position reached is
+    stored in the imports table in the same transaction, so an interrupted
+    import resumes where it left off. Subclasses define the stages: for
+    each stage a query on the source database that selects the rows after
+    the last imported source id and a count query for progress reporting.
+    The first column of the query must be the source id. '''
+
+    name = None
+    stages = ('places', 'visits')
+    queries = {}
+    count_queries = {}
+    chunk_size = 5000
+
+    @classmethod
+    def default_path(cls):
+        ''' The path to the history database of the default profile, None if
+        it does not exist '''
+        return None
+
+    def __init__(self, path, places, report=print_progress):
+        self.path = os.path.realpath(path)
+        self.places = places
+        self.report = report
+        self.source = '%s:%s' % (self.name, self.path)
+
+    def __call__(self):
+        src = apsw.Connection(self.path, flags=apsw.SQLITE_OPEN_READONLY)
+        conn = self.places.open_connection()
+        try:
+            stage, last_id = self.state(conn)
+            if stage == 'done':
+                print('History from {} has already been imported'.format(self.path))
+                return
+            st = time.monotonic()
+            # An import interrupted while re-aging has imported every row
+            if stage != 'frecency':
+                for name in self.stages[self.stages.index(stage):]:
+                    if self.has_stage(src, name):
+                        self.run_stage(src, conn, name, last_id)
+                    last_id = 0
+                self.save_state(conn, 'frecency', 0)
+            self.places.reage_frecency()
+            self.save_state(conn, 'done', 0)
+            print('Imported history from {} in {:.1f} seconds'.format(self.path, time.monotonic() - st))
+        finally:
+            self.places.invalidate_caches()
+            src.close()
+            conn.close()
+
+    def state(self, conn):
+        for stage, last_id in conn.cursor().execute('SELECT stage, last_id FROM imports WHERE source=?', (self.source,)):
+            if stage in self.stages or stage in ('frecency', 'done'):
+                return stage, last_id
+            return self.stages[-1], 0
+        return self.stages[0], 0
+
+    def save_state(self, conn, stage, last_id):
+        conn.cursor().execute('INSERT OR REPLACE INTO imports (source, stage, last_id) VALUES (?, ?, ?)', (self.source, stage, last_id))
+
+    def has_stage(self, src, name):
+        return True
+
+    def run_stage(self, src, conn, name, last_id):
+        total = next(src.cursor().execute(self.count_queries[name], (last_id,)))[0]
+        write = getattr(self, 'write_' + name)
+        query, done = self.queries[name], 0
+        while True:
+            rows = src.cursor().execute(query, (last_id, self.chunk_size)).fetchall()
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            with conn:
+                c = conn.cursor()
+                write(c, rows)
+                self.save_state(conn, name, last_id)
+            done += len(rows)
+            if self.report is not None:
+                self.report(self, name, done, max(done, total))
+
+    def write_places(self, c, rows):
+        # Merge into existing places with the same URL
+        c.executemany(
+            'INSERT INTO places (url, title, visit_count, typed, last_visit_date) VALUES (?, ?, ?, ?, ?) ON CONFLICT(url) DO UPDATE SET'
+            ' visit_count = visit_count + excluded.visit_count, typed = MAX(typed, excluded.typed),'
+            ' last_visit_date = MAX(last_visit_date, excluded.last_visit_date),'
+            ' title = CASE title WHEN "_" THEN excluded.title ELSE title END',
+            ((place_url(url), title or '_', visit_count, 1 if typed else 0, last_visit_date)
+             for src_id, url, title, visit_count, typed, last_visit_date in rows))
+
+    def write_visits(self, c, rows):
+        c.executemany(
+            'INSERT INTO visits (place_id, visit_date, type) SELECT id, ?, ? FROM places WHERE url=?',
+            ((visit_date, visit_type, place_url(url)) for src_id, url, visit_date, visit_type in rows))
+
+    def write_favicons(self, c, rows):
+        ts = now()
+        c.executemany('INSERT OR IGNORE INTO favicons (url, last_visit_date) VALUES (?, ?)', ((favicon, ts) for src_id, url, favicon in rows))
+        c.executemany(
+            'INSERT OR IGNORE INTO favicons_link (favicon_id, place_id) SELECT favicons.id, places.id FROM favicons, places'
+            ' WHERE favicons.url=? AND places.url=?', ((favicon, place_url(url)) for src_id, url, favicon in rows))
+
+
+class FirefoxImporter(Importer):
+
+    name = 'firefox'
+    stages = ('places', 'visits', 'favicons')
+    queries = {
+        'places': 'SELECT id, url, title, visit_count, typed, last_visit_date FROM moz_places'
+        ' WHERE id > ? AND url IS NOT NULL AND last_visit_date > 0 AND visit_count > 0 AND frecency > 0 ORDER BY id LIMIT ?',
+
+        'visits': 'SELECT v.id, p.url, v.visit_date, CASE v.visit_type WHEN 1 THEN {} WHEN 2 THEN {} END'
+        ' FROM moz_historyvisits v JOIN moz_places p ON p.id = v.place_id'
+        ' WHERE v.id > ? AND v.visit_date > 0 AND v.visit_type IN (1, 2) ORDER BY v.id LIMIT ?'.format(
+            VisitType.link_clicked.value, VisitType.typed.value),
+
+        # Only versions of Firefox before 55 store favicons in places.sqlite
+        'favicons': 'SELECT p.id, p.url, f.url FROM moz_places p JOIN moz_favicons f ON f.id = p.favicon_id WHERE p.id > ? ORDER BY p.id LIMIT ?',
+    }
+    count_queries = {
+        'places': 'SELECT COUNT(*) FROM moz_places WHERE id > ?',
+        'visits': 'SELECT COUNT(*) FROM moz_historyvisits WHERE id > ?',
+        'favicons': 'SELECT COUNT(*) FROM moz_places WHERE id > ? AND favicon_id > 0',
+    }
+
+    @classmethod
+    def default_path(cls):
+        for path in glob(os.path.expanduser('~/.mozilla/firefox/*/places.sqlite')):
+            return path
+
+    def has_stage(self, src, name):
+        if name == 'favicons':
+            return bool(tuple(src.cursor().execute('SELECT name FROM sqlite_master WHERE type="table" AND name="moz_favicons"')))
+        return True
+
+
+class ChromiumImporter(Importer):
+
+    name = 'chromium'
+    queries = {
+        'places': 'SELECT id, url, title, visit_count, typed_count, last_visit_time - {} FROM urls'
+        ' WHERE id > ? AND last_visit_time > 0 AND visit_count > 0 ORDER BY id LIMIT ?'.format(CHROMIUM_EPOCH_OFFSET),
+
+        # The low byte of transition is the core transition type, 0 is a
+        # link and 1 is typed
+        'visits': 'SELECT v.id, u.url, v.visit_time - {}, CASE v.transition & 255 WHEN 0 THEN {} WHEN 1 THEN {} END'
+        ' FROM visits v JOIN urls u ON u.id = v.url'
+        ' WHERE v.id > ? AND v.visit_time > 0 AND v.transition & 255 IN (0, 1) ORDER BY v.id LIMIT ?'.format(
+            CHROMIUM_EPOCH_OFFSET, VisitType.link_clicked.value, VisitType.typed.value),
+    }
+    count_queries = {
+        'places': 'SELECT COUNT(*) FROM urls WHERE id > ?',
+        'visits': 'SELECT COUNT(*) FROM visits WHERE id > ?',
+    }
+
+    @classmethod
+    def default_path(cls):
+        for path in ('~/.config/chromium/Default/History', '~/.config/google-chrome/Default/History'):
+            path = os.path.expanduser(path)
+            if os.path.exists(path):
+                return path
+
+
+importers = {cls.name: cls for cls in (FirefoxImporter, ChromiumImporter)}
+
+
+def import_history(browser, path=None, places=None, report=print_progress):
+    ''' Import the history of browser (one of the keys of importers) from the
+    database at path into places. The browser must not be running, as it
+    keeps its history database locked. '''
+    cls = importers[browser]
+    path = path or cls.default_path()
+    if path is None:
+        print('No {} history found'.format(browser))
+        return
+    if places is None:
+        from .places import places
+    cls(path, places, report=report)()
+
+
+def test():
+    import tempfile
+    from .places import Places
+    with tempfile.TemporaryDirectory() as tdir:
+        path = os.path.join(tdir, 'History')
+        src = apsw.Connection(path)
+        src.cursor().execute(
+            'CREATE TABLE urls (id INTEGER PRIMARY KEY, url TEXT, title TEXT, visit_count INTEGER, typed_count INTEGER, last_visit_time INTEGER);'
+            'CREATE TABLE visits (id INTEGER PRIMARY KEY, url INTEGER, visit_time INTEGER, transition INTEGER);')
+        ts = now() + CHROMIUM_EPOCH_OFFSET
+        src.cursor().executemany('INSERT INTO urls VALUES (?, ?, ?, ?, 0, ?)', (
+            (1, 'https://a.org/?utm_source=x', 'A', 2, ts), (2, 'https://a.org/', 'A', 1, ts), (3, 'https://b.org/', 'B', 1, ts)))
+        src.cursor().executemany('INSERT INTO visits VALUES (?, ?, ?, 0)', ((i, url, ts) for i, url in enumerate((1, 1, 2, 3), 1)))
+        src.close()
+        p = Places(os.path.join(tdir, 'places.sqlite'))
+
+        def visits():
+            return dict(p.read('SELECT p.url, COUNT(*) FROM places p JOIN visits v ON v.place_id = p.id GROUP BY p.url'))
+
+        # Interrupt the import while re-aging frecency
+        reage = p.reage_frecency
+
+        def interrupted(**kw):
+            raise KeyboardInterrupt()
+        p.reage_frecency = interrupted
+        try:
+            import_history('chromium', path, p, report=None)
+        except KeyboardInterrupt:
+            pass
+        del p.reage_frecency
+        calls = []
+        p.reage_frecency = lambda **kw: calls.append(reage(**kw))
+        import_history('chromium', path, p, report=None)
+        assert len(calls) == 1
+        assert visits() == {'https://a.org/': 3, 'https://b.org/': 1}
+        assert list(p.read('SELECT stage FROM imports')) == [('done',)]
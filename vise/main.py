@@ -18,13 +18,14 @@ from gettext import gettext as _
 
 import sip
 from PyQt5.Qt import (
-    QApplication, QFontDatabase, QNetworkDiskCache, QLocalSocket, QLocalServer,
+    QApplication, QFontDatabase, QLocalSocket, QLocalServer,
     QSslSocket, QTextStream, QAbstractSocket, QTimer, Qt, pyqtSignal,
     QSocketNotifier, QNetworkCacheMetaData
 )
 
 from .constants import appname, str_version, cache_dir, iswindows, isosx, local_socket_address
 from .downloads import Downloads
+from .favicons import create_favicon_cache, decoded_icons
 from .keys import KeyFilter
 from .message_box import error_dialog
 from .settings import delete_profile
@@ -60,13 +61,6 @@ def option_parser():
     return parser
 
 
-def create_favicon_cache():
-    c = QNetworkDiskCache()
-    c.setCacheDirectory(os.path.join(cache_dir, 'favicons'))
-    c.setMaximumCacheSize(25 * 1024 * 1024)
-    return c
-
-
 class Application(QApplication):
 
     password_loaded = pyqtSignal(object, object)
@@ -256,6 +250,7 @@ class Application(QApplication):
                         return  # error occurred
                     ic = ic[written:]
                 self.disk_cache.insert(dio)
+                decoded_icons.discard(qurl.toString())
 
     def shutdown(self):
         self.lastWindowClosed.disconnect()
@@ -273,6 +268,18 @@ class Application(QApplication):
                     pass
         for w in self.windows:
             w.close()
+        places.flush()
+        password_db.lock()
+
+    def schedule_places_maintenance(self):
+        # Prune history, let frecency decay for places that have not been
+        # visited recently and vacuum, once shortly after startup and then
+        # daily. Maintenance pauses whenever history is being written.
+        self.places_maintenance_timer = t = QTimer(self)
+        t.setInterval(24 * 60 * 60 * 1000)
+        t.timeout.connect(places.start_maintenance)
+        t.start()
+        QTimer.singleShot(60 * 1000, places.start_maintenance)
 
     def new_window(self, is_private=False, restart_state=None):
         w = MainWindow(is_private=is_private, restart_state=restart_state)
@@ -406,6 +413,7 @@ def run_app(
         os.environ['QTWEBENGINE_REMOTE_DEBUGGING'] = '127.0.0.1:%d' % port
         app.debug_port = port
     app.original_env = env
+    app.schedule_places_maintenance()
     style = Style()
     app.setStyle(style)
     try:
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# vim:fileencoding=utf-8
+# License: GPL v3 Copyright: 2017, Kovid Goyal <kovid at kovidgoyal.net>
+
+import argparse
+import json
+import os
+import random
+import string
+import sys
+import tempfile
+import time
+
+from ..crypto import AES256GCM, SECRETBOX, aes256gcm_available, decrypt_many, decrypt_v1, encrypt_many, encrypt_v1, random_bytes
+from .db import READ_THREADS, PasswordStore, usernames
+
+
+def random_word(rng, size=None):
+    return ''.join(rng.choice(string.ascii_lowercase) for i in range(size or rng.randint(3, 10)))
+
+
+def create_vault(dirpath, num_entries, rng):
+    ''' Create a vault with num_entries entries of one to three accounts,
+    using a random key, since deriving a key from a password is slow '''
+    store = PasswordStore(random_bytes(32), dirpath, pw_is_key=True, summarize=usernames)
+    for i in range(num_entries):
+        accounts = [{
+            'username': random_word(rng), 'password': random_word(rng, 16), 'notes': random_word(rng, rng.randint(0, 200)) or None,
+            'autologin': False} for a in range(rng.randint(1, 3))]
+        store.set_data('http:%s%d.com' % (random_word(rng), i), json.dumps({'version': 1, 'accounts': accounts}))
+    store.load_index()
+    return store
+
+
+def timed(func):
+    st = time.perf_counter()
+    func()
+    return time.perf_counter() - st
+
+
+def vault_scans(num_entries=10000, num_threads=READ_THREADS, seed=42):
+    ''' Measure the time taken by operations that decrypt every entry of a
+    vault, reading sequentially and on a pool of num_threads threads '''
+    rng = random.Random(seed)
+    with tempfile.TemporaryDirectory() as tdir:
+        print('Creating a vault with %d entries...' % num_entries, file=sys.stderr)
+        store = create_vault(tdir, num_entries, rng)
+
+        def rebuild_index():
+            os.remove(os.path.join(tdir, 'key-index'))
+            store._index = None
+            store.load_index()
+
+        operations = (
+            ('get_all_data', lambda: sum(1 for x in store.get_all_data())),
+            ('verify', store.verify),
+            ('rebuild_index', rebuild_index),
+            ('entries', store.entries),
+        )
+        for name, func in operations:
+            times = []
+            for threads in (1, num_threads):
+                store.num_threads = threads
+                times.append(timed(func))
+            print('%-14s sequential: %.3fs %d threads: %.3fs speedup: %.1fx' % (name, times[0], num_threads, times[1], times[0] / times[1]))
+
+
+def secretbox_overhead(num_messages=10000, size=200, seed=42):
+    ''' Measure the time per message taken to encrypt and decrypt messages of
+    the typical size of an entry one at a time and in a batch '''
+    rng = random.Random(seed)
+    key = random_bytes(32)
+    messages = [random_word(rng, size).encode('ascii') for i in range(num_messages)]
+    encrypted = [encrypt_v1(m, key) for m in messages]
+    out = bytearray(size)
+
+    def batch_encrypt():
+        for ciphertext, nonce in encrypt_many(messages, key):
+            pass
+
+    def batch_decrypt():
+        for data in decrypt_many(encrypted, key, out):
+            pass
+
+    operations = (
+        ('encrypt', lambda: [encrypt_v1(m, key) for m in messages], batch_encrypt),
+        ('decrypt', lambda: [decrypt_v1(c, n, key) for c, n in encrypted], batch_decrypt),
+    )
+    for name, single, batch in operations:
+        times = [timed(single) * 1e6 / num_messages, timed(batch) * 1e6 / num_messages]
+        print('%-8s one at a time: %.2fus batched: %.2fus per message' % (name, times[0], times[1]))
+
+
+def entry_formats(total_size=64 * 1024 * 1024, sizes=(200, 64 * 1024, 1024 * 1024)):
+    ''' Measure the throughput of encrypting and decrypting entries of the
+    specified sizes, adding up to total_size bytes, in the v1
+    (XSalsa20-Poly1305) and v2 (AES-256-GCM) formats '''
+    versions = [('v1', SECRETBOX)]
+    if aes256gcm_available():
+        versions.append(('v2', AES256GCM))
+    else:
+        print('AES-256-GCM is not supported on this computer, only measuring v1', file=sys.stderr)
+    key = random_bytes(32)
+    for size in sizes:
+        messages = [random_bytes(size)] * max(1, total_size // size)
+        mb = len(messages) * size / (1024 * 1024)
+        for name, version in versions:
+            encrypted = [(bytes(c), n) for c, n in encrypt_many(messages, key, version)]
+
+            def encrypt():
+                for x in encrypt_many(messages, key, version):
+                    pass
+
+            def decrypt():
+                for x in decrypt_many(encrypted, key, version=version):
+                    pass
+            print('%s %8d byte entries encrypt: %7.1f MB/s decrypt: %7.1f MB/s' % (name, size, mb / timed(encrypt), mb / timed(decrypt)))
+
+
+def main(args=sys.argv[1:]):
+    parser = argparse.ArgumentParser(prog='python -m vise.passwd.benchmark', description='Benchmark vault wide operations of the password store')
+    parser.add_argument(
+        'benchmark', nargs='?', default='vault-scans', choices=('vault-scans', 'secretbox', 'formats'),
+        help='The benchmark to run, secretbox measures the per message overhead of encryption, formats compares the entry formats')
+    parser.add_argument('--entries', type=int, default=10000, help='Number of entries in the synthetic vault')
+    parser.add_argument('--threads', type=int, default=READ_THREADS, help='Number of threads to read and decrypt entries with')
+    parser.add_argument('--seed', type=int, default=42, help='Seed for the random number generator')
+    args = parser.parse_args(args)
+    if args.benchmark == 'secretbox':
+        secretbox_overhead(args.entries, seed=args.seed)
+    elif args.benchmark == 'formats':
+        entry_formats()
+    else:
+        vault_scans(args.entries, args.threads, args.seed)
+
+
+if __name__ == '__main__':
+    main()
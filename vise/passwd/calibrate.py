@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+# vim:fileencoding=utf-8
+# License: GPL v3 Copyright: 2017, Kovid Goyal <kovid at kovidgoyal.net>
+
+import argparse
+import json
+import sys
+
+from ..crypto import AES256GCM, SECRETBOX, calibrate_kdf
+from .db import PasswordStore
+
+
+def open_store(vault):
+    if not PasswordStore.has_password(vault):
+        raise SystemExit('No password manager found')
+    pw = sys.stdin.read().rstrip()
+    store = PasswordStore(pw, vault)
+    store.join()
+    return store, pw
+
+
+def main(args=sys.argv[1:]):
+    parser = argparse.ArgumentParser(
+        prog='python -m vise.passwd.calibrate',
+        description='Find the Argon2id key derivation parameters that make unlocking the password manager take the specified time on this machine')
+    parser.add_argument('--time', type=float, default=1, help='The time in seconds unlocking should take')
+    parser.add_argument('--memory', type=int, default=256, help='The maximum memory in MB to use when unlocking')
+    parser.add_argument('--upgrade', action='store_true', default=False, help=(
+        'Re-encrypt the password manager to use the found parameters. The master password is read from stdin.'
+        ' vise must not be running.'))
+    parser.add_argument('--entry-format', choices=('secretbox', 'aes256gcm'), default=None, help=(
+        'Re-encrypt the entries of the password manager in the specified format, instead of calibrating. aes256gcm is faster,'
+        ' but a password manager using it can only be opened on computers whose CPU supports it. The master password is read'
+        ' from stdin. vise must not be running.'))
+    parser.add_argument('--vault', default=None, help='The directory of the password manager to upgrade, defaults to the one used by vise')
+    args = parser.parse_args(args)
+    if args.entry_format:
+        store = open_store(args.vault)[0]
+        print('Re-encrypting...', file=sys.stderr)
+        store.set_entry_version({'secretbox': SECRETBOX, 'aes256gcm': AES256GCM}[args.entry_format])
+        return
+    print('Calibrating...', file=sys.stderr)
+    kdf, taken = calibrate_kdf(args.time, args.memory * 1024 * 1024)
+    print('Unlocking takes %.2fs with the parameters:' % taken, file=sys.stderr)
+    print(json.dumps(kdf, indent=2))
+    if args.upgrade:
+        store, pw = open_store(args.vault)
+        print('Re-encrypting...', file=sys.stderr)
+        store.upgrade_kdf(pw, kdf)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,27 +2,196 @@
 # vim:fileencoding=utf-8
 # License: GPL v3 Copyright: 2015, Kovid Goyal <kovid at kovidgoyal.net>
 
+import io
 import json
 import os
 import hashlib
+import shutil
 import struct
 import tempfile
 from binascii import hexlify, unhexlify
-from threading import Thread
+from collections import OrderedDict, deque
+from functools import partial
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from threading import Lock, RLock, Thread, Timer
+from time import monotonic
 from urllib.parse import urlparse
 
-from ..constants import config_dir
-from ..crypto import derive_key_v1, generate_salt_v1, nonce_size_v1, decrypt_v1, encrypt_v1, lock_python_bytes, MessageForged
+from ..constants import config_dir, iswindows
+from ..crypto import (
+    AES256GCM, SECRETBOX, aes256gcm_available, decrypt_many, default_kdf, derive_key, encrypt_many, generate_salt, nonce_size, decrypt_v1,
+    encrypt_v1, kdf_params, lock_python_bytes, random_bytes, crypto_secretbox_macbytes, crypto_secretstream_xchacha20poly1305_headerbytes,
+    GuardedBytes, MessageForged, SecretStream)
 from ..utils import atomic_write
 from ..settings import DynamicPrefs
 
 password_exclusions = DynamicPrefs('password-exclusions')
+# Encrypted index of the keys of all entries, the - means it is not an entry
+INDEX_NAME = 'key-index'
+# Number of threads reading and decrypting entries in vault wide operations.
+# libsodium is called via ctypes, which releases the GIL.
+READ_THREADS = min(8, os.cpu_count() or 1)
+# Number of entries read per task, decrypting an entry takes too little time
+# for it to be worth a task of its own
+READ_CHUNK_SIZE = 32
+# Decrypted entries are cached for autofill, for at most this many seconds
+# and entries
+CREDENTIAL_CACHE_TTL = 300
+CREDENTIAL_CACHE_SIZE = 64
+# Used while changing the password. Entries are re-encrypted into the
+# staging directory, the journal is written, the current entries are backed
+# up and then replaced by the staged ones, metadata.json last. If that is
+# interrupted, the journal is used to roll back to the backups.
+REKEY_STAGING, REKEY_BACKUP, REKEY_JOURNAL = 'rekey-staging', 'rekey-backup', 'rekey-journal'
+# Attachments are stored in sub-directories of this directory, one per
+# entry, and encrypted with crypto_secretstream in chunks of
+# ATTACHMENT_CHUNK_SIZE bytes, so that memory use does not depend on their
+# size. Each attachment has its own key, stored encrypted with the key of
+# the store, so that changing the password does not re-encrypt them.
+ATTACHMENTS_DIR = 'attachments'
+ATTACHMENT_CHUNK_SIZE = 64 * 1024
+ATTACHMENT_HEADER = struct.Struct('!HI')  # version, chunk size
+
+
+def imap_ordered(func, iterable, num_threads=READ_THREADS):
+    ''' Like map() but func is run on a pool of threads, with a bounded
+    number of calls in flight, so that memory use is constant. The results
+    are yielded in order, as they become available. '''
+    if num_threads < 2:
+        yield from map(func, iterable)
+        return
+    with ThreadPoolExecutor(max_workers=num_threads, thread_name_prefix='ReadPW') as pool:
+        pending = deque()
+        for x in iterable:
+            pending.append(pool.submit(func, x))
+            if len(pending) >= 2 * num_threads:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def encode_entries(entries, enc_key, version=SECRETBOX):
+    ''' Yield the contents of the file for every (key, data) in entries. The
+    header of the file is the version of the encryption used, see
+    crypto.encrypt_many(). '''
+    header = struct.pack('!H', version)
+    messages = (struct.pack('!I', len(key)) + key + data for key, data in entries)
+    for ciphertext, nonce in encrypt_many(messages, enc_key, version):
+        yield b''.join((header, nonce, ciphertext))
+
+
+def encode_entry(key, data, enc_key, version=SECRETBOX):
+    return next(encode_entries(((key, data),), enc_key, version))
+
+
+def read_exactly(f, size):
+    ''' Read size bytes from f, fewer only at the end of the file '''
+    ans = f.read(size)
+    while ans and len(ans) < size:
+        more = f.read(size - len(ans))
+        if not more:
+            break
+        ans += more
+    return ans
+
+
+def wrapped_key_size():
+    return nonce_size() + 32 + crypto_secretbox_macbytes()
+
+
+def durable_write(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def fsync_dir(path):
+    if not iswindows:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+class UnsupportedFormat(ValueError):
+    pass
 
 
 class PasswordWrong(ValueError):
     pass
 
 
+class CredentialCache:
+
+    ''' A LRU cache of decrypted entries in guarded memory. Entries expire
+    ttl seconds after being added and are wiped by a timer, so nothing
+    remains in memory once autofill is idle. '''
+
+    def __init__(self, ttl=CREDENTIAL_CACHE_TTL, max_size=CREDENTIAL_CACHE_SIZE):
+        self.ttl, self.max_size = ttl, max_size
+        self.entries = OrderedDict()
+        self.lock = Lock()
+        self.timer = None
+
+    def get(self, key):
+        ''' Return (True, data) on a hit, (False, None) otherwise '''
+        with self.lock:
+            self.expire()
+            entry = self.entries.get(key)
+            if entry is None:
+                return False, None
+            self.entries.move_to_end(key)
+            return True, (None if entry[1] is None else entry[1].get())
+
+    def set(self, key, data):
+        with self.lock:
+            self.pop(key)
+            self.entries[key] = monotonic() + self.ttl, (None if data is None else GuardedBytes(data))
+            while len(self.entries) > self.max_size:
+                self.pop(next(iter(self.entries)))
+            self.schedule()
+
+    def invalidate(self, key):
+        with self.lock:
+            self.pop(key)
+
+    def clear(self):
+        with self.lock:
+            for key in tuple(self.entries):
+                self.pop(key)
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+
+    def pop(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None and entry[1] is not None:
+            entry[1].free()
+
+    def expire(self):
+        now = monotonic()
+        for key, (expires, data) in tuple(self.entries.items()):
+            if expires <= now:
+                self.pop(key)
+
+    def schedule(self):
+        if self.timer is None and self.entries:
+            delay = min(expires for expires, data in self.entries.values()) - monotonic()
+            self.timer = Timer(max(0, delay), self.on_timer)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def on_timer(self):
+        with self.lock:
+            self.timer = None
+            self.expire()
+            self.schedule()
+
+
 class PasswordStore:  # {{{
 
     @classmethod
@@ -39,9 +208,19 @@ class PasswordStore:  # {{{
             traceback.print_exc()
             return False
 
-    def __init__(self, password, dirpath=None, pw_is_key=False):
+    def __init__(self, password, dirpath=None, pw_is_key=False, summarize=None, kdf=None):
+        ''' kdf is the key derivation parameters used if the store is
+        created, see crypto.kdf_params(). Defaults to crypto.default_kdf(). '''
         dirpath = os.path.realpath(dirpath or os.path.join(config_dir, 'passwd'))
         self.root = dirpath
+        self.summarize = summarize or (lambda data: None)
+        self.num_threads = READ_THREADS
+        self._index = None
+        # Held while writing entries, so that migrate_entries() can run in
+        # the background without overwriting changes
+        self.write_lock = RLock()
+        # Writing the index is deferred while a batch() is active
+        self.batch_depth, self.index_dirty = 0, False
         if isinstance(password, str):
             password = password.encode('utf-8')
         lock_python_bytes(password)
@@ -50,14 +229,26 @@ class PasswordStore:  # {{{
         except FileExistsError:
             pass
         self.metadata_path = os.path.join(self.root, 'metadata.json')
+        self.recover_from_rekey()
         try:
             with open(self.metadata_path, 'rb') as f:
                 self.metadata = json.loads(f.read().decode('utf-8'))
         except FileNotFoundError:
+            kdf = kdf or default_kdf()
             self.metadata = {
                 'version': 1,
-                'salt': hexlify(generate_salt_v1()).decode('ascii')
+                'salt': hexlify(generate_salt(kdf)).decode('ascii')
             }
+            if kdf is not None:
+                self.metadata['kdf'] = kdf
+        # The format entries are written in, recorded in the metadata, so that
+        # a vault synced to a computer whose CPU cannot read it is not
+        # unlocked, see set_entry_version()
+        self.entry_version = self.metadata.get('entry_version', SECRETBOX)
+        if self.entry_version == AES256GCM and not aes256gcm_available():
+            raise UnsupportedFormat(
+                'This password manager is encrypted with AES-256-GCM, which is not supported by the CPU of this computer.'
+                ' Switch it to the XSalsa20-Poly1305 format on a computer that supports AES-256-GCM to use it here.')
         if pw_is_key:
             self.password = self.key_error = None
             self.key = password
@@ -79,8 +270,7 @@ class PasswordStore:  # {{{
     def derive_key(self):
         pw, self.password = self.password, None
         try:
-            self.key = derive_key_v1(pw, unhexlify(self.metadata['salt']))[0]
-            lock_python_bytes(self.key)
+            self.key = derive_key(pw, unhexlify(self.metadata['salt']), self.metadata.get('kdf'))
             if 'sentinel' not in self.metadata:
                 cipher, nonce = encrypt_v1(b'sentinel', self.key)
                 self.metadata['sentinel'] = (hexlify(nonce).decode('ascii'), hexlify(cipher).decode('ascii'))
@@ -106,29 +296,149 @@ class PasswordStore:  # {{{
             raise self.key_error
 
     def read_data(self, fname, key=None):
-        try:
-            with open(os.path.join(self.root, fname), 'rb') as f:
-                version = f.read(2)
-                if struct.unpack('!H', version)[0] != 1:
+        fname, key, data, err = self.read_chunk((fname,), key=key)[0]
+        if err is not None:
+            raise err
+        return key, data
+
+    def read_chunk(self, fnames, key=None):
+        ''' Return [(fname, key, data, error), ...] for fnames, with error the
+        exception raised reading the entry, if any. The files are read into
+        buffers that are decrypted in a single batch. '''
+        ans = []
+        # Map of encryption version to (indices into ans, messages)
+        batches = {version: ([], []) for version in (SECRETBOX, AES256GCM)}
+        for fname in fnames:
+            try:
+                with open(os.path.join(self.root, fname), 'rb') as f:
+                    raw = bytearray(os.fstat(f.fileno()).st_size)
+                    raw = memoryview(raw)[:f.readinto(raw)]
+                version = struct.unpack_from('!H', raw)[0] if len(raw) > 1 else None
+                if version not in batches:
                     raise ValueError('Unsupported encryption version')
-                nonce = f.read(nonce_size_v1())
-                data = decrypt_v1(f.read(), nonce, key or self.key)
-                keysize, = struct.unpack_from('!I', data)
-                offset = struct.calcsize('!I')
-                key = data[offset:keysize + offset].decode('utf-8')
-                return key, data[keysize + offset:]
-        except FileNotFoundError:
-            return None, None
+                nsize = nonce_size(version)
+                if len(raw) < 2 + nsize:
+                    raise ValueError('Truncated entry')
+                batches[version][0].append(len(ans))
+                batches[version][1].append((raw[2 + nsize:], raw[2:2 + nsize]))
+                ans.append(None)
+            except FileNotFoundError:
+                ans.append((fname, None, None, None))
+            except Exception as e:
+                ans.append((fname, None, None, e))
+        offset = struct.calcsize('!I')
+        for version, (pending, messages) in batches.items():
+            if not messages:
+                continue
+            for i, data in zip(pending, decrypt_many(messages, key or self.key, version=version)):
+                fname = fnames[i]
+                try:
+                    if data is None:
+                        raise MessageForged('Message forged!')
+                    keysize, = struct.unpack_from('!I', data)
+                    ans[i] = fname, str(data[offset:keysize + offset], 'utf-8'), bytes(data[keysize + offset:]), None
+                except Exception as e:
+                    ans[i] = fname, None, None, e
+        return ans
 
-    def __iter__(self):
+    def map_chunks(self, func, fnames):
+        ''' Yield the items of func(chunk) for chunks of the file names, in
+        order, running func on the chunks in parallel '''
+        fnames = iter(fnames)
+        chunks = iter(lambda: tuple(islice(fnames, READ_CHUNK_SIZE)), ())
+        for results in imap_ordered(func, chunks, num_threads=self.num_threads):
+            yield from results
+
+    def read_many(self, fnames, key=None):
+        ''' Yield (fname, key, data, error) for every file name, in order,
+        reading and decrypting them in parallel '''
+        return self.map_chunks(partial(self.read_chunk, key=key), fnames)
+
+    def write_data(self, fname, key, data):
+        atomic_write(os.path.join(self.root, fname), encode_entry(key, data, self.key, self.entry_version))
+
+    def entry_files(self):
         for entry in os.scandir(self.root):
             if not entry.is_symlink() and entry.is_file(follow_symlinks=False):
                 name = entry.name
                 if '.' not in name and '-' not in name:
-                    yield name
+                    yield entry
+
+    def __iter__(self):
+        for entry in self.entry_files():
+            yield entry.name
+
+    def signature(self, st):
+        # Changes when an entry is written, by us or by something else, such
+        # as a file synchronization tool. atomic_write() keeps the mtime of
+        # the file it replaces, but not its inode.
+        return [st.st_mtime_ns, st.st_size, st.st_ino]
+
+    def load_index(self):
+        ''' Return the index of all entries, a map of file name to [key,
+        summary, signature]. The index is stored encrypted in the vault, if it
+        is missing or stale, only the entries that changed since it was
+        written are decrypted to update it. '''
+        with self.write_lock:
+            if self._index is None:
+                self._index = {}
+                try:
+                    key, data = self.read_data(INDEX_NAME)
+                    if key == INDEX_NAME:
+                        self._index = json.loads(data.decode('utf-8'))['entries']
+                except Exception:
+                    import traceback
+                    traceback.print_exc()
+            index, changed = self._index, False
+            current = {entry.name: self.signature(entry.stat(follow_symlinks=False)) for entry in self.entry_files()}
+            for fname in tuple(index):
+                if fname not in current:
+                    del index[fname]
+                    changed = True
+            stale = [fname for fname, sig in current.items() if fname not in index or index[fname][2] != current[fname]]
+            for fname, key, data, err in self.read_many(stale):
+                changed = True
+                if key is None:
+                    index.pop(fname, None)
+                else:
+                    index[fname] = [key, self.summarize(data), current[fname]]
+            if changed:
+                self.write_index()
+            return index
+
+    def write_index(self):
+        data = json.dumps({'version': 1, 'entries': self._index}, ensure_ascii=False).encode('utf-8')
+        self.write_data(INDEX_NAME, INDEX_NAME.encode('utf-8'), data)
+
+    def update_index(self, fname, key, data):
+        if self._index is None:
+            return
+        if data is None:
+            self._index.pop(fname, None)
+        else:
+            st = os.stat(os.path.join(self.root, fname), follow_symlinks=False)
+            self._index[fname] = [key, self.summarize(data), self.signature(st)]
+        if self.batch_depth:
+            self.index_dirty = True
+        else:
+            self.write_index()
 
     # External API {{{
 
+    @contextmanager
+    def batch(self):
+        ''' Write the index once, at the end of a sequence of set_data()
+        calls, instead of after every one of them '''
+        with self.write_lock:
+            self.batch_depth += 1
+            try:
+                yield self
+            finally:
+                self.batch_depth -= 1
+                if not self.batch_depth and self.index_dirty:
+                    self.index_dirty = False
+                    self.write_index()
+
     def __contains__(self, key):
         fname = self.generate_file_name(key)
         return os.path.exists(os.path.join(self.root, fname))
@@ -141,64 +451,570 @@ class PasswordStore:  # {{{
         except MessageForged:
             raise ValueError('The data for %s is corrupted' % key)
 
+    def entries(self):
+        ''' Return (key, summary) for all entries, without decrypting them,
+        if the index is up to date '''
+        self.join()
+        return [(key, summary) for key, summary, sig in self.load_index().values()]
+
+    def get_many(self, keys):
+        ''' Yield (key, data) for every key, in order, decrypting them in
+        parallel. data is None for missing keys. '''
+        self.join()
+        keys = tuple(keys)
+        for key, (fname, k, data, err) in zip(keys, self.read_many(map(self.generate_file_name, keys))):
+            if err is not None:
+                raise ValueError('The data for %s is corrupted' % key)
+            yield key, data
+
     def get_all_data(self):
         self.join()
-        for name in self:
-            try:
-                key, data = self.read_data(name)
-            except Exception:
-                key = None
+        for name, key, data, err in self.read_many(sorted(self)):
             if key is not None:
                 yield key, data
 
+    def verify(self):
+        ''' Return the file names of the entries that cannot be decrypted '''
+        self.join()
+        return [name for name, key, data, err in self.read_many(sorted(self)) if err is not None]
+
     def set_data(self, key, data=None):
         self.join()
-        fname = self.generate_file_name(key)
-        if isinstance(key, str):
-            key = key.encode('utf-8')
-        if isinstance(data, str):
-            data = data.encode('utf-8')
-        fpath = os.path.join(self.root, fname)
-        if data is None:
+        with self.write_lock:
+            fname = self.generate_file_name(key)
+            if isinstance(key, bytes):
+                key = key.decode('utf-8')
+            if isinstance(data, str):
+                data = data.encode('utf-8')
+            if data is None:
+                try:
+                    os.remove(os.path.join(self.root, fname))
+                except FileNotFoundError:
+                    pass
+                shutil.rmtree(self.attachment_dir(key), ignore_errors=True)
+            else:
+                self.write_data(fname, key.encode('utf-8'), data)
+            self.update_index(fname, key, data)
+
+    def attachment_dir(self, key):
+        return os.path.join(self.root, ATTACHMENTS_DIR, self.generate_file_name(key))
+
+    def attachment_path(self, key, name):
+        return os.path.join(self.attachment_dir(key), self.generate_file_name(name))
+
+    def attachment_files(self):
+        ''' Yield the paths of all attachments, relative to the root of the
+        store '''
+        try:
+            dirs = list(os.scandir(os.path.join(self.root, ATTACHMENTS_DIR)))
+        except FileNotFoundError:
+            return
+        for d in dirs:
+            if d.is_dir(follow_symlinks=False):
+                for entry in os.scandir(d.path):
+                    if entry.is_file(follow_symlinks=False) and '-' not in entry.name:
+                        yield os.path.join(ATTACHMENTS_DIR, d.name, entry.name)
+
+    def read_attachment_key(self, f, key=None):
+        ''' Read the header of the attachment file f up to the stream header,
+        returning (chunk_size, attachment key) '''
+        try:
+            version, chunk_size = ATTACHMENT_HEADER.unpack(read_exactly(f, ATTACHMENT_HEADER.size))
+        except struct.error:
+            raise ValueError('Truncated attachment')
+        if version != 1:
+            raise ValueError('Unsupported attachment version')
+        wrapped = read_exactly(f, wrapped_key_size())
+        akey = decrypt_v1(wrapped[nonce_size():], wrapped[:nonce_size()], key or self.key)
+        lock_python_bytes(akey)
+        return chunk_size, akey
+
+    def open_attachment(self, f):
+        ''' Read the header of the attachment file f, returning (name,
+        chunk_size, stream) with stream the SecretStream to decrypt the
+        chunks that follow '''
+        chunk_size, akey = self.read_attachment_key(f)
+        stream = SecretStream(akey, read_exactly(f, crypto_secretstream_xchacha20poly1305_headerbytes()))
+        try:
+            size = read_exactly(f, 4)
+            if len(size) != 4:
+                raise ValueError('Truncated attachment')
+            name, final = stream.pull(read_exactly(f, struct.unpack('!I', size)[0]))
+        except Exception:
+            stream.free()
+            raise
+        return str(name, 'utf-8'), chunk_size, stream
+
+    def encode_attachment(self, name, source, chunk_size=ATTACHMENT_CHUNK_SIZE):
+        ''' Yield the contents of the file for the attachment named name,
+        with data read from the file object source '''
+        akey = random_bytes(32)
+        lock_python_bytes(akey)
+        stream = SecretStream(akey)
+        # The stream state is freed even if the generator is not exhausted,
+        # for example, when writing the file fails
+        try:
+            ciphertext, nonce = encrypt_v1(akey, self.key)
+            ename = bytes(stream.push(name.encode('utf-8')))
+            yield b''.join((ATTACHMENT_HEADER.pack(1, chunk_size), nonce, ciphertext, stream.header, struct.pack('!I', len(ename)), ename))
+            chunk = read_exactly(source, chunk_size)
+            while True:
+                # The last chunk is marked as final, so that truncation is detected
+                following = read_exactly(source, chunk_size) if len(chunk) == chunk_size else b''
+                yield stream.push(chunk, final=not following)
+                if not following:
+                    break
+                chunk = following
+        finally:
+            stream.free()
+
+    def set_attachment(self, key, name, source):
+        ''' Store the attachment named name for the entry key, replacing any
+        existing attachment with that name. source is bytes or a file object,
+        which is read a chunk at a time. Attachments are removed with their
+        entry. '''
+        self.join()
+        if isinstance(source, bytes):
+            source = io.BytesIO(source)
+        with self.write_lock:
+            os.makedirs(self.attachment_dir(key), exist_ok=True)
+            atomic_write(self.attachment_path(key, name), self.encode_attachment(name, source))
+
+    def remove_attachment(self, key, name):
+        with self.write_lock:
+            try:
+                os.remove(self.attachment_path(key, name))
+                os.rmdir(self.attachment_dir(key))
+            except OSError:
+                pass
+
+    def attachments(self, key):
+        ''' Return the sorted names of the attachments of the entry key '''
+        self.join()
+        ans = []
+        try:
+            files = [e.path for e in os.scandir(self.attachment_dir(key)) if e.is_file(follow_symlinks=False) and '-' not in e.name]
+        except FileNotFoundError:
+            return ans
+        for path in files:
             try:
-                os.remove(fpath)
+                with open(path, 'rb') as f:
+                    name, chunk_size, stream = self.open_attachment(f)
+                stream.free()
+                ans.append(name)
             except FileNotFoundError:
                 pass
+            except MessageForged:
+                raise ValueError('The attachments of %s are corrupted' % key)
+        return sorted(ans)
+
+    def iter_attachment(self, key, name):
+        ''' Yield the data of the attachment named name of the entry key, in
+        chunks. Raises ValueError at the end if the attachment is truncated or
+        corrupted, so the data should not be used before then. '''
+        self.join()
+        with open(self.attachment_path(key, name), 'rb') as f:
+            stream = None
+            try:
+                aname, chunk_size, stream = self.open_attachment(f)
+                if aname != name:
+                    raise MessageForged('Attachment name does not match')
+                while True:
+                    raw = read_exactly(f, chunk_size + stream.abytes)
+                    if not raw:
+                        raise ValueError('The attachment %s of %s is truncated' % (name, key))
+                    data, final = stream.pull(raw)
+                    yield bytes(data)
+                    if final:
+                        break
+                if f.read(1):
+                    raise ValueError('The attachment %s of %s has extra data' % (name, key))
+            except MessageForged:
+                raise ValueError('The attachment %s of %s is corrupted' % (name, key))
+            finally:
+                if stream is not None:
+                    stream.free()
+
+    def export_attachment(self, key, name, dest):
+        ''' Write the decrypted attachment to dest, a path, which is written
+        atomically, so that it is not replaced by corrupted data, or a file
+        object '''
+        if hasattr(dest, 'write'):
+            for chunk in self.iter_attachment(key, name):
+                dest.write(chunk)
         else:
-            keysize = struct.pack('!I', len(key))
-            data, nonce = encrypt_v1(keysize + key + data, self.key)
-            atomic_write(fpath, struct.pack('!H', 1) + nonce + data)
+            atomic_write(dest, self.iter_attachment(key, name))
+
+    def rewrap_attachment(self, path, dest, new_key):
+        ''' Copy the attachment file at path to dest with its key encrypted
+        with new_key instead of the current key '''
+        with open(path, 'rb') as src:
+            chunk_size, akey = self.read_attachment_key(src)
+            ciphertext, nonce = encrypt_v1(akey, new_key)
+            with open(dest, 'wb') as f:
+                f.write(ATTACHMENT_HEADER.pack(1, chunk_size) + nonce + ciphertext)
+                shutil.copyfileobj(src, f)
+                f.flush()
+                os.fsync(f.fileno())
+        with open(dest, 'rb') as f:
+            if self.read_attachment_key(f, new_key)[1] != akey:
+                raise ValueError('Verification of the re-encrypted attachment {} failed'.format(path))
+
+    def new_key(self, password, kdf):
+        salt = generate_salt(kdf)
+        key = derive_key(password, salt, kdf)
+        cipher, nonce = encrypt_v1(b'sentinel', key)
+        metadata = dict(self.metadata, salt=hexlify(salt).decode('ascii'), sentinel=(hexlify(nonce).decode('ascii'), hexlify(cipher).decode('ascii')))
+        metadata.pop('kdf', None)
+        if kdf is not None:
+            metadata['kdf'] = kdf
+        return key, metadata
 
     def change_password(self, new_password):
+        ''' Re-encrypt all entries with a key derived from new_password. Either
+        every entry and the metadata are switched to the new key, or, if
+        anything fails, including a crash, nothing is. '''
         self.join()
-        old_key = self.key
-        self.password = new_password
-        self.metadata.pop('sentinel', None)
-        self.run_derive()
+        with self.write_lock:
+            self.rekey(*self.new_key(new_password, self.metadata.get('kdf')))
+
+    def upgrade_kdf(self, password, kdf):
+        ''' Re-encrypt all entries with a key derived from the current
+        password using the key derivation parameters kdf, for example, to
+        upgrade a vault using the v1 parameters to Argon2id '''
         self.join()
-        if self.key_error is not None:
-            raise self.key_error
+        if derive_key(password, unhexlify(self.metadata['salt']), self.metadata.get('kdf')) != self.key:
+            raise PasswordWrong('The password is incorrect')
+        with self.write_lock:
+            self.rekey(*self.new_key(password, kdf))
+
+    def set_entry_version(self, version):
+        ''' Switch the format entries are encrypted in to version, SECRETBOX
+        (XSalsa20-Poly1305, the default) or AES256GCM, which is faster, but
+        can only be read on computers whose CPU supports it. Returns the
+        number of entries re-encrypted. '''
+        if version == AES256GCM and not aes256gcm_available():
+            raise UnsupportedFormat('AES-256-GCM is not supported by the CPU of this computer')
+        self.join()
+        with self.write_lock:
+            self.entry_version = version
+            # The metadata must only say the vault is readable without
+            # AES-256-GCM once every entry is
+            if version == AES256GCM:
+                self.metadata['entry_version'] = version
+                self.commit_metadata()
+        count = self.migrate_entries()
+        if version == SECRETBOX:
+            with self.write_lock:
+                self.metadata.pop('entry_version', None)
+                self.commit_metadata()
+        return count
+
+    def migrate_entries(self, stop=None):
+        ''' Re-encrypt the entries that are not in the format of the vault,
+        self.entry_version, a chunk at a time, so that it can run
+        in the background while the store is in use. Entries that change
+        while being migrated are left alone. Migration stops early if stop()
+        returns True. Returns the number of entries migrated. '''
+        self.join()
+        header = struct.pack('!H', self.entry_version)
 
-        for name in self:
+        def needs_migration(fname):
             try:
-                key, data = self.read_data(name, key=old_key)
-            except Exception:
+                with open(os.path.join(self.root, fname), 'rb') as f:
+                    return f.read(2) != header
+            except FileNotFoundError:
+                return False
+
+        names, count = [fname for fname in self if needs_migration(fname)], 0
+        for i in range(0, len(names), READ_CHUNK_SIZE):
+            if stop is not None and stop():
+                break
+            signatures = {}
+            for fname in names[i:i + READ_CHUNK_SIZE]:
+                try:
+                    signatures[fname] = self.signature(os.stat(os.path.join(self.root, fname)))
+                except FileNotFoundError:
+                    pass
+            found = [(fname, key, data) for fname, key, data, err in self.read_chunk(tuple(signatures)) if key is not None]
+            with self.write_lock:
+                for (fname, key, data), raw in zip(found, encode_entries(
+                        ((key.encode('utf-8'), data) for fname, key, data in found), self.key, self.entry_version)):
+                    path = os.path.join(self.root, fname)
+                    try:
+                        if self.signature(os.stat(path)) != signatures[fname]:
+                            continue
+                    except FileNotFoundError:
+                        continue
+                    atomic_write(path, raw)
+                    count += 1
+                    if self._index is not None and fname in self._index:
+                        self._index[fname][2] = self.signature(os.stat(path))
+        with self.write_lock:
+            if count or needs_migration(INDEX_NAME):
+                self.load_index()
+                self.write_index()
+        return count
+
+    def rekey(self, new_key, metadata):
+        staging, backup, journal = (os.path.join(self.root, x) for x in (REKEY_STAGING, REKEY_BACKUP, REKEY_JOURNAL))
+        for x in (staging, backup):
+            shutil.rmtree(x, ignore_errors=True)
+            os.mkdir(x)
+        try:
+            names = sorted(self)
+
+            def stage(chunk):
+                entries = self.read_chunk(chunk)
+                found = [(fname, key, data) for fname, key, data, err in entries if key is not None]
+                for (fname, key, data), raw in zip(found, encode_entries(
+                        ((key.encode('utf-8'), data) for fname, key, data in found), new_key, self.entry_version)):
+                    durable_write(os.path.join(staging, fname), raw)
+                return [
+                    (fname, None, None, err) if key is None else (fname, key, self.summarize(data), hashlib.sha256(data).digest())
+                    for fname, key, data, err in entries]
+
+            index, failed = {}, []
+            for fname, key, summary, digest in self.map_chunks(stage, names):
+                if key is None:
+                    if digest is not None:
+                        failed.append(fname)
+                else:
+                    index[fname] = [key, summary, digest]
+            if failed:
+                raise ValueError('The password was not changed as {} entries could not be decrypted: {}'.format(len(failed), ', '.join(failed)))
+
+            def verify(chunk):
+                entries = self.read_chunk(tuple(os.path.join(REKEY_STAGING, fname) for fname in chunk), key=new_key)
+                return [
+                    (fname, data is not None and hashlib.sha256(data).digest() == index[fname][2], self.signature(os.stat(os.path.join(staging, fname))))
+                    for fname, (path, key, data, err) in zip(chunk, entries)]
+
+            for fname, ok, sig in self.map_chunks(verify, list(index)):
+                if not ok:
+                    raise ValueError('Verification of the re-encrypted entry {} failed'.format(fname))
+                index[fname][2] = sig
+            attachments = sorted(self.attachment_files())
+            for path in attachments:
+                os.makedirs(os.path.dirname(os.path.join(staging, path)), exist_ok=True)
+                self.rewrap_attachment(os.path.join(self.root, path), os.path.join(staging, path), new_key)
+            data = json.dumps({'version': 1, 'entries': index}, ensure_ascii=False).encode('utf-8')
+            durable_write(os.path.join(staging, INDEX_NAME), encode_entry(INDEX_NAME.encode('utf-8'), data, new_key, self.entry_version))
+            durable_write(os.path.join(staging, 'metadata.json'), json.dumps(metadata, indent=2, ensure_ascii=False).encode('utf-8'))
+            fsync_dir(staging)
+        except Exception:
+            shutil.rmtree(staging, ignore_errors=True)
+            shutil.rmtree(backup, ignore_errors=True)
+            raise
+
+        # Switch over, from here on an interruption is rolled back using the
+        # journal by recover_from_rekey()
+        durable_write(journal, json.dumps({'version': 1, 'salt': metadata['salt']}).encode('utf-8'))
+        fsync_dir(self.root)
+        names = list(index) + attachments + [INDEX_NAME, 'metadata.json']
+        for fname in names:
+            os.makedirs(os.path.dirname(os.path.join(backup, fname)), exist_ok=True)
+            try:
+                os.link(os.path.join(self.root, fname), os.path.join(backup, fname))
+            except FileNotFoundError:
                 pass
-            else:
-                self.set_data(key, data)
+            except OSError:
+                shutil.copy2(os.path.join(self.root, fname), os.path.join(backup, fname))
+        fsync_dir(backup)
+        try:
+            for fname in names:
+                os.replace(os.path.join(staging, fname), os.path.join(self.root, fname))
+            fsync_dir(self.root)
+        except Exception:
+            self.recover_from_rekey()
+            raise
+        self.key, self.metadata, self._index = new_key, metadata, index
+        self.recover_from_rekey()
+
+    def recover_from_rekey(self):
+        ''' Clean up after changing the password. If the switch to the new key
+        was interrupted before the new metadata was in place, restore the
+        backed up entries. '''
+        staging, backup, journal = (os.path.join(self.root, x) for x in (REKEY_STAGING, REKEY_BACKUP, REKEY_JOURNAL))
+        try:
+            with open(journal, 'rb') as f:
+                salt = json.loads(f.read().decode('utf-8'))['salt']
+        except FileNotFoundError:
+            salt = None
+        if salt is not None:
+            try:
+                with open(self.metadata_path, 'rb') as f:
+                    committed = json.loads(f.read().decode('utf-8')).get('salt') == salt
+            except FileNotFoundError:
+                committed = False
+            if not committed:
+                for dirpath, dirnames, filenames in os.walk(backup):
+                    for fname in filenames:
+                        path = os.path.relpath(os.path.join(dirpath, fname), backup)
+                        os.replace(os.path.join(backup, path), os.path.join(self.root, path))
+                fsync_dir(self.root)
+                self._index = None
+            os.remove(journal)
+        for x in (staging, backup):
+            shutil.rmtree(x, ignore_errors=True)
     # }}}
 # }}}
 
 
 def test():
+    from ..crypto import ARGON2ID, crypto_pwhash, crypto_pwhash_memlimit_min, generate_salt_v1
     with tempfile.TemporaryDirectory() as tdir:
+        # A vault created before the key derivation parameters were stored
+        with open(os.path.join(tdir, 'metadata.json'), 'wb') as f:
+            f.write(json.dumps({'version': 1, 'salt': hexlify(generate_salt_v1()).decode('ascii')}).encode('utf-8'))
         p = PasswordStore('test', tdir)
         p.join()
+        assert 'kdf' not in p.metadata
         p.set_data('a', 'one')
         assert p.get_data('a') == b'one'
         assert tuple(p.get_all_data()) == (('a', b'one'),)
+        if crypto_pwhash is not None:
+            kdf = kdf_params(1, crypto_pwhash_memlimit_min() * 8, ARGON2ID)
+            try:
+                p.upgrade_kdf('wrong', kdf)
+                raise AssertionError('Upgraded with the wrong password')
+            except PasswordWrong:
+                pass
+            p.upgrade_kdf('test', kdf)
+            assert p.metadata['kdf'] == kdf
+            assert tuple(PasswordStore('test', tdir).get_all_data()) == (('a', b'one'),)
         p.change_password('pw2')
+        assert p.metadata.get('kdf') == (kdf if crypto_pwhash is not None else None)
         assert tuple(p.get_all_data()) == (('a', b'one'),)
+        assert tuple(PasswordStore('pw2', tdir).get_all_data()) == (('a', b'one'),)
+        # An interrupted change of password is rolled back
+        old_key, orig_replace, calls = p.key, os.replace, []
+
+        def crashing_replace(src, dest):
+            calls.append(src)
+            if len(calls) > 1:
+                raise OSError('simulated crash')
+            orig_replace(src, dest)
+        p.set_data('z', 'two')
+        os.replace = crashing_replace
+        try:
+            p.change_password('pw3')
+            raise AssertionError('change_password() did not fail')
+        except OSError:
+            pass
+        finally:
+            os.replace = orig_replace
+        # The rollback also failed, as os.replace() is still broken, so it is
+        # done when the store is next opened, as after a crash
+        assert p.key == old_key
+        p = PasswordStore(old_key, tdir, pw_is_key=True)
+        assert not os.path.exists(os.path.join(tdir, REKEY_JOURNAL)) and not os.path.exists(os.path.join(tdir, REKEY_BACKUP))
+        assert sorted(p.get_all_data()) == [('a', b'one'), ('z', b'two')]
+        p.set_data('z')
+        # The index is kept up to date and rebuilt when stale
+        p.summarize = lambda data: len(data)
+        p.set_data('b', 'three')
+        assert sorted(p.entries()) == [('a', None), ('b', 5)]
+        p.set_data('a')
+        assert p.entries() == [('b', 5)]
+        q = PasswordStore(p.key, tdir, pw_is_key=True, summarize=p.summarize)
+        q.set_data('c', 'c')
+        os.remove(os.path.join(tdir, p.generate_file_name('b')))
+        assert p.entries() == [('c', 1)]
+        os.remove(os.path.join(tdir, INDEX_NAME))
+        p._index = None
+        assert p.entries() == [('c', 1)]
+        # Writes in a batch update the index once, at the end
+        writes = []
+        orig_write_index = p.write_index
+        p.write_index = lambda: (writes.append(1), orig_write_index())
+        with p.batch():
+            p.set_data('d', 'dd')
+            with p.batch():
+                p.set_data('e', 'e')
+            assert not writes
+        assert len(writes) == 1
+        del p.write_index
+        assert sorted(PasswordStore(p.key, tdir, pw_is_key=True, summarize=p.summarize).entries()) == [('c', 1), ('d', 2), ('e', 1)]
+        p.set_data('d'), p.set_data('e')
+        # Parallel reads are in order
+        for i in range(20):
+            p.set_data('k%d' % i, str(i))
+        keys = ['k%d' % i for i in range(20)] + ['missing']
+        assert list(p.get_many(keys)) == [(k, str(i).encode('ascii')) for i, k in enumerate(keys[:-1])] + [('missing', None)]
+        assert p.verify() == []
+        with open(os.path.join(tdir, p.generate_file_name('k3')), 'r+b') as f:
+            f.seek(-1, os.SEEK_END), f.write(b'x')
+        assert p.verify() == [p.generate_file_name('k3')]
+        p.set_data('k3')
+        # Entries are only switched to AES-256-GCM on request, entries in the
+        # other format remain readable and are migrated
+        assert p.entry_version == SECRETBOX
+        if aes256gcm_available():
+            p.set_data('old', 'v1')
+            p.entry_version = AES256GCM
+            p.set_data('new', 'v2')
+            assert list(p.get_many(['old', 'new'])) == [('old', b'v1'), ('new', b'v2')]
+            assert p.set_entry_version(AES256GCM) > 0 and p.metadata['entry_version'] == AES256GCM
+            for fname in tuple(p) + (INDEX_NAME,):
+                with open(os.path.join(tdir, fname), 'rb') as f:
+                    assert struct.unpack('!H', f.read(2))[0] == AES256GCM
+            assert p.migrate_entries() == 0 and p.get_data('old') == b'v1' and p.verify() == []
+            assert sorted(p.entries()) == sorted(PasswordStore(p.key, tdir, pw_is_key=True, summarize=p.summarize).entries())
+            # A vault using AES-256-GCM is not unlocked on computers that
+            # cannot read it
+            from .. import crypto
+            orig, crypto.crypto_aead_aes256gcm_is_available = crypto.crypto_aead_aes256gcm_is_available, lambda: 0
+            try:
+                PasswordStore(p.key, tdir, pw_is_key=True)
+                raise AssertionError('Unlocked a vault that cannot be read')
+            except UnsupportedFormat:
+                pass
+            finally:
+                crypto.crypto_aead_aes256gcm_is_available = orig
+            p.set_entry_version(SECRETBOX)
+            assert 'entry_version' not in p.metadata and PasswordStore(p.key, tdir, pw_is_key=True).entry_version == SECRETBOX
+        # Attachments are encrypted a chunk at a time
+        big = random_bytes(3 * ATTACHMENT_CHUNK_SIZE + 5)
+        p.set_attachment('b', 'big.bin', io.BytesIO(big))
+        p.set_attachment('b', 'empty', b'')
+        p.set_attachment('b', 'exact', b'x' * ATTACHMENT_CHUNK_SIZE)
+        assert p.attachments('b') == ['big.bin', 'empty', 'exact'] and p.attachments('c') == []
+        assert b''.join(p.iter_attachment('b', 'big.bin')) == big and b''.join(p.iter_attachment('b', 'empty')) == b''
+        p.change_password('pw4')
+        out = io.BytesIO()
+        p.export_attachment('b', 'exact', out)
+        assert out.getvalue() == b'x' * ATTACHMENT_CHUNK_SIZE
+        p.export_attachment('b', 'big.bin', os.path.join(tdir, 'exported.bin'))
+        with open(os.path.join(tdir, 'exported.bin'), 'rb') as f:
+            assert f.read() == big
+        path = p.attachment_path('b', 'big.bin')
+        with open(path, 'r+b') as f:
+            f.truncate(os.path.getsize(path) - 5 - SecretStream(p.key).abytes)
+        try:
+            b''.join(p.iter_attachment('b', 'big.bin'))
+            raise AssertionError('Truncated attachment was read')
+        except ValueError:
+            pass
+        p.set_data('b')
+        assert p.attachments('b') == []
+    # Autofill reads are cached until the entry changes
+    with tempfile.TemporaryDirectory() as tdir:
+        db = PasswordDB(p.key, tdir, pw_is_key=True)
+        db.add_account('http:x', 'u', 'p')
+        assert db.get_accounts('http:x')[0]['username'] == 'u' and db.get_accounts('http:y') == []
+        os.remove(os.path.join(tdir, db.store.generate_file_name('http:x')))
+        assert db.get_accounts('http:x')[0]['username'] == 'u'
+        db.add_account('http:x', 'v', 'p')
+        assert [a['username'] for a in db.get_accounts('http:x')] == ['v', 'u']
+        db.lock()
+        assert not db.cache.entries
+        cache = CredentialCache(ttl=0.01, max_size=2)
+        for key in 'abc':
+            cache.set(key, key.encode('ascii'))
+        assert cache.get('a') == (False, None) and cache.get('c') == (True, b'c')
+        cache.timer.join()
+        assert not cache.entries and cache.timer is None
 
 
 def key_from_url(url):
@@ -213,6 +1029,14 @@ def key_from_url(url):
     return key
 
 
+def usernames(data):
+    # The summary of an entry in the index of the store
+    try:
+        return [a['username'] for a in json.loads(data.decode('utf-8'))['accounts']]
+    except Exception:
+        return []
+
+
 class PasswordDB:
 
     @classmethod
@@ -220,15 +1044,20 @@ class PasswordDB:
         return PasswordStore.has_password(path)
 
     def __init__(self, password, path=None, pw_is_key=False):
-        self.store = PasswordStore(password, path, pw_is_key=pw_is_key)
+        self.store = PasswordStore(password, path, pw_is_key=pw_is_key, summarize=usernames)
+        self.cache = CredentialCache()
 
     def __getitem__(self, key):
-        data = self.store.get_data(key)
+        found, data = self.cache.get(key)
+        if not found:
+            data = self.store.get_data(key)
+            self.cache.set(key, data)
         if data is None:
             return {'version': 1, 'accounts': []}
         return json.loads(data.decode('utf-8'))
 
     def __setitem__(self, key, val):
+        self.cache.invalidate(key)
         if val is None:
             self.store.set_data(key)
         else:
@@ -241,14 +1070,29 @@ class PasswordDB:
         return key in self.store
 
     def __iter__(self):
-        for key, data in self.store.get_all_data():
+        for key, accounts in self.store.entries():
             yield key
 
+    def entries(self):
+        ''' Return (key, usernames) for every key '''
+        return self.store.entries()
+
+    def items(self):
+        ''' Yield (key, data) for every key, decrypting in parallel, for
+        exporting '''
+        for key, data in self.store.get_all_data():
+            yield key, json.loads(data.decode('utf-8'))
+
     def get_accounts(self, key):
         return self[key]['accounts']
 
-    def add_account(self, key, username, password, notes=None, autologin=None):
-        data = self[key]
+    def add_account(self, key, username, password, notes=None, autologin=None, data=None):
+        ''' Add an account to the data for key. If data is specified, it is
+        updated in place instead of being read and written. Returns True if
+        the data was changed. '''
+        commit = data is None
+        if commit:
+            data = self[key]
         existing, existing_pos = None, -1
         for i, a in enumerate(data['accounts']):
             if a['username'] == username:
@@ -260,11 +1104,13 @@ class PasswordDB:
                 break
         adata = {'username': username, 'password': password, 'notes': notes, 'autologin': autologin or False}
         if existing_pos == 0 and adata == existing:
-            return
+            return False
         accounts = [a for a in data['accounts'] if a is not existing]
         accounts.insert(0, adata)
         data['accounts'] = accounts
-        self[key] = data
+        if commit:
+            self[key] = data
+        return True
 
     def remove_account(self, key, username):
         data = self[key]
@@ -282,8 +1128,32 @@ class PasswordDB:
             del self[key]
 
     def change_password(self, new_password):
+        self.cache.clear()
         self.store.change_password(new_password)
 
+    def upgrade_kdf(self, password, kdf):
+        self.cache.clear()
+        self.store.upgrade_kdf(password, kdf)
+
+    def set_entry_version(self, version):
+        return self.store.set_entry_version(version)
+
+    def attachments(self, key):
+        return self.store.attachments(key)
+
+    def set_attachment(self, key, name, source):
+        self.store.set_attachment(key, name, source)
+
+    def remove_attachment(self, key, name):
+        self.store.remove_attachment(key, name)
+
+    def export_attachment(self, key, name, dest):
+        self.store.export_attachment(key, name, dest)
+
+    def lock(self):
+        ''' Wipe all decrypted data cached in memory '''
+        self.cache.clear()
+
 
 class DelayLoadedPasswordDB(PasswordDB):
 
@@ -291,6 +1161,7 @@ class DelayLoadedPasswordDB(PasswordDB):
         self.store = None
         self.error = (None, None)
         self.loader = None
+        self.cache = CredentialCache()
 
     def start_load(self, password, callback=None, pw_is_key=False):
         if self.loader is not None:
@@ -299,13 +1170,20 @@ class DelayLoadedPasswordDB(PasswordDB):
 
         def loadpw():
             try:
-                self.store = PasswordStore(password, pw_is_key=pw_is_key)
+                self.store = PasswordStore(password, pw_is_key=pw_is_key, summarize=usernames)
                 self.store.join()
             except Exception as e:
                 import traceback
                 self.error = (e, traceback.format_exc())
             if callback is not None:
                 callback(*self.error)
+            if self.error[0] is None:
+                # Completes an interrupted switch of the entry format.
+                # Entries are written atomically, so it is safe to interrupt
+                # the migration at exit
+                t = Thread(name='MigratePW', target=self.store.migrate_entries)
+                t.daemon = True
+                t.start()
         self.loader = t = Thread(name='LoadPW', target=loadpw)
         t.daemon = True
         t.start()
@@ -335,10 +1213,19 @@ password_db = DelayLoadedPasswordDB()
 
 def import_lastpass_db(path, db):
     import csv
+    accounts = {}
     with open(path, 'r') as f:
         for i, row in enumerate(csv.reader(f)):
             if not row or i == 0:
                 continue
             url, username, password, *_ = row
-            key = key_from_url(url)
-            db.add_account(key, username, password)
+            accounts.setdefault(key_from_url(url), []).append((username, password))
+    # Read the existing entries in parallel, then merge the imported accounts
+    with db.store.batch():
+        for key, data in db.store.get_many(accounts):
+            data = {'version': 1, 'accounts': []} if data is None else json.loads(data.decode('utf-8'))
+            changed = False
+            for username, password in accounts[key]:
+                changed = db.add_account(key, username, password, data=data) or changed
+            if changed:
+                db[key] = data
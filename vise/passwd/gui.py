@@ -17,25 +17,30 @@ from ..utils import Dialog, choose_files, BusyCursor
 from .db import PasswordDB, import_lastpass_db
 
 
+def sorted_entries(db):
+    # The entries come from the index, so no entries need to be decrypted
+    return sorted(((key, ' '.join([key] + (usernames or []))) for key, usernames in db.entries()), key=lambda x: x[0].lower())
+
+
 class KeysModel(QAbstractListModel):
 
     def __init__(self, db, parent=None):
-        self.keys = sorted(db, key=lambda x: x.lower())
+        self.entries = sorted_entries(db)
         QAbstractListModel.__init__(self, parent)
 
     def rowCount(self, parent=None):
-        return len(self.keys)
+        return len(self.entries)
 
     def data(self, index, role=Qt.DisplayRole):
-        if role == Qt.DisplayRole:
+        if role in (Qt.DisplayRole, Qt.UserRole):
             try:
-                return self.keys[index.row()]
+                return self.entries[index.row()][0 if role == Qt.DisplayRole else 1]
             except IndexError:
                 pass
 
     def refresh(self, db):
         self.beginResetModel()
-        self.keys = sorted(db, key=lambda x: x.lower())
+        self.entries = sorted_entries(db)
         self.endResetModel()
 
 
@@ -169,6 +174,8 @@ class PasswordManager(Dialog):
         self.model = KeysModel(self.db, self)
         self.proxy_model = pm = QSortFilterProxyModel(self)
         pm.setSourceModel(self.model), pm.setFilterCaseSensitivity(Qt.CaseInsensitive)
+        # Filter on usernames as well as keys
+        pm.setFilterRole(Qt.UserRole)
         self.view = v = QListView(self)
         v.setStyleSheet('QListView::item { padding: 5px }')
         v.setAlternatingRowColors(True)
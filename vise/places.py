@@ -4,16 +4,24 @@
 
 import os
 import re
+import json
 import math
+import sys
 import time
+import traceback
 import unicodedata
 from collections import OrderedDict, namedtuple
-from itertools import repeat
+from contextlib import contextmanager
 from enum import Enum, unique
+from itertools import repeat
+from queue import Queue, Empty
+from threading import Thread, Event, Lock, BoundedSemaphore
+from urllib.parse import urlparse
 
 import apsw
 from PyQt5.Qt import QWebEnginePage
 
+from .canonical_url import canonicalize, reset_tracking_parameters
 from .constants import config_dir
 from .resources import get_data
 
@@ -22,9 +30,34 @@ def now():
     return int(time.time() * 1e6)
 
 
+def url_host(url):
+    ''' The lower cased host of url, without any leading www., used for
+    completing hosts '''
+    try:
+        host = urlparse(url).hostname or ''
+    except ValueError:
+        return ''
+    return host[4:] if host.startswith('www.') else host
+
+
+def reversed_host(url):
+    ''' The reversed, lower cased host of url followed by a period, so that
+    a host and all its sub-domains share a prefix '''
+    try:
+        host = urlparse(url).hostname
+    except ValueError:
+        host = None
+    return host[::-1] + '.' if host else ''
+
+
 def normalize(x):
     return unicodedata.normalize('NFC', x)
 
+
+def place_url(qurl):
+    ''' The url under which a QUrl is stored in places '''
+    return canonicalize(normalize(qurl.toString()))[1]
+
 DAY = int(24 * 60 * 60 * 1e6)
 
 
@@ -40,6 +73,57 @@ class VisitType(Enum):
 FRECENCY_NUM_VISITS = 10
 VISIT_TYPE_WEIGHTS = {VisitType.link_clicked.value: 120, VisitType.typed.value: 200}
 RECENCY_WEIGHTS = [100, 70, 50, 30, 10]
+# Visits older than the last of these many days get the last recency weight
+RECENCY_BUCKET_DAYS = (4, 14, 31, 90)
+# Number of place ids re-aged per transaction
+REAGE_CHUNK_SIZE = 20000
+# Number of places scanned, renamed or merged per transaction when merging in bulk
+MERGE_CHUNK_SIZE = 5000
+
+SCHEMA_VERSION = 8
+# Let the WAL grow to about 4MB before it is checkpointed and truncate it
+# back to this size afterwards
+WAL_AUTOCHECKPOINT_PAGES = 1000
+WAL_SIZE_LIMIT = 4 * 1024 * 1024
+# Number of virtual machine instructions between checks for aborted reads
+PROGRESS_STEPS = 1000
+# Trigram tokenizer cannot match substrings shorter than this
+MIN_INDEXED_SUBSTRING = 3
+# Raw visits older than this many days are compacted into per day rollups.
+# Must be more than the last recency bucket, so that rolled up visits keep
+# their recency weight. Only the order of visits within a day is lost.
+ROLLUP_AFTER_DAYS = 120
+# Number of visits compacted per transaction
+ROLLUP_CHUNK_SIZE = 5000
+# Places not visited for this many days are moved to the archive, unless
+# overridden by the history_archive_days setting
+ARCHIVE_AFTER_DAYS = 400
+# Number of rows deleted and pages vacuumed per maintenance transaction
+MAINTENANCE_CHUNK_SIZE = 500
+# Maintenance only writes when nothing else has been written for this many seconds
+MAINTENANCE_IDLE_TIME = 2
+# Number of rows sampled per index when refreshing query planner statistics
+ANALYSIS_LIMIT = 1000
+# Number of visits in a page of history
+HISTORY_PAGE_SIZE = 100
+# History searches matching at most this many places read the visits of those
+# places, instead of scanning history by date for visits to them
+HISTORY_SEARCH_PLACES = 1000
+# Number of times a batch of writes is retried when the database is locked
+# for longer than the busy timeout, other than by a background job of places,
+# for which batches are retried until it finishes
+WRITE_RETRIES = 5
+# Seconds to wait for queued writes to be committed by flush()
+FLUSH_TIMEOUT = 30
+# The names of the jobs in pending_jobs, that of forgetting a host is
+# followed by the host
+URL_CLEANUP_JOB, FORGET_JOB = 'url_cleanup', 'forget:'
+# Seconds to wait for a background job to stop when places is closed
+JOB_STOP_TIMEOUT = 5
+# Databases created before incremental vacuuming was enabled are only
+# converted by a full VACUUM if they are smaller than this, as it locks the
+# database for as long as it takes
+AUTO_VACUUM_CONVERSION_LIMIT = 64 * 1024 * 1024
 
 MergeData = namedtuple('MergeData', 'visit_count typed last_visit_date frecency')
 
@@ -53,35 +137,597 @@ qt_visit_types = {
 }
 del from_qt
 
+SCHEMA_UPGRADES = {
+    2: '''
+CREATE VIRTUAL TABLE places_fts USING fts5(
+    url, title,
+    content='places', content_rowid='id', tokenize='trigram'
+);
+CREATE TRIGGER places_fts_insert_trg
+        AFTER INSERT ON places
+        BEGIN
+          INSERT INTO places_fts(rowid, url, title) VALUES (NEW.id, NEW.url, NEW.title);
+        END;
+CREATE TRIGGER places_fts_delete_trg
+        AFTER DELETE ON places
+        BEGIN
+          INSERT INTO places_fts(places_fts, rowid, url, title) VALUES ('delete', OLD.id, OLD.url, OLD.title);
+        END;
+CREATE TRIGGER places_fts_update_trg
+        AFTER UPDATE OF url, title ON places
+        BEGIN
+          INSERT INTO places_fts(places_fts, rowid, url, title) VALUES ('delete', OLD.id, OLD.url, OLD.title);
+          INSERT INTO places_fts(rowid, url, title) VALUES (NEW.id, NEW.url, NEW.title);
+        END;
+INSERT INTO places_fts(places_fts) VALUES ('rebuild');
+''',
+
+    # Only maintain the lower case columns when url/title actually change
+    3: '''
+DROP TRIGGER url_update_trg;
+DROP TRIGGER title_update_trg;
+CREATE TRIGGER url_update_trg
+        AFTER UPDATE OF url ON places WHEN NEW.url IS NOT OLD.url
+        BEGIN
+          UPDATE places SET url_lower=lower_case(NEW.url) WHERE id=NEW.id;
+        END;
+CREATE TRIGGER title_update_trg
+        AFTER UPDATE OF title ON places WHEN NEW.title IS NOT OLD.title
+        BEGIN
+          UPDATE places SET title_lower=lower_case(NEW.title) WHERE id=NEW.id;
+        END;
+''',
+
+    # Progress of history imports from other browsers, see history_import.py
+    4: '''
+CREATE TABLE imports(
+    id INTEGER PRIMARY KEY,
+    source TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    last_id INTEGER DEFAULT 0 NOT NULL,
+    UNIQUE(source)
+);
+''',
+
+    # Old visits are compacted into per day rollups
+    5: '''
+CREATE TABLE visit_rollups(
+    id INTEGER PRIMARY KEY,
+    place_id INTEGER NOT NULL,
+    day INTEGER NOT NULL,
+    type INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    UNIQUE(place_id, day, type),
+    FOREIGN KEY(place_id) REFERENCES places(id) ON DELETE CASCADE
+);
+''',
+
+    # Hosts of places, for inline completion and deleting sites
+    6: '''
+ALTER TABLE places ADD COLUMN host TEXT DEFAULT '' NOT NULL;
+ALTER TABLE places ADD COLUMN rev_host TEXT DEFAULT '' NOT NULL;
+UPDATE places SET host=url_host(url), rev_host=reversed_host(url);
+CREATE INDEX places_host ON places (host);
+CREATE INDEX places_rev_host ON places (rev_host);
+CREATE TABLE hosts(
+    id INTEGER PRIMARY KEY,
+    host TEXT NOT NULL,
+    frecency INTEGER DEFAULT 0 NOT NULL,
+    UNIQUE(host)
+);
+INSERT INTO hosts (host, frecency) SELECT host, SUM(MAX(frecency, 0)) FROM places WHERE host != '' GROUP BY host;
+CREATE TRIGGER host_insert_trg
+        AFTER INSERT ON places
+        BEGIN
+          UPDATE places SET host=url_host(NEW.url), rev_host=reversed_host(NEW.url) WHERE id=NEW.id;
+        END;
+CREATE TRIGGER host_update_trg
+        AFTER UPDATE OF url ON places WHEN NEW.url IS NOT OLD.url
+        BEGIN
+          UPDATE places SET host=url_host(NEW.url), rev_host=reversed_host(NEW.url) WHERE id=NEW.id;
+        END;
+CREATE TRIGGER hosts_update_trg
+        AFTER UPDATE OF host, frecency ON places WHEN NEW.host IS NOT OLD.host OR NEW.frecency IS NOT OLD.frecency
+        BEGIN
+          UPDATE hosts SET frecency = frecency - MAX(OLD.frecency, 0) WHERE host=OLD.host;
+          INSERT INTO hosts (host, frecency) SELECT NEW.host, MAX(NEW.frecency, 0) WHERE NEW.host != ''
+            ON CONFLICT(host) DO UPDATE SET frecency = frecency + excluded.frecency;
+        END;
+CREATE TRIGGER hosts_delete_trg
+        AFTER DELETE ON places
+        BEGIN
+          UPDATE hosts SET frecency = frecency - MAX(OLD.frecency, 0) WHERE host=OLD.host;
+        END;
+''',
+
+    # Paging through rolled up history by day
+    7: '''
+CREATE INDEX visit_rollups_day ON visit_rollups (day);
+''',
+
+    # Jobs run once by maintenance, such as rewriting the urls of existing
+    # places in canonical form
+    8: '''
+CREATE TABLE pending_jobs(
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    UNIQUE(name)
+);
+INSERT INTO pending_jobs (name) VALUES ('url_cleanup');
+''',
+}
+
+# Places not visited for a long time, along with their visit rollups, are
+# moved to this database, attached to every connection as archive
+ARCHIVE_SCHEMA = '''
+CREATE TABLE archive.places (
+    id INTEGER PRIMARY KEY,
+    url TEXT NOT NULL,
+    url_lower TEXT NOT NULL,
+    title TEXT NOT NULL,
+    title_lower TEXT NOT NULL,
+    visit_count INTEGER DEFAULT 0 NOT NULL,
+    typed INTEGER DEFAULT 0 NOT NULL,
+    last_visit_date INTEGER DEFAULT 0 NOT NULL,
+    frecency INTEGER DEFAULT -1 NOT NULL,
+    UNIQUE(url)
+);
+CREATE INDEX archive.places_frecency ON places (frecency);
+CREATE TABLE archive.visit_rollups (
+    id INTEGER PRIMARY KEY,
+    place_id INTEGER NOT NULL,
+    day INTEGER NOT NULL,
+    type INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    UNIQUE(place_id, day, type),
+    FOREIGN KEY(place_id) REFERENCES places(id) ON DELETE CASCADE
+);
+PRAGMA archive.user_version = 1;
+'''
+
+ARCHIVE_SCHEMA_VERSION = 2
+ARCHIVE_UPGRADES = {
+    # The places of main moved to the archive, see ARCHIVE_SQL
+    2: '''
+CREATE TABLE archive.moves (
+    place_id INTEGER PRIMARY KEY,
+    url TEXT NOT NULL
+);
+''',
+}
+
+
+def reage_sql():
+    ''' The frecency algorithm of Places.calculate_frecency() as a single
+    statement operating on the places with ids between :first and :last '''
+    type_weight = 'CASE type %s END' % ' '.join(
+        'WHEN %d THEN %r' % (vtype, weight / 100) for vtype, weight in sorted(VISIT_TYPE_WEIGHTS.items()))
+    recency_weight = 'CASE %s ELSE %d END' % (' '.join(
+        'WHEN ABS(:now - visit_date) / %d <= %d THEN %d' % (DAY, max_days, weight)
+        for max_days, weight in zip(RECENCY_BUCKET_DAYS, RECENCY_WEIGHTS)), RECENCY_WEIGHTS[-1])
+    return '''
+WITH recent AS (
+    SELECT place_id, visit_date, type, count,
+        SUM(count) OVER (PARTITION BY place_id ORDER BY visit_date DESC, type ROWS UNBOUNDED PRECEDING) AS n
+    FROM (
+        SELECT place_id, visit_date, type, 1 AS count FROM visits WHERE place_id BETWEEN :first AND :last
+        UNION ALL
+        SELECT place_id, day * {day}, type, count FROM visit_rollups WHERE place_id BETWEEN :first AND :last
+    )
+), weights AS (
+    SELECT place_id, SUM(weight * num) AS total, SUM(num * (weight IS NOT NULL)) AS num FROM (
+        SELECT place_id, ({type_weight}) * ({recency_weight}) AS weight, MIN(count, {num_visits} - (n - count)) AS num
+        FROM recent WHERE n - count < {num_visits}
+    ) GROUP BY place_id
+), scores AS (
+    SELECT places.id AS id, places.visit_count * weights.total / weights.num AS score FROM weights JOIN places ON places.id = weights.place_id
+), frecencies AS (
+    SELECT id, COALESCE(CAST(score AS INTEGER) + (score > CAST(score AS INTEGER)), 0) AS frecency FROM scores
+)
+UPDATE places SET frecency = frecencies.frecency FROM frecencies WHERE places.id = frecencies.id AND places.frecency != frecencies.frecency
+'''.format(type_weight=type_weight, recency_weight=recency_weight, num_visits=FRECENCY_NUM_VISITS, day=DAY)
+
+
+# Temporary table of places to merge into other places, processed by MERGE_SQL
+CREATE_MERGES_SQL = 'CREATE TEMP TABLE merges (id INTEGER PRIMARY KEY, src INTEGER UNIQUE NOT NULL, dest INTEGER NOT NULL)'
+
+# Places in temp.url_changes whose new url is the url of a place that is not
+# changing are merged into that place
+MERGE_INTO_UNCHANGED_SQL = (
+    'INSERT OR IGNORE INTO temp.merges (src, dest) SELECT ch.place_id, p.id FROM temp.url_changes ch JOIN places p ON p.url = ch.url'
+    ' WHERE p.id NOT IN (SELECT place_id FROM temp.url_changes)')
+
+# Merge the places in temp.merges with ids between :first and :last into their
+# destinations, frecency has to be recomputed afterwards
+MERGE_SQL = '''
+UPDATE places SET visit_count = places.visit_count + m.visit_count, typed = MAX(places.typed, m.typed),
+    last_visit_date = MAX(places.last_visit_date, m.last_visit_date)
+FROM (
+    SELECT merges.dest AS dest, SUM(p.visit_count) AS visit_count, MAX(p.typed) AS typed, MAX(p.last_visit_date) AS last_visit_date
+    FROM temp.merges JOIN places p ON p.id = merges.src WHERE merges.id BETWEEN :first AND :last GROUP BY merges.dest
+) AS m WHERE places.id = m.dest;
+UPDATE visits SET place_id = merges.dest FROM temp.merges WHERE visits.place_id = merges.src AND merges.id BETWEEN :first AND :last;
+INSERT INTO visit_rollups (place_id, day, type, count)
+    SELECT merges.dest, r.day, r.type, r.count FROM visit_rollups r JOIN temp.merges ON merges.src = r.place_id WHERE merges.id BETWEEN :first AND :last
+    ON CONFLICT (place_id, day, type) DO UPDATE SET count = count + excluded.count;
+DELETE FROM places WHERE id IN (SELECT src FROM temp.merges WHERE id BETWEEN :first AND :last);
+'''
+
+
+# Compact the visits matching {where} into rollups
+ROLLUP_SQL = '''
+INSERT INTO visit_rollups (place_id, day, type, count)
+    SELECT place_id, visit_date / {day}, type, COUNT(*) FROM visits WHERE {{where}} GROUP BY place_id, visit_date / {day}, type
+    ON CONFLICT (place_id, day, type) DO UPDATE SET count = count + excluded.count;
+DELETE FROM visits WHERE {{where}};
+'''.format(day=DAY)
+
+# Move the places in temp.archiving, whose visits must have been rolled up,
+# to the archive. Places already in the archive are merged. Since
+# transactions are not atomic across databases in WAL mode, a crash can leave
+# a place in both databases. The places that were moved are recorded in
+# archive.moves, in the same transaction as the move, so that such places
+# are only deleted from main when archived again, not merged a second time.
+ARCHIVE_SQL = '''
+DELETE FROM temp.archiving_moved;
+INSERT INTO temp.archiving_moved SELECT m.place_id FROM archive.moves m JOIN main.places p ON p.id = m.place_id AND p.url = m.url
+    WHERE m.place_id IN (SELECT id FROM temp.archiving);
+INSERT INTO archive.places (url, url_lower, title, title_lower, visit_count, typed, last_visit_date, frecency)
+    SELECT url, url_lower, title, title_lower, visit_count, typed, last_visit_date, frecency FROM main.places
+    WHERE id IN (SELECT id FROM temp.archiving) AND id NOT IN (SELECT id FROM temp.archiving_moved)
+    ON CONFLICT (url) DO UPDATE SET title = excluded.title, title_lower = excluded.title_lower, visit_count = visit_count + excluded.visit_count,
+    typed = MAX(typed, excluded.typed), last_visit_date = MAX(last_visit_date, excluded.last_visit_date), frecency = excluded.frecency;
+INSERT INTO archive.visit_rollups (place_id, day, type, count)
+    SELECT a.id, r.day, r.type, r.count FROM main.visit_rollups r JOIN main.places p ON p.id = r.place_id JOIN archive.places a ON a.url = p.url
+    WHERE r.place_id IN (SELECT id FROM temp.archiving) AND r.place_id NOT IN (SELECT id FROM temp.archiving_moved)
+    ON CONFLICT (place_id, day, type) DO UPDATE SET count = count + excluded.count;
+INSERT OR REPLACE INTO archive.moves (place_id, url) SELECT id, url FROM main.places WHERE id IN (SELECT id FROM temp.archiving);
+DELETE FROM main.places WHERE id IN (SELECT id FROM temp.archiving);
+'''
+
+# The most recent visits of a place, with the visits in rollups counted
+# as count visits on that day
+RECENT_VISITS_SQL = (
+    'SELECT visit_date, type, 1 FROM visits WHERE place_id=? UNION ALL'
+    ' SELECT day * %d, type, count FROM visit_rollups WHERE place_id=? ORDER BY 1 DESC, 2 LIMIT ?' % DAY)
+
+
+# A page of history before or after a position. Visits and rollups are
+# ordered by (date, kind, id), kind being 1 for visits and 0 for rollups,
+# whose date is the start of their day. Each part is a range scan of an
+# index on date, see Places.history(). When searching for a few places, the
+# visits and rollups of those places are looked up using their place_id
+# indices instead, with {places} the JSON array of their ids.
+HISTORY_SQL = '''
+SELECT h.visit_date, h.kind, h.id, p.id, p.url, p.title, h.count FROM (
+    SELECT * FROM (
+        SELECT visits.visit_date, 1 AS kind, visits.id, visits.place_id, 1 AS count FROM {visits}
+        WHERE (visits.visit_date, visits.id) {op} (:date, :visit_id) {where} ORDER BY visits.visit_date {order}, visits.id {order} LIMIT :limit)
+    UNION ALL
+    SELECT * FROM (
+        SELECT visit_rollups.day * {day} AS visit_date, 0 AS kind, visit_rollups.id, visit_rollups.place_id, visit_rollups.count FROM {rollups}
+        WHERE (visit_rollups.day, visit_rollups.id) {op} (:day, :rollup_id) {where}
+        ORDER BY visit_rollups.day {order}, visit_rollups.id {order} LIMIT :limit)
+) h JOIN places p ON p.id = h.place_id ORDER BY h.visit_date {order}, h.kind {order}, h.id {order} LIMIT :limit
+'''
+
+
+def like_expression(x):
+    return '%' + re.sub(r'([|%_])', r'|\1', x.lower()) + '%'
+
+
+def fts_expression(substrings):
+    return ' AND '.join('"%s"' % x.replace('"', '""') for x in substrings)
+
+
+def substring_clauses(substrings):
+    ''' Return the clauses and parameters selecting the places whose url or
+    title contain all the substrings '''
+    # Substrings long enough to be looked up in the trigram index narrow
+    # down the candidates, shorter ones are filtered with LIKE
+    indexed = tuple(x for x in substrings if len(x) >= MIN_INDEXED_SUBSTRING)
+    like_expressions = tuple(like_expression(x) for x in substrings if len(x) < MIN_INDEXED_SUBSTRING)
+    clauses = ['(url_lower LIKE ? ESCAPE "|" OR title_lower LIKE ? ESCAPE "|")'] * len(like_expressions)
+    params = [x for x in like_expressions for y in (0, 1)]
+    if indexed:
+        clauses.insert(0, 'id IN (SELECT rowid FROM places_fts WHERE places_fts MATCH ?)')
+        params.insert(0, fts_expression(indexed))
+    return clauses, params
+
+
+class Writer(Thread):
+
+    ''' Applies the queued writes to places in a single transaction per batch,
+    on a connection owned by this thread. '''
+
+    def __init__(self, places, batch_interval):
+        Thread.__init__(self, name='PlacesWriter')
+        self.daemon = True
+        self.places = places
+        self.batch_interval = batch_interval
+        self.queue = Queue()
+        self.last_write = 0
+
+    def __call__(self, name, *args):
+        self.queue.put((name, args))
+
+    def flush(self, timeout=FLUSH_TIMEOUT):
+        ''' Wait for the queued writes to be committed. Returns False if that
+        did not happen within timeout seconds. '''
+        if not self.is_alive():
+            return False
+        done = Event()
+        self.queue.put(done)
+        return done.wait(timeout)
+
+    def shutdown(self, timeout=FLUSH_TIMEOUT):
+        self.queue.put(None)
+        self.join(timeout)
+
+    def run(self):
+        conn = self.places.open_connection()
+        try:
+            keep_going, events, waiters, retries = True, [], [], 0
+            while keep_going or events:
+                try:
+                    # Events from a batch that could not be committed are
+                    # retried first, with the events queued since
+                    if keep_going:
+                        keep_going = self.collect(events, waiters)
+                    if events:
+                        self.apply(conn, events)
+                    events, retries = [], 0
+                except apsw.BusyError:
+                    if not self.places.job_running:
+                        retries += 1
+                    if retries > WRITE_RETRIES:
+                        print('Dropping %d changes to places as the database is locked' % len(events), file=sys.stderr)
+                        traceback.print_exc()
+                        events, retries = [], 0
+                except Exception:
+                    print('Dropping %d changes to places as they could not be committed' % len(events), file=sys.stderr)
+                    traceback.print_exc()
+                    events, retries = [], 0
+                finally:
+                    # Waiters are woken once their events have been committed
+                    # or dropped, never left waiting
+                    if not events:
+                        for w in waiters:
+                            w.set()
+                        del waiters[:]
+        finally:
+            conn.close()
+
+    def collect(self, events, waiters):
+        # Do not wait for new events when there are events to retry
+        try:
+            item = self.queue.get(timeout=self.batch_interval if events else None)
+        except Empty:
+            return True
+        deadline = time.monotonic() + self.batch_interval
+        while True:
+            if item is None:
+                return False
+            if isinstance(item, Event):
+                waiters.append(item)
+                return True
+            events.append(item)
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                return True
+            try:
+                item = self.queue.get(timeout=timeout)
+            except Empty:
+                return True
+
+    def apply(self, conn, events):
+        # Only the last title change for a URL in a batch matters
+        last_title = {args[0]: i for i, (name, args) in enumerate(events) if name == 'title'}
+        with conn:
+            c = conn.cursor()
+            for i, (name, args) in enumerate(events):
+                if name == 'title' and last_title[args[0]] != i:
+                    continue
+                try:
+                    with conn:
+                        getattr(self.places, 'record_' + name)(c, *args)
+                except apsw.BusyError:
+                    # The whole batch is retried
+                    raise
+                except Exception:
+                    # An event that cannot be applied, do not lose the rest
+                    # of the batch because of it
+                    traceback.print_exc()
+        self.last_write = time.monotonic()
+        self.places.invalidate_caches()
+
+
+class ReaderPool:
+
+    ''' A bounded pool of read-only connections. Since places.sqlite is in WAL
+    mode, these never block, or are blocked by, the writer. '''
+
+    def __init__(self, places, size):
+        self.places = places
+        self.idle = []
+        self.lock = Lock()
+        self.slots = BoundedSemaphore(size)
+
+    @contextmanager
+    def __call__(self):
+        with self.slots:
+            with self.lock:
+                conn = self.idle.pop() if self.idle else None
+            if conn is None:
+                conn = self.places.open_connection(readonly=True)
+            try:
+                yield conn
+            finally:
+                with self.lock:
+                    self.idle.append(conn)
+
+    def close(self):
+        with self.lock:
+            for conn in self.idle:
+                conn.close()
+            del self.idle[:]
+
+
+class RefinementCache:
+
+    ''' An LRU cache of substring_matches() results. A query that refines a
+    cached query, that is every cached substring is contained in one of its
+    substrings, can be answered by filtering the cached rows, as long as the
+    cached rows were not truncated by the limit. '''
+
+    def __init__(self, size=32):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = Lock()
+        self.generation = 0
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.entries.clear()
+
+    def get(self, substrings, limit):
+        lowered = tuple(x.lower() for x in substrings)
+        with self.lock:
+            generation = self.generation
+            climit, rows = self.entries.get(substrings, (None, None))
+            if climit == limit:
+                self.entries.move_to_end(substrings)
+                return rows
+            for key, (climit, crows) in reversed(self.entries.items()):
+                if climit == limit and all(any(q.lower() in x for x in lowered) for q in key):
+                    rows = [r for r in crows if all(x in r[1].lower() or x in r[2].lower() for x in lowered)]
+                    # A truncated result set is only usable if nothing was
+                    # filtered out of it
+                    if len(crows) < limit or len(rows) == limit:
+                        break
+            else:
+                return
+        self.set(substrings, limit, rows, generation)
+        return rows
+
+    def set(self, substrings, limit, rows, generation):
+        with self.lock:
+            if generation == self.generation:
+                self.entries[substrings] = limit, rows
+                self.entries.move_to_end(substrings)
+                while len(self.entries) > self.size:
+                    self.entries.popitem(last=False)
+
 
 class Places:
 
     path = os.path.join(config_dir, 'places.sqlite')
+    # Seconds for which the writer collects changes before committing them
+    write_batch_interval = 0.5
+    num_readers = 3
 
     def __init__(self, path=None):
         self._conn = None
+        self._writer = None
+        self._readers = None
+        self._job = None
+        self._stop_jobs = Event()
+        self.completion_cache = RefinementCache()
         if path:
             self.path = path
 
+    @property
+    def archive_path(self):
+        return os.path.splitext(self.path)[0] + '-archive.sqlite'
+
+    def open_connection(self, readonly=False):
+        if readonly:
+            conn = apsw.Connection(self.path, flags=apsw.SQLITE_OPEN_READONLY)
+            conn.setbusytimeout(5000)
+            conn.cursor().execute('ATTACH DATABASE ? AS archive', (self.archive_path,))
+            return conn
+        conn = apsw.Connection(self.path)
+        conn.setbusytimeout(5000)
+        conn.createscalarfunction('lower_case', lambda x: x.lower(), 1)
+        conn.createscalarfunction('url_host', url_host, 1)
+        conn.createscalarfunction('reversed_host', reversed_host, 1)
+        c = conn.cursor()
+        c.execute('PRAGMA foreign_keys = ON')
+        c.execute('ATTACH DATABASE ? AS archive', (self.archive_path,))
+        # Takes effect for new databases, existing ones are converted by
+        # vacuum() in the background
+        c.execute('PRAGMA main.auto_vacuum = INCREMENTAL')
+        c.execute('PRAGMA archive.auto_vacuum = INCREMENTAL')
+        # Applies to all attached databases
+        c.execute('PRAGMA journal_mode = WAL')
+        # Commits in WAL mode only need to be synced at checkpoints
+        c.execute('PRAGMA synchronous = NORMAL')
+        c.execute('PRAGMA wal_autocheckpoint = %d' % WAL_AUTOCHECKPOINT_PAGES)
+        c.execute('PRAGMA journal_size_limit = %d' % WAL_SIZE_LIMIT)
+        uv = next(c.execute('PRAGMA user_version'))[0]
+        if uv == 0:
+            c.execute(get_data('places.sqlite').decode('utf-8'))
+        elif uv < SCHEMA_VERSION:
+            self.upgrade_schema(conn, uv)
+        av = next(c.execute('PRAGMA archive.user_version'))[0]
+        if av == 0:
+            c.execute(ARCHIVE_SCHEMA)
+            av = 1
+        for version in range(av + 1, ARCHIVE_SCHEMA_VERSION + 1):
+            with conn:
+                c.execute(ARCHIVE_UPGRADES[version])
+                c.execute('PRAGMA archive.user_version=%d' % version)
+        c.close()
+        return conn
+
     @property
     def conn(self):
         if self._conn is None:
-            self._conn = apsw.Connection(self.path)
-            self._conn.createscalarfunction('lower_case', lambda x: x.lower(), 1)
-            c = self._conn.cursor()
-            c.execute('PRAGMA foreign_keys = ON')
-            uv = next(c.execute('PRAGMA user_version'))[0]
-            if uv == 0:
-                c.execute(get_data('places.sqlite').decode('utf-8'))
-            c.close()
+            self._conn = self.open_connection()
         return self._conn
 
+    @property
+    def writer(self):
+        if self._writer is None:
+            self.conn  # ensure the schema exists before the writer thread connects
+            self._writer = Writer(self, self.write_batch_interval)
+            self._writer.start()
+        return self._writer
+
+    @property
+    def reader(self):
+        ''' Context manager that provides a read-only connection, for use from
+        any thread. Usage: with places.reader() as conn: ... '''
+        if self._readers is None:
+            self.conn  # ensure the schema exists and the database is in WAL mode
+            self._readers = ReaderPool(self, self.num_readers)
+        return self._readers
+
+    def invalidate_caches(self):
+        ' Must be called after every committed write '
+        self.completion_cache.clear()
+
+    def flush(self, timeout=FLUSH_TIMEOUT):
+        ''' Wait for all queued writes to be committed, returns False if that
+        did not happen within timeout seconds '''
+        if self._writer is not None:
+            return self._writer.flush(timeout)
+        return True
+
+    def upgrade_schema(self, conn, current_version):
+        with conn:
+            cursor = conn.cursor()
+            for version in range(current_version + 1, SCHEMA_VERSION + 1):
+                cursor.execute(SCHEMA_UPGRADES[version])
+                cursor.execute('PRAGMA user_version=%d' % version)
+
     def insert(self, table, cursor=None, **kw):
         cursor = cursor or self.conn.cursor()
         values = ('?,' * len(kw)).rstrip(',')
         kw = OrderedDict(kw.items())
         cursor.execute('INSERT INTO %s (%s) VALUES (%s)' % (table, ','.join(kw), values), tuple(kw.values()))
-        return self.conn.last_insert_rowid()
+        return cursor.getconnection().last_insert_rowid()
 
     def on_visit(self, qurl, visit_type, is_main_frame):
         if not is_main_frame:
@@ -89,245 +735,847 @@ class Places:
         visit_type = qt_visit_types[visit_type]
         if not VISIT_TYPE_WEIGHTS.get(visit_type.value, 0):
             return
-        url = normalize(qurl.toString())
-        timestamp = now()
-        with self.conn:
-            c = self.conn.cursor()
-            try:
-                place_id, visit_count, typed = next(c.execute('SELECT id, visit_count, typed FROM places WHERE url=?', (url,)))
-                typed = bool(typed)
-            except StopIteration:
-                typed = visit_type is VisitType.typed
-                place_id = self.insert('places', cursor=c, url=url, typed=int(typed))
-                visit_count = 0
-            typed = typed or visit_type is VisitType.typed
-            self.insert('visits', cursor=c, place_id=place_id, visit_date=timestamp, type=visit_type.value)
-            frecency = self.calculate_frecency(place_id, visit_count, cursor=c)
-            c.execute('UPDATE places SET visit_count = ?, last_visit_date = ?, typed = ?, frecency = ? WHERE id=?', (
-                visit_count + 1, timestamp, typed, frecency, place_id))
-
-    def merge_places(self, src_place_id, dest_place_id):
+        self.writer('visit', place_url(qurl), visit_type, now())
+
+    def record_visit(self, c, url, visit_type, timestamp):
+        try:
+            place_id, visit_count, typed = next(c.execute('SELECT id, visit_count, typed FROM places WHERE url=?', (url,)))
+            typed = bool(typed)
+        except StopIteration:
+            typed = visit_type is VisitType.typed
+            place_id = self.insert('places', cursor=c, url=url, typed=int(typed))
+            visit_count = 0
+        typed = typed or visit_type is VisitType.typed
+        self.insert('visits', cursor=c, place_id=place_id, visit_date=timestamp, type=visit_type.value)
+        frecency = self.calculate_frecency(place_id, visit_count, cursor=c)
+        c.execute('UPDATE places SET visit_count = ?, last_visit_date = ?, typed = ?, frecency = ? WHERE id=?', (
+            visit_count + 1, timestamp, typed, frecency, place_id))
+
+    def merge_places(self, src_place_id, dest_place_id, cursor=None):
         ' Merge src onto dest and delete src '
-        c = self.conn.cursor()
+        c = cursor or self.conn.cursor()
 
         def data(place_id):
             return MergeData(*next(c.execute('SELECT visit_count, typed, last_visit_date, frecency FROM places WHERE id=?', (place_id,))))
         src, dest = data(src_place_id), data(dest_place_id)
         c.execute('UPDATE visits SET place_id=? WHERE place_id=?', (dest_place_id, src_place_id))
+        c.execute(
+            'INSERT INTO visit_rollups (place_id, day, type, count) SELECT ?, day, type, count FROM visit_rollups WHERE place_id=?'
+            ' ON CONFLICT (place_id, day, type) DO UPDATE SET count = count + excluded.count', (dest_place_id, src_place_id))
         visit_count = src.visit_count + dest.visit_count
-        frecency = self.calculate_frecency(dest_place_id, visit_count)
+        frecency = self.calculate_frecency(dest_place_id, visit_count, cursor=c)
         c.execute('UPDATE places SET visit_count = ?, last_visit_date = ?, typed = ?, frecency = ? WHERE id=?', (
             visit_count, max(src.last_visit_date, dest.last_visit_date), src.typed or dest.typed, frecency, dest_place_id))
         c.execute('DELETE FROM places WHERE id=?', (src_place_id,))
 
-    def merge_https_places(self, http_qurl=None):
-        ' Merge the specified http place into the corresponding https place, if available '
-        with self.conn:
-            c = self.conn.cursor()
+    def merge_https_places(self, http_qurl=None, report=print, stop=None, reage=True):
+        ''' Merge the specified http place into the corresponding https place,
+        if available. If no place is specified, merge every http place that
+        has an https twin, on a separate connection, in chunks, so that it can
+        run in a background thread, see start_url_cleanup(). '''
+        if http_qurl is not None:
+            self.writer('https_merge', place_url(http_qurl))
+            return
+        conn = self.open_connection()
+        try:
+            c = conn.cursor()
+            c.execute(CREATE_MERGES_SQL)
+            # The range restriction on url is used to search the url index
+            c.execute(
+                'INSERT INTO temp.merges (src, dest) SELECT h.id, s.id FROM places h JOIN places s ON s.url = "https" || substr(h.url, 5)'
+                ' WHERE h.url >= "http:" AND h.url < "http;"')
+            return self.merge_in_bulk(conn, report, stop, reage)
+        finally:
+            conn.close()
 
-            def place_id_for(url):
-                try:
-                    return next(c.execute('SELECT id FROM places WHERE url=?', (url,)))[0]
-                except StopIteration:
-                    pass
-
-            pairs = {}
-            if http_qurl is None:
-                # Go over all http urls in db
-                for place_id, url in c.execute('SELECT id, url FROM places'):
-                    if url.startswith('http:'):
-                        pairs[place_id] = 'https' + url[4:]
-            else:
-                url = normalize(http_qurl.toString())
-                place_id = place_id_for(url)
-                if place_id is None:
-                    return
-                pairs[place_id] = 'https' + url[4:]
-
-            mergers = {}
-            for place_id, surl in pairs.items():
-                splace_id = place_id_for(surl)
-                if splace_id is not None:
-                    mergers[place_id] = splace_id
-            for place_id, splace_id in mergers.items():
-                self.merge_places(place_id, splace_id)
-
-    def transform_urls(self, transform_func=None):
+    def record_https_merge(self, c, url):
+        ids = dict(c.execute('SELECT url, id FROM places WHERE url IN (?, ?)', (url, 'https' + url[4:])))
+        if len(ids) == 2:
+            self.merge_places(ids[url], ids['https' + url[4:]], cursor=c)
+
+    def merge_in_bulk(self, conn, report=print, stop=None, reage=True):
+        ''' Merge every place in temp.merges into its destination, in chunks,
+        then recompute frecency once, unless reage is False, for callers that
+        recompute it themselves. Returns the number of merged places. '''
+        stop = stop or Event()
+        c = conn.cursor()
+        total = next(c.execute('SELECT COUNT(*) FROM temp.merges'))[0]
+        for first in range(1, total + 1, MERGE_CHUNK_SIZE):
+            if not self.wait_for_idle(stop):
+                break
+            with conn:
+                c.execute(MERGE_SQL, {'first': first, 'last': first + MERGE_CHUNK_SIZE - 1})
+            self.invalidate_caches()
+            if report is not None:
+                report('Merged %d of %d places' % (min(total, first + MERGE_CHUNK_SIZE - 1), total))
+        c.execute('DROP TABLE temp.merges')
+        if total and reage:
+            self.reage_frecency(report=report, stop=stop)
+        return total
+
+    def transform_urls(self, transform_func=None, report=print, stop=None, reage=True):
+        ''' Change the url of every place to the url returned by
+        transform_func, by default the URL substitution rules. Places whose
+        new url already exists are merged into the existing place. Uses its
+        own connection and works in chunks, so it can run in a background
+        thread, see start_url_cleanup(). '''
         if transform_func is None:
             from .url_substitution import substitute as transform_func
-        with self.conn:
-            c = self.conn.cursor()
-            changes = {}
-            url_map = {}
-            for place_id, url in c.execute('SELECT id, url FROM places'):
-                url_map[url] = place_id
-                changed, nurl = transform_func(url)
-                if changed:
-                    changes[place_id] = nurl
-            if changes:
-                merge, other = {}, {}
-                for place_id, nurl in changes.items():
-                    nplace_id = url_map.get(nurl)
-                    if nplace_id is None:
-                        other[place_id] = nurl
-                    else:
-                        merge[place_id] = nplace_id
-
-                if other:
-                    c.executemany('UPDATE places SET url=? WHERE id=?', [
-                        (url, place_id) for place_id, url in other.items()])
-                for src, dest in merge.items():
-                    self.merge_places(src, dest)
+        stop = stop or Event()
+        conn = self.open_connection()
+        try:
+            c = conn.cursor()
+            c.execute('CREATE TEMP TABLE url_changes (place_id INTEGER PRIMARY KEY, url TEXT NOT NULL); CREATE INDEX temp.url_changes_url ON url_changes (url)')
+            last_id = scanned = 0
+            while not stop.is_set():
+                rows = c.execute('SELECT id, url FROM places WHERE id > ? ORDER BY id LIMIT ?', (last_id, MERGE_CHUNK_SIZE)).fetchall()
+                if not rows:
+                    break
+                last_id, scanned = rows[-1][0], scanned + len(rows)
+                changes = []
+                for place_id, url in rows:
+                    changed, nurl = transform_func(url)
+                    if changed and nurl != url:
+                        changes.append((place_id, nurl))
+                with conn:
+                    c.executemany('INSERT INTO temp.url_changes (place_id, url) VALUES (?, ?)', changes)
+                if report is not None:
+                    report('Transformed %d places' % scanned)
+            if stop.is_set():
+                return 0
+            c.execute(CREATE_MERGES_SQL)
+            # Places that change to the url of a place that is not changing
+            # are merged into it
+            c.execute(MERGE_INTO_UNCHANGED_SQL)
+            # Of the places that change to the same new url, the first is
+            # renamed and the rest are merged into it
+            c.execute(
+                'INSERT INTO temp.merges (src, dest) SELECT ch.place_id, k.place_id FROM temp.url_changes ch JOIN'
+                ' (SELECT url, MIN(place_id) AS place_id FROM temp.url_changes WHERE url NOT IN'
+                ' (SELECT url FROM places WHERE id NOT IN (SELECT place_id FROM temp.url_changes)) GROUP BY url) k'
+                ' ON k.url = ch.url WHERE ch.place_id != k.place_id')
+            c.execute('DELETE FROM temp.url_changes WHERE place_id IN (SELECT src FROM temp.merges)')
+            # The new urls are now unique, but may still be in use by places
+            # that are changing, so rename in passes, each renaming the
+            # places whose new url has been vacated by the previous pass
+            renamed = skipped = 0
+            while True:
+                ids = [x for x, in c.execute('SELECT place_id FROM temp.url_changes ORDER BY place_id')]
+                before = renamed
+                for i in range(0, len(ids), MERGE_CHUNK_SIZE):
+                    if not self.wait_for_idle(stop):
+                        break
+                    chunk = ids[i:i + MERGE_CHUNK_SIZE]
+                    with conn:
+                        c.execute(
+                            'UPDATE OR IGNORE places SET url = ch.url FROM temp.url_changes ch WHERE places.id = ch.place_id AND ch.place_id BETWEEN ? AND ?',
+                            (chunk[0], chunk[-1]))
+                        renamed += conn.changes()
+                    self.invalidate_caches()
+                c.execute('DELETE FROM temp.url_changes WHERE place_id IN (SELECT ch.place_id FROM temp.url_changes ch JOIN places p ON p.id = ch.place_id'
+                          ' WHERE p.url = ch.url) OR place_id NOT IN (SELECT id FROM places)')
+                if stop.is_set() or renamed == before:
+                    break
+            if not stop.is_set() and self.wait_for_idle(stop):
+                # What remains are places whose urls are swapped in a cycle
+                # and places whose new url was taken after the scan
+                remaining = next(c.execute('SELECT COUNT(*) FROM temp.url_changes'))[0]
+                if remaining:
+                    try:
+                        with conn:
+                            c.execute(MERGE_INTO_UNCHANGED_SQL)
+                            c.execute('DELETE FROM temp.url_changes WHERE place_id IN (SELECT src FROM temp.merges)')
+                            c.execute('UPDATE places SET url = "vise-rename:" || id WHERE id IN (SELECT place_id FROM temp.url_changes)')
+                            c.execute('UPDATE places SET url = ch.url FROM temp.url_changes ch WHERE places.id = ch.place_id')
+                            renamed += conn.changes()
+                    except apsw.ConstraintError:
+                        skipped = remaining
+                    self.invalidate_caches()
+            c.execute('DROP TABLE temp.url_changes')
+            merged = self.merge_in_bulk(conn, report, stop, reage)
+            if report is not None:
+                report('Changed the url of %d places and merged %d places' % (renamed, merged))
+                if skipped:
+                    report('Could not change the url of %d places as their new urls are in use' % skipped)
+            return renamed + merged
+        finally:
+            conn.close()
+
+    def canonicalize_urls(self, report=print, stop=None, reage=True):
+        ''' Change the url of every place to its canonical form, see
+        canonicalize(), merging the variants of a url. Reports the number of
+        rows and bytes saved. '''
+        conn = self.open_connection()
+        try:
+            c = conn.cursor()
+
+            def size():
+                # Free pages are returned to the filesystem by maintain()
+                pages = next(c.execute('PRAGMA page_count'))[0] - next(c.execute('PRAGMA freelist_count'))[0]
+                return next(c.execute('SELECT COUNT(*) FROM places'))[0], pages * next(c.execute('PRAGMA page_size'))[0]
+            before = size()
+            changed = self.transform_urls(canonicalize, report=report, stop=stop, reage=reage)
+            if report is not None:
+                after = size()
+                report('Canonicalized the urls of %d places, saving %d rows and %d bytes' % (changed, before[0] - after[0], before[1] - after[1]))
+            return changed
+        finally:
+            conn.close()
+
+    def start_forget(self, host):
+        ''' Forget the history of host in the background. Until it has been
+        deleted, host is recorded in pending_jobs, so that forgetting is
+        resumed by maintain() if it is interrupted, or run after the current
+        job if another job is running. Returns True if the job was started. '''
+        self.writer('pending_job', FORGET_JOB + host)
+        return self.start_job('PlacesForget', self.forget_site, host)
+
+    def record_pending_job(self, c, name):
+        c.execute('INSERT OR IGNORE INTO pending_jobs (name) VALUES (?)', (name,))
+
+    def forget_site(self, host, report=print, stop=None):
+        ''' Delete the history of host and its favicons, see forget_host() '''
+        from .favicons import remove_favicons
+        remove_favicons(self.forget_host(host, report=report, stop=stop))
+
+    def forget_host(self, host, report=print, stop=None):
+        ''' Delete the history of host and all its sub-domains, including
+        archived history and the favicons used only by it. Places are found
+        using the rev_host index and deleted in chunks, when nothing else is
+        being written, so it can run in a background thread. Once everything
+        has been deleted, host is removed from pending_jobs, see
+        start_forget(). Returns the urls of the deleted favicons. '''
+        stop = stop or Event()
+        prefix = reversed_host('//' + host)
+        if not prefix:
+            return []
+        # Visits to host that are still queued must not be committed after
+        # its history has been deleted
+        self.flush()
+        # Matches rev_host values starting with prefix, since / follows .
+        bounds = (prefix, prefix[:-1] + '/')
+        conn = self.open_connection()
+        try:
+            c = conn.cursor()
+            # Overwrite deleted content, even in databases that are not
+            # incrementally vacuumed
+            c.execute('PRAGMA secure_delete = ON')
+            c.execute('CREATE TEMP TABLE forget_favicons (id INTEGER PRIMARY KEY)')
+            c.execute(
+                'INSERT OR IGNORE INTO temp.forget_favicons SELECT favicon_id FROM favicons_link WHERE place_id IN'
+                ' (SELECT id FROM places WHERE rev_host >= ? AND rev_host < ?)', bounds)
+            deleted, favicons = 0, []
+            while self.wait_for_idle(stop):
+                with conn:
+                    c.execute('DELETE FROM places WHERE id IN (SELECT id FROM places WHERE rev_host >= ? AND rev_host < ? LIMIT ?)', bounds + (
+                        MAINTENANCE_CHUNK_SIZE,))
+                    changes = conn.changes()
+                deleted += changes
+                self.invalidate_caches()
+                if changes < MAINTENANCE_CHUNK_SIZE:
+                    break
+            if self.wait_for_idle(stop):
+                with conn:
+                    unused = (' FROM favicons WHERE id IN (SELECT id FROM temp.forget_favicons) AND'
+                              ' NOT EXISTS (SELECT 1 FROM favicons_link WHERE favicon_id = favicons.id)')
+                    favicons = [url for url, in c.execute('SELECT url' + unused)]
+                    c.execute('DELETE' + unused)
+                    # The archive and hosts tables are small enough to scan
+                    c.execute('DELETE FROM archive.places WHERE reversed_host(url) >= ? AND reversed_host(url) < ?', bounds)
+                    deleted += conn.changes()
+                    c.execute("DELETE FROM hosts WHERE reversed_host('//' || host) >= ? AND reversed_host('//' || host) < ?", bounds)
+                    c.execute('DELETE FROM pending_jobs WHERE name = ?', (FORGET_JOB + host,))
+                self.invalidate_caches()
+                # Do not leave the deleted history in free pages
+                self.vacuum(conn, stop)
+            c.execute('DROP TABLE temp.forget_favicons')
+            if report is not None:
+                if stop.is_set():
+                    report('Forgetting %s was interrupted, it will be resumed by the next maintenance' % host)
+                else:
+                    report('Deleted %d places and %d favicons of %s' % (deleted, len(favicons), host))
+            return favicons
+        finally:
+            conn.close()
 
     def calculate_frecency(self, place_id, visit_count, cursor=None):
         ' Algorithm taken from: https://developer.mozilla.org/en-US/docs/Mozilla/Tech/Places/Frecency_algorithm '
         cursor = cursor or self.conn.cursor()
-        visit_weights = []
-        for visit_date, visit_type in cursor.execute(
-                'SELECT visit_date, type FROM visits WHERE place_id=? ORDER BY visit_date DESC LIMIT ?', (place_id, FRECENCY_NUM_VISITS)):
+        visit_weights, remaining = [], FRECENCY_NUM_VISITS
+        for visit_date, visit_type, count in cursor.execute(RECENT_VISITS_SQL, (place_id, place_id, FRECENCY_NUM_VISITS)):
+            count = min(count, remaining)
+            remaining -= count
             type_weight = VISIT_TYPE_WEIGHTS.get(visit_type, 0)
             if type_weight == 0:
                 continue
             days = abs(now() - visit_date) // DAY
-            bucket = 4
-            if days <= 4:
-                bucket = 0
-            elif days <= 14:
-                bucket = 1
-            elif days <= 31:
-                bucket = 2
-            elif days <= 90:
-                bucket = 3
-            visit_weights.append((type_weight / 100) * RECENCY_WEIGHTS[bucket])
+            for bucket, max_days in enumerate(RECENCY_BUCKET_DAYS):
+                if days <= max_days:
+                    break
+            else:
+                bucket = len(RECENCY_BUCKET_DAYS)
+            visit_weights.extend(repeat((type_weight / 100) * RECENCY_WEIGHTS[bucket], count))
         try:
             frecency = int(math.ceil(visit_count * sum(visit_weights) / len(visit_weights)))
         except ZeroDivisionError:
             frecency = 0
         return frecency
 
+    def reage_frecency(self, chunk_size=REAGE_CHUNK_SIZE, report=print, stop=None):
+        ''' Recompute the frecency of every place that has visits, so that
+        the frecency of places that have not been visited recently decays.
+        Uses its own connection and one transaction per chunk of places, run
+        when nothing else is being written, so it can run in a background
+        thread. Re-aging stops once stop is set. '''
+        stop = stop or Event()
+        conn = self.open_connection()
+        try:
+            c = conn.cursor()
+            first, last = next(c.execute('SELECT MIN(id), MAX(id) FROM places'))
+            if first is None:
+                return 0
+            num_visits = next(c.execute('SELECT COUNT(*) FROM visits'))[0]
+            sql, changed, st = reage_sql(), 0, time.monotonic()
+            for start in range(first, last + 1, chunk_size):
+                if not self.wait_for_idle(stop):
+                    break
+                with conn:
+                    c.execute(sql, {'now': now(), 'first': start, 'last': start + chunk_size - 1})
+                    changed += conn.changes()
+            self.invalidate_caches()
+            elapsed = max(time.monotonic() - st, 1e-6)
+            if report is not None:
+                report('Re-aged frecency of %d places from %d visits in %.2f seconds (%d visits/sec), %d changed' % (
+                    last - first + 1, num_visits, elapsed, num_visits / elapsed, changed))
+            return changed
+        finally:
+            conn.close()
+
+    def wait_for_idle(self, stop):
+        ''' Wait till nothing has been written for MAINTENANCE_IDLE_TIME
+        seconds. Returns False if stop is set while waiting. '''
+        while not stop.is_set():
+            w = self._writer
+            if w is None:
+                return True
+            remaining = MAINTENANCE_IDLE_TIME - (time.monotonic() - w.last_write)
+            if remaining <= 0 and w.queue.empty():
+                return True
+            stop.wait(max(remaining, 0.1))
+        return False
+
+    def rollup_visits(self, conn, stop, days=ROLLUP_AFTER_DAYS):
+        ''' Compact visits older than the specified number of days into per
+        place, per day, per visit type rollups, in chunks '''
+        cutoff, c, rolled = now() - (days * DAY), conn.cursor(), 0
+        while self.wait_for_idle(stop):
+            with conn:
+                # Chunks end at the date of the visit ROLLUP_CHUNK_SIZE rows
+                # in, a day split between chunks is summed by the upsert
+                end = next(c.execute(
+                    'SELECT COALESCE((SELECT visit_date FROM visits WHERE visit_date < :cutoff ORDER BY visit_date LIMIT 1 OFFSET :limit), :cutoff)',
+                    {'cutoff': cutoff, 'limit': ROLLUP_CHUNK_SIZE}))[0]
+                c.execute(ROLLUP_SQL.format(where='visit_date < :end'), {'end': end})
+                rolled += conn.changes()
+            if end == cutoff:
+                break
+        return rolled
+
+    def archive_places(self, conn, stop, days=None):
+        ''' Move places not visited in the specified number of days, by
+        default the history_archive_days setting, to the archive, in chunks '''
+        if days is None:
+            from .config import misc_config
+            days = int(misc_config('history_archive_days', default=ARCHIVE_AFTER_DAYS))
+        cutoff, c, archived = now() - (max(days, ROLLUP_AFTER_DAYS) * DAY), conn.cursor(), 0
+        c.execute('CREATE TEMP TABLE IF NOT EXISTS archiving (id INTEGER PRIMARY KEY)')
+        c.execute('CREATE TEMP TABLE IF NOT EXISTS archiving_moved (id INTEGER PRIMARY KEY)')
+        if self.wait_for_idle(stop):
+            with conn:
+                # Places whose move has been committed in both databases
+                c.execute('DELETE FROM archive.moves WHERE NOT EXISTS (SELECT 1 FROM main.places p WHERE p.id = moves.place_id AND p.url = moves.url)')
+        while self.wait_for_idle(stop):
+            with conn:
+                c.execute('DELETE FROM temp.archiving')
+                c.execute('INSERT INTO temp.archiving SELECT id FROM places WHERE last_visit_date < ? LIMIT ?', (cutoff, MAINTENANCE_CHUNK_SIZE))
+                count = conn.changes()
+                c.execute(ROLLUP_SQL.format(where='place_id IN (SELECT id FROM temp.archiving)'), {})
+                c.execute(ARCHIVE_SQL)
+            archived += count
+            if count:
+                self.invalidate_caches()
+            if count < MAINTENANCE_CHUNK_SIZE:
+                break
+        return archived
+
+    def prune_favicons(self, conn, stop, days=ARCHIVE_AFTER_DAYS):
+        ''' Delete favicons that are old or no longer used by any place, in chunks '''
+        limit, c, deleted = now() - (days * DAY), conn.cursor(), 0
+        while self.wait_for_idle(stop):
+            with conn:
+                c.execute(
+                    'DELETE FROM favicons WHERE id IN (SELECT id FROM favicons WHERE last_visit_date < ? OR'
+                    ' NOT EXISTS (SELECT 1 FROM favicons_link WHERE favicon_id = favicons.id) LIMIT ?)', (limit, MAINTENANCE_CHUNK_SIZE))
+                changes = conn.changes()
+            deleted += changes
+            if changes < MAINTENANCE_CHUNK_SIZE:
+                break
+        return deleted
+
+    def vacuum(self, conn, stop, convert=False):
+        ''' Return free pages to the filesystem, in chunks. If convert is
+        True, small databases created before incremental vacuuming was
+        enabled are converted by a full VACUUM, once. '''
+        # Interrupts the VACUUM when stopped
+        conn.setprogresshandler(stop.is_set, PROGRESS_STEPS)
+        c = conn.cursor()
+        try:
+            for schema in ('main', 'archive'):
+                if next(c.execute('PRAGMA %s.auto_vacuum' % schema))[0] != 2:
+                    size = next(c.execute('PRAGMA %s.page_count' % schema))[0] * next(c.execute('PRAGMA %s.page_size' % schema))[0]
+                    if convert and size <= AUTO_VACUUM_CONVERSION_LIMIT and self.wait_for_idle(stop):
+                        c.execute('PRAGMA %s.auto_vacuum = INCREMENTAL' % schema)
+                        c.execute('VACUUM %s' % schema)
+                    continue
+                while next(c.execute('PRAGMA %s.freelist_count' % schema))[0] > 0 and self.wait_for_idle(stop):
+                    # The pragma frees one page per step
+                    for x in c.execute('PRAGMA %s.incremental_vacuum(%d)' % (schema, MAINTENANCE_CHUNK_SIZE)):
+                        pass
+        except apsw.InterruptError:
+            if not stop.is_set():
+                raise
+
+    def maintain(self, stop=None, report=print):
+        ''' Compact old visits into rollups, move old places to the archive,
+        re-age frecency, vacuum and refresh the statistics used by the query
+        planner. Pending one time jobs, such as url_cleanup() after an
+        upgrade, are run first. Uses its own connection and small
+        transactions that are only run when nothing else is being written,
+        so it can run in a background thread. Stops as soon as possible once
+        stop is set. Returns the number of visits, places and favicons
+        removed. '''
+        stop = stop or Event()
+        conn = self.open_connection()
+        # Interrupts long running statements, such as VACUUM, when stopped
+        conn.setprogresshandler(stop.is_set, PROGRESS_STEPS)
+        try:
+            st = time.monotonic()
+            # Frecency is re-aged once, below
+            self.run_pending_jobs(report, stop, reage=False)
+            rolled = self.rollup_visits(conn, stop)
+            archived = self.archive_places(conn, stop)
+            deleted = self.prune_favicons(conn, stop)
+            if self.wait_for_idle(stop):
+                with conn:
+                    conn.cursor().execute('DELETE FROM hosts WHERE frecency <= 0 AND NOT EXISTS (SELECT 1 FROM places WHERE places.host = hosts.host)')
+            self.reage_frecency(report=report, stop=stop)
+            self.vacuum(conn, stop, convert=True)
+            if self.wait_for_idle(stop):
+                conn.cursor().execute('PRAGMA analysis_limit = %d; ANALYZE' % ANALYSIS_LIMIT)
+            if report is not None and not stop.is_set():
+                report('Maintenance of places rolled up %d visits, archived %d places and deleted %d favicons in %.2f seconds' % (
+                    rolled, archived, deleted, time.monotonic() - st))
+            return rolled + archived + deleted
+        except apsw.InterruptError:
+            if not stop.is_set():
+                raise
+        finally:
+            conn.close()
+
+    def start_job(self, name, func, *args):
+        ''' Run func(*args, stop=stop) in a background thread, where stop is
+        an Event that is set when places is closed. Only one job runs at a
+        time, returns False if a job is already running. '''
+        if self.job_running:
+            return False
+
+        def run():
+            try:
+                func(*args, stop=self._stop_jobs)
+                # Jobs recorded while this one was running, such as
+                # forgetting a host, are run now, not by the next maintenance
+                if not self._stop_jobs.is_set():
+                    self.run_pending_jobs(stop=self._stop_jobs)
+            except Exception:
+                traceback.print_exc()
+
+        self.conn  # ensure the schema exists before the thread connects
+        self._stop_jobs.clear()
+        self._job = t = Thread(name=name, target=run)
+        t.daemon = True
+        t.start()
+        return True
+
+    @property
+    def job_running(self):
+        return self._job is not None and self._job.is_alive()
+
+    def run_pending_jobs(self, report=print, stop=None, reage=True):
+        ''' Run the jobs recorded in pending_jobs, which remove themselves
+        once they are complete. reage is passed to url_cleanup(). '''
+        stop = stop or Event()
+        # Jobs are recorded via the writer
+        self.flush()
+        conn = self.open_connection()
+        try:
+            names = [name for name, in conn.cursor().execute('SELECT name FROM pending_jobs ORDER BY id')]
+        finally:
+            conn.close()
+        for name in names:
+            if stop.is_set():
+                break
+            if name == URL_CLEANUP_JOB:
+                self.url_cleanup(report=report, stop=stop, reage=reage)
+            elif name.startswith(FORGET_JOB):
+                self.forget_site(name[len(FORGET_JOB):], report=report, stop=stop)
+
+    def start_maintenance(self):
+        return self.start_job('PlacesMaintenance', self.maintain)
+
+    def url_cleanup(self, transform_func=None, report=print, stop=None, reage=True):
+        ''' Merge http places into their https twins, canonicalize urls and
+        apply transform_func, by default the URL substitution rules, to all
+        places, then re-age frecency once, unless reage is False. Run once by
+        maintain() after an upgrade. '''
+        stop = stop or Event()
+        changed = self.merge_https_places(report=report, stop=stop, reage=False)
+        changed += self.canonicalize_urls(report=report, stop=stop, reage=False)
+        changed += self.transform_urls(transform_func, report=report, stop=stop, reage=False)
+        if changed and reage:
+            self.reage_frecency(report=report, stop=stop)
+        if not stop.is_set():
+            conn = self.open_connection()
+            try:
+                conn.cursor().execute('DELETE FROM pending_jobs WHERE name = ?', (URL_CLEANUP_JOB,))
+            finally:
+                conn.close()
+
+    def start_url_cleanup(self, transform_func=None):
+        ''' Run url_cleanup() in the background. Should be run after the
+        substitution rules or the tracking parameters are changed. '''
+        reset_tracking_parameters()
+        return self.start_job('PlacesURLCleanup', self.url_cleanup, transform_func)
+
     def on_title_change(self, qurl, title):
         title = normalize(title.strip())
         if qurl.isEmpty() or not title:
             return
-        url = normalize(qurl.toString())
-        with self.conn:
-            c = self.conn.cursor()
-            try:
-                place_id, old_title = next(c.execute('SELECT id,title FROM places WHERE url=?', (url,)))
-            except StopIteration:
-                return
-            if old_title == title:
-                return
-            c.execute('UPDATE places SET title=? WHERE id=?', (title, place_id))
+        self.writer('title', place_url(qurl), title)
+
+    def record_title(self, c, url, title):
+        try:
+            place_id, old_title = next(c.execute('SELECT id,title FROM places WHERE url=?', (url,)))
+        except StopIteration:
+            return
+        if old_title == title:
+            return
+        c.execute('UPDATE places SET title=? WHERE id=?', (title, place_id))
 
     def on_favicon_change(self, qurl, favicon_qurl):
         if qurl.isEmpty():
             return
-        url = qurl.toString()
-        favicon = favicon_qurl.toString()
-        with self.conn:
-            c = self.conn.cursor()
-            try:
-                place_id = next(c.execute('SELECT id FROM places WHERE url=?', (url,)))[0]
-            except StopIteration:
-                return
-            if not favicon:
-                c.execute('DELETE FROM favicons_link WHERE place_id=?', (place_id,))
-                return
-            ts = now()
-            try:
-                favicon_id = next(c.execute('SELECT id FROM favicons WHERE url=?', (favicon,)))[0]
-                c.execute('UPDATE favicons SET last_visit_date=? WHERE id=?', (ts, favicon_id))
-            except StopIteration:
-                favicon_id = self.insert('favicons', url=favicon, last_visit_date=ts)
-            c.execute('INSERT OR IGNORE INTO favicons_link (favicon_id, place_id) VALUES (?, ?)', (favicon_id, place_id))
+        self.writer('favicon', place_url(qurl), favicon_qurl.toString(), now())
 
-    def prune(self, days=400):
-        limit = now() - (days * DAY)
-        c = self.conn.cursor()
-        c.execute('DELETE FROM places WHERE last_visit_date < ?; DELETE FROM favicons WHERE last_visit_date < ?', (limit, limit))
+    def record_favicon(self, c, url, favicon, timestamp):
+        try:
+            place_id = next(c.execute('SELECT id FROM places WHERE url=?', (url,)))[0]
+        except StopIteration:
+            return
+        if not favicon:
+            c.execute('DELETE FROM favicons_link WHERE place_id=?', (place_id,))
+            return
+        try:
+            favicon_id = next(c.execute('SELECT id FROM favicons WHERE url=?', (favicon,)))[0]
+            c.execute('UPDATE favicons SET last_visit_date=? WHERE id=?', (timestamp, favicon_id))
+        except StopIteration:
+            favicon_id = self.insert('favicons', cursor=c, url=favicon, last_visit_date=timestamp)
+        c.execute('INSERT OR IGNORE INTO favicons_link (favicon_id, place_id) VALUES (?, ?)', (favicon_id, place_id))
 
     def close(self):
+        if self._job is not None:
+            self._stop_jobs.set()
+            # Jobs check stop between chunks and long statements are
+            # interrupted, so this only times out if a job is stuck
+            self._job.join(JOB_STOP_TIMEOUT)
+            self._job = None
+        if self._writer is not None:
+            self._writer.shutdown()
+            self._writer = None
+        if self._readers is not None:
+            self._readers.close()
+            self._readers = None
         if self._conn:
-            self.prune()
+            self._conn.cursor().execute('PRAGMA wal_checkpoint(TRUNCATE)')
             self._conn.close()
             self._conn = None
 
-    def subsequence_matches(self, subsequence=None, limit=50):
-        c = self.conn.cursor()
+    def read(self, sql, params=(), abort=None):
+        ''' Yield the rows of a query as they are produced. abort, if
+        specified, is called periodically, if it returns True, the query is
+        interrupted with apsw.InterruptError '''
+        with self.reader() as conn:
+            if abort is not None:
+                conn.setprogresshandler(abort, PROGRESS_STEPS)
+            try:
+                yield from conn.cursor().execute(sql, params)
+            finally:
+                if abort is not None:
+                    conn.setprogresshandler(None)
+
+    def top_places(self, limit=50, abort=None):
+        yield from self.read('SELECT id, url, title FROM places ORDER BY frecency DESC LIMIT ?', (limit,), abort)
+
+    def subsequence_matches(self, subsequence=None, limit=50, abort=None):
         if not subsequence:
-            for url, title in c.execute('SELECT url, title FROM PLACES ORDER BY frecency DESC LIMIT ?', (limit,)):
-                yield url, title
+            yield from self.top_places(limit, abort)
             return
 
+        # A subsequence has no contiguous runs of characters for the trigram
+        # index to use, so this remains a scan in frecency order
         subsequence = normalize((subsequence or ''))[:20]
         like_expr = re.sub(r'([|%_])', r'|\1', subsequence.lower())
         like_expr = '%' + '%'.join(like_expr) + '%'
 
-        for place_id, url, title in c.execute(
-                'SELECT id, url, title FROM places WHERE url_lower LIKE ? ESCAPE "|" OR title_lower LIKE ? ESCAPE "|" ORDER BY frecency DESC LIMIT ?',
-                (like_expr, like_expr, limit)):
-            yield place_id, url, title
+        yield from self.read(
+            'SELECT id, url, title FROM places WHERE url_lower LIKE ? ESCAPE "|" OR title_lower LIKE ? ESCAPE "|" ORDER BY frecency DESC LIMIT ?',
+            (like_expr, like_expr, limit), abort)
 
-    def substring_matches(self, substrings=None, limit=50):
-        c = self.conn.cursor()
+    def substring_matches(self, substrings=None, limit=50, abort=None):
+        substrings = tuple(filter(None, map(normalize, substrings or ())))
         if not substrings:
-            for url, title in c.execute('SELECT url, title FROM PLACES ORDER BY frecency DESC LIMIT ?', (limit,)):
-                yield url, title
+            yield from self.top_places(limit, abort)
+            return
+        rows = self.completion_cache.get(substrings, limit)
+        if rows is not None:
+            yield from rows
             return
-        substrings = map(normalize, substrings)
-        like_expressions = tuple('%' + re.sub(r'([|%_])', r'|\1', x.lower()) + '%' for x in substrings)
-        where_clause = ' AND '.join(repeat('(url_lower LIKE ? OR title_lower LIKE ?)', len(like_expressions)))
+        generation = self.completion_cache.generation
+        clauses, params = substring_clauses(substrings)
+        params.append(limit)
 
-        for place_id, url, title in c.execute(
-                'SELECT id, url, title FROM places WHERE %s ORDER BY frecency DESC LIMIT %d' % (where_clause, limit),
-                (x for x in like_expressions for y in (0, 1))):
-            yield place_id, url, title
+        rows = []
+        for row in self.read('SELECT id, url, title FROM places WHERE %s ORDER BY frecency DESC LIMIT ?' % ' AND '.join(clauses), params, abort):
+            rows.append(row)
+            yield row
+        self.completion_cache.set(substrings, limit, rows, generation)
 
-    def favicon_url(self, place_id):
-        try:
-            return next(self.conn.cursor().execute(
-                'SELECT url FROM favicons WHERE id IN (SELECT favicon_id FROM favicons_link WHERE place_id=? LIMIT 1) LIMIT 1', (place_id,)))[0]
-        except StopIteration:
-            pass
+    def history(self, before=None, after=None, substrings=None, limit=HISTORY_PAGE_SIZE):
+        ''' Return a page of at most limit visits, newest first, as (date,
+        kind, id, place_id, url, title, count) tuples. Visits older than
+        ROLLUP_AFTER_DAYS are rolled up, one entry per place, day and visit
+        type, with count the number of visits. The page is the one before
+        (older than) or after (newer than) a position, the (date, kind, id)
+        of an entry from a previous page, so each page is a range scan, no
+        matter how deep into history it is. If substrings are specified,
+        only visits to places containing all of them are returned. '''
+        pos, op, order = before, '<', 'DESC'
+        if after is not None:
+            pos, op, order = after, '>', 'ASC'
+        date, kind, entry_id = pos or (1 << 62, 1, 1 << 62)
+        # At the same date, visits come before rollups
+        params = {
+            'date': date, 'visit_id': entry_id if kind else (-1 if after else 0),
+            'day': date // DAY, 'rollup_id': (1 << 62) if kind else entry_id, 'limit': limit}
+        visits, rollups, where = 'visits', 'visit_rollups', ''
+        substrings = tuple(filter(None, map(normalize, substrings or ())))
+        if substrings:
+            clauses, sparams = substring_clauses(substrings)
+            place_ids = [x for x, in self.read('SELECT id FROM places WHERE %s' % ' AND '.join(clauses), sparams)]
+            if not place_ids:
+                return []
+            params['places'] = json.dumps(place_ids)
+            if len(place_ids) <= HISTORY_SEARCH_PLACES:
+                # CROSS JOIN makes the matching places the outer loop
+                visits = 'json_each(:places) m CROSS JOIN visits ON visits.place_id = m.value'
+                rollups = 'json_each(:places) m CROSS JOIN visit_rollups ON visit_rollups.place_id = m.value'
+            else:
+                where = 'AND place_id IN (SELECT value FROM json_each(:places))'
+        rows = list(self.read(HISTORY_SQL.format(op=op, order=order, where=where, day=DAY, visits=visits, rollups=rollups), params))
+        if after is not None:
+            rows.reverse()
+        return rows
+
+    def inline_completion(self, prefix):
+        ''' Return the host with the highest frecency that starts with prefix,
+        for completing URLs as they are typed, or None '''
+        prefix = normalize(prefix).lower()
+        www = 'www.' if prefix.startswith('www.') else ''
+        prefix = prefix[len(www):]
+        if prefix:
+            for host, in self.read(
+                    'SELECT host FROM hosts WHERE host >= ? AND host < ? ORDER BY frecency DESC LIMIT 1', (prefix, prefix + chr(0x10ffff))):
+                return www + host
+
+    def archived_matches(self, substrings, limit=50, abort=None):
+        ''' Search the archive of old history for places matching all the
+        substrings. The archive is not indexed, so this is much slower than
+        substring_matches(). Yields rows with a place id of None, since
+        archived places are not in places. '''
+        substrings = tuple(filter(None, map(normalize, substrings or ())))
+        clauses = ['(url_lower LIKE ? ESCAPE "|" OR title_lower LIKE ? ESCAPE "|")'] * len(substrings)
+        params = [like_expression(x) for x in substrings for y in (0, 1)]
+        clauses.append('url NOT IN (SELECT url FROM main.places)')
+        params.append(limit)
+        yield from self.read(
+            'SELECT NULL, url, title FROM archive.places WHERE %s ORDER BY frecency DESC LIMIT ?' % ' AND '.join(clauses), params, abort)
+
+    def favicon_urls(self, place_ids):
+        ''' Return a map of place id to favicon url for all the places in
+        place_ids that have a favicon '''
+        place_ids = tuple(place_ids)
+        if not place_ids:
+            return {}
+        return dict(self.read(
+            'SELECT l.place_id, f.url FROM favicons_link l JOIN favicons f ON f.id = l.favicon_id WHERE l.place_id IN (%s)' % ','.join(
+                repeat('?', len(place_ids))), place_ids))
 
 
 places = Places()
 
 
-def import_from_firefox():
-    global places
-    from glob import glob
-    places.close()
-    os.remove(places.path)
-    places = Places()
-    conn = apsw.Connection(glob(os.path.expanduser('~/.mozilla/firefox/*/places.sqlite'))[0])
-    place_id_map, favicon_id_map, favicon_links = {}, {}, {}
-    with places.conn:
-        print('Importing places table')
-        for place_id, url, title, visit_count, typed, frecency, last_visit_date, favicon_id in conn.cursor().execute(
-                'SELECT id,url,title,visit_count,typed,frecency,last_visit_date,favicon_id FROM moz_places'):
-            if last_visit_date and visit_count and frecency > 0 and url:
-                place_id_map[place_id] = places.insert(
-                    'places', url=url, title=title or '_', visit_count=visit_count, typed=typed, frecency=frecency, last_visit_date=last_visit_date)
-                if favicon_id is not None and favicon_id > 0:
-                    favicon_links[place_id_map[place_id]] = favicon_id
-        print('Importing visits table')
-        items = []
-        for place_id, visit_date, visit_type in conn.cursor().execute(
-                'SELECT place_id,visit_date,visit_type FROM moz_historyvisits'):
-            place_id = place_id_map.get(place_id)
-            if place_id is not None and visit_date and visit_type in (1, 2):
-                items.append((place_id, visit_date, {1: VisitType.link_clicked, 2: VisitType.typed}[visit_type].value))
-        places.conn.cursor().executemany(
-            'INSERT INTO visits (place_id, visit_date, type) VALUES (?, ?, ?)', items)
-        print('Importing favicons table')
-        ts = now()
-        for favicon_id, url in conn.cursor().execute('SELECT id,url FROM moz_favicons'):
-            favicon_id_map[favicon_id] = places.insert('favicons', url=url, last_visit_date=ts)
-        links = ((place_id, favicon_id_map[favicon_id]) for place_id, favicon_id in favicon_links.items())
-        places.conn.cursor().executemany('INSERT INTO favicons_link(place_id,favicon_id) VALUES (?,?)', links)
-
-    print("Vacuuming...")
-    conn.cursor().execute('VACUUM')
-    conn.close()
+def import_from_firefox(path=None):
+    from .history_import import import_history
+    import_history('firefox', path)
+
+
+def test():
+    import tempfile
+    with tempfile.TemporaryDirectory() as tdir:
+        p = Places(os.path.join(tdir, 'places.sqlite'))
+        for url, title, frecency in (
+                ('https://github.com/kovidgoyal', 'GitHub', 10), ('https://example.com/a_b', 'Example', 20), ('http://gi.org', 'Gi', 5)):
+            p.insert('places', url=url, title=title, frecency=frecency)
+
+        def ids(*substrings):
+            return [x[0] for x in p.substring_matches(substrings)]
+        assert p.inline_completion('gi') == 'github.com'
+        assert p.inline_completion('Www.Ex') == 'www.example.com'
+        assert p.inline_completion('gx') is None
+        assert ids('GIT') == [1]
+        assert ids('gi') == [1, 3]
+        assert ids('hub', 'kov') == [1]
+        assert ids('exam', 'gi') == []
+        assert ids('a_b') == [2]
+        assert ids('') == [2, 1, 3]
+        p.conn.cursor().execute('UPDATE places SET title=? WHERE id=1', ('Renamed',))
+        p.invalidate_caches()
+        assert ids('renam') == [1]
+        p.conn.cursor().execute('DELETE FROM places WHERE id=2')
+        p.invalidate_caches()
+        assert ids('exam') == []
+        # Refinements of a cached query are answered from the cache
+        assert ids('git') == [1]
+        p.conn.cursor().execute('DELETE FROM places WHERE id=1')
+        assert ids('gith') == [1]
+        assert ids('gitx') == []
+        p.invalidate_caches()
+        assert ids('gith') == []
+
+        from PyQt5.Qt import QUrl
+        url = QUrl('https://example.org/page')
+        p.on_visit(url, QWebEnginePage.NavigationTypeTyped, True)
+        p.on_title_change(url, 'One'), p.on_title_change(url, 'Two')
+        p.on_favicon_change(url, QUrl('https://example.org/favicon.ico'))
+        p.flush()
+        place_id, _, title = next(p.substring_matches(['example.org']))
+        assert title == 'Two'
+        assert p.favicon_urls([place_id, -1]) == {place_id: 'https://example.org/favicon.ico'}
+        # A batch that fails because the database is locked is retried
+        orig, fails = p.record_title, [1]
+
+        def busy_title(*args):
+            if fails:
+                fails.pop()
+                raise apsw.BusyError('locked')
+            return orig(*args)
+        p.record_title = busy_title
+        p.on_title_change(url, 'Three')
+        assert p.flush()
+        del p.record_title
+        assert next(p.substring_matches(['example.org']))[2] == 'Three'
+        # Maintenance prunes old places and favicons that are not in use
+        p.insert('places', url='https://old.example.org', last_visit_date=now() - 500 * DAY)
+        p.insert('favicons', url='https://example.org/unused.ico', last_visit_date=now())
+        p.maintain(report=None)
+        assert [x[1] for x in p.substring_matches(['example.org'])] == ['https://example.org/page']
+        assert next(p.conn.cursor().execute('SELECT COUNT(*) FROM favicons'))[0] == 1
+        assert [x[1] for x in p.archived_matches(['old.exam'])] == ['https://old.example.org']
+        # A place left in main by a crash after it was moved to the archive is
+        # not merged into the archive again
+        place_id, url = next(p.read('SELECT place_id, url FROM archive.moves'))
+        archived = list(p.read('SELECT visit_count FROM archive.places WHERE url=?', (url,)))
+        p.insert('places', id=place_id, url=url, visit_count=3, last_visit_date=now() - 500 * DAY)
+        p.maintain(report=None)
+        assert list(p.read('SELECT visit_count FROM archive.places WHERE url=?', (url,))) == archived
+        assert list(p.read('SELECT id FROM places WHERE url=?', (url,))) == []
+        # Databases created without incremental vacuuming are converted by
+        # maintenance, not when opened
+        path = os.path.join(tdir, 'old.sqlite')
+        apsw.Connection(path).cursor().execute('CREATE TABLE old (x INTEGER)')
+        old = Places(path)
+        old.conn  # creates the schema
+
+        def auto_vacuum():
+            return next(apsw.Connection(path).cursor().execute('PRAGMA auto_vacuum'))[0]
+        assert auto_vacuum() == 0
+        old.maintain(report=None)
+        assert auto_vacuum() == 2
+        old.close()
+        # Merging in bulk
+        for url in ('http://a.org/x', 'https://a.org/x', 'http://b.org/', 'https://b.org/?q'):
+            p.insert('places', url=url, visit_count=1, last_visit_date=now())
+        assert p.merge_https_places(report=None) == 1
+        assert p.transform_urls(lambda url: ('b.org' in url, 'https://b.org/'), report=None) == 2
+        assert [x[1:] for x in p.read('SELECT id, url, visit_count FROM places WHERE url LIKE "%.org/%" ORDER BY url')] == [
+            ('https://a.org/x', 2), ('https://b.org/', 2), ('https://example.org/page', 1)]
+        # Places whose urls are swapped or chained are all renamed
+        for url in ('https://d.org/1', 'https://d.org/2', 'https://e.org/1', 'https://e.org/2', 'https://e.org/3'):
+            p.insert('places', url=url, title=url, visit_count=1, last_visit_date=now())
+        renames = {'https://d.org/1': 'https://d.org/2', 'https://d.org/2': 'https://d.org/1', 'https://e.org/1': 'https://e.org/2',
+                   'https://e.org/2': 'https://e.org/3', 'https://e.org/3': 'https://e.org/4'}
+        assert p.transform_urls(lambda url: (url in renames, renames.get(url, url)), report=None) == 5
+        assert list(p.read('SELECT title, url FROM places WHERE url LIKE "https://d.org/%" OR url LIKE "https://e.org/%" ORDER BY title')) == [
+            (k, v) for k, v in sorted(renames.items())]
+        for url in ('https://c.org/?utm_source=x', 'https://c.org/#top', 'https://c.org/'):
+            p.insert('places', url=url, visit_count=1, last_visit_date=now())
+        assert p.canonicalize_urls(report=None) == 2
+        assert list(p.read('SELECT visit_count FROM places WHERE url LIKE "https://c.org/%"')) == [(3,)]
+        # The urls of existing places are cleaned up once, after an upgrade
+        p.insert('places', url='https://c.org/?fbclid=x', visit_count=1, last_visit_date=now())
+        p.insert('pending_jobs', name='url_cleanup')
+        reages, orig_reage = [], p.reage_frecency
+        p.reage_frecency = lambda **kw: (reages.append(1), orig_reage(**kw))
+        p.maintain(report=None)
+        del p.reage_frecency
+        assert list(p.read('SELECT visit_count FROM places WHERE url LIKE "https://c.org/%"')) == [(4,)]
+        assert list(p.read('SELECT name FROM pending_jobs')) == []
+        assert len(reages) == 1
+        # Forgetting a site includes its sub-domains and favicons
+        for url in ('https://d.org/', 'https://www.d.org/x', 'https://a.b.d.org/', 'https://dd.org/'):
+            place_id = p.insert('places', url=url, last_visit_date=now())
+            p.insert('visits', place_id=place_id, visit_date=now(), type=VisitType.typed.value)
+            p.record_favicon(p.conn.cursor(), url, url + 'favicon.ico', now())
+        # Including visits that have not been committed yet
+        p.on_visit(QUrl('https://www.d.org/queued'), QWebEnginePage.NavigationTypeTyped, True)
+        assert p.forget_host('d.org', report=None) == ['https://d.org/favicon.ico', 'https://www.d.org/xfavicon.ico', 'https://a.b.d.org/favicon.ico']
+        assert [x for x, in p.read('SELECT url FROM places WHERE url LIKE "%d.org/%"')] == ['https://dd.org/']
+        assert p.inline_completion('d.') is None
+        # Forgetting is resumed by maintenance when it is interrupted
+        p.insert('places', url='https://f.org/', last_visit_date=now())
+        p.insert('pending_jobs', name=FORGET_JOB + 'f.org')
+        stop = Event()
+        stop.set()
+        p.forget_host('f.org', report=None, stop=stop)
+        assert list(p.read('SELECT name FROM pending_jobs')) == [(FORGET_JOB + 'f.org',)]
+        p.maintain(report=None)
+        assert list(p.read('SELECT name FROM pending_jobs')) == [] and list(p.read("SELECT id FROM places WHERE host = 'f.org'")) == []
+        # Paging through visits and rolled up visits by position
+        place_id = p.insert('places', url='https://paging.test/', title='Paging', last_visit_date=now())
+        for i in range(3):
+            p.insert('visits', place_id=place_id, visit_date=now() - i * DAY, type=VisitType.typed.value)
+        p.insert('visit_rollups', place_id=place_id, day=now() // DAY - 200, type=VisitType.typed.value, count=4)
+        rows = p.history(substrings=['paging'])
+        assert [(kind, count) for date, kind, entry_id, pid, url, title, count in rows] == [(1, 1)] * 3 + [(0, 4)]
+        assert p.history(before=rows[1][:3], substrings=['paging'], limit=2) == rows[2:]
+        assert p.history(after=rows[3][:3], substrings=['paging'], limit=2) == rows[1:3]
+        p.close()
@@ -0,0 +1,339 @@
+#!/usr/bin/env python
+# vim:fileencoding=utf-8
+# License: GPL v3 Copyright: 2017, Kovid Goyal <kovid at kovidgoyal.net>
+
+import argparse
+import itertools
+import json
+import os
+import platform
+import random
+import string
+import subprocess
+import sys
+import tempfile
+import time
+from bisect import bisect
+from threading import Thread, Event
+
+import apsw
+
+from .places import Places, VisitType, now, DAY, SCHEMA_UPGRADES
+
+
+def random_word(rng, size=None):
+    return ''.join(rng.choice(string.ascii_lowercase) for i in range(size or rng.randint(3, 10)))
+
+
+def create_places(places, num_places, rng):
+    with places.conn:
+        c = places.conn.cursor()
+        for i in range(num_places):
+            url = 'https://%s.%s/%s' % (random_word(rng), rng.choice(('com', 'org', 'net')), random_word(rng))
+            title = ' '.join(random_word(rng) for i in range(rng.randint(1, 6)))
+            places.insert('places', cursor=c, url=url, title=title, visit_count=1, frecency=rng.randint(1, 10000), last_visit_date=now())
+
+
+def percentile(samples, p):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p / 100))]
+
+
+def time_completions(places, queries):
+    samples = []
+    for q in queries:
+        st = time.perf_counter()
+        list(places.substring_matches(q.split()))
+        samples.append(time.perf_counter() - st)
+    return samples
+
+
+def write_visits(places, stop, counter, rng):
+    while not stop.is_set():
+        url = 'https://%s.example.com/%s' % (random_word(rng), random_word(rng))
+        places.writer('visit', url, VisitType.typed, now())
+        counter[0] += 1
+        time.sleep(0.0005)
+
+
+def completion_latency_under_writes(num_places=100000, num_queries=500, seed=42):
+    ''' Measure the latency of completion queries with an idle database and
+    while visits are being written as fast as the writer thread will take
+    them. '''
+    rng = random.Random(seed)
+    queries = [' '.join(random_word(rng, rng.randint(1, 4)) for i in range(rng.randint(1, 2))) for i in range(num_queries)]
+    with tempfile.TemporaryDirectory() as tdir:
+        places = Places(os.path.join(tdir, 'places.sqlite'))
+        places.write_batch_interval = 0.01
+        print('Creating %d places...' % num_places)
+        create_places(places, num_places, rng)
+
+        def report(name, samples):
+            print('%-12s p50: %.2fms p99: %.2fms max: %.2fms' % (
+                name, percentile(samples, 50) * 1000, percentile(samples, 99) * 1000, max(samples) * 1000))
+
+        report('idle', time_completions(places, queries))
+        stop, counter = Event(), [0]
+        writer = Thread(target=write_visits, args=(places, stop, counter, random.Random(seed)))
+        writer.start()
+        st = time.monotonic()
+        try:
+            samples = time_completions(places, queries)
+        finally:
+            stop.set()
+            writer.join()
+        elapsed = time.monotonic() - st
+        places.flush()
+        report('writing', samples)
+        print('Visits queued while querying: %d (%.0f/sec)' % (counter[0], counter[0] / elapsed))
+        places.close()
+
+
+def create_visits(places, num_visits, rng, max_age_days=365):
+    first, last = next(places.conn.cursor().execute('SELECT MIN(id), MAX(id) FROM places'))
+    ts = now()
+    with places.conn:
+        places.conn.cursor().executemany('INSERT INTO visits (place_id, visit_date, type) VALUES (?, ?, ?)', (
+            (rng.randint(first, last), ts - rng.randint(0, max_age_days * DAY), rng.choice((VisitType.link_clicked.value, VisitType.typed.value)))
+            for i in range(num_visits)))
+
+
+def frecency_reaging(num_places=100000, num_visits=1000000, seed=42):
+    ''' Measure the throughput of the bulk frecency re-aging job '''
+    rng = random.Random(seed)
+    with tempfile.TemporaryDirectory() as tdir:
+        places = Places(os.path.join(tdir, 'places.sqlite'))
+        print('Creating %d places with %d visits...' % (num_places, num_visits))
+        create_places(places, num_places, rng)
+        create_visits(places, num_visits, rng)
+        places.reage_frecency()
+        places.close()
+
+
+# The triggers from before schema version 3, that fired on every update
+LEGACY_LOWER_CASE_TRIGGERS = '''
+DROP TRIGGER url_update_trg;
+DROP TRIGGER title_update_trg;
+CREATE TRIGGER url_update_trg AFTER UPDATE ON places BEGIN UPDATE places SET url_lower=lower_case(NEW.url) WHERE id=NEW.id; END;
+CREATE TRIGGER title_update_trg AFTER UPDATE ON places BEGIN UPDATE places SET title_lower=lower_case(NEW.title) WHERE id=NEW.id; END;
+'''
+
+
+def time_visits(places, urls, batch_size=100):
+    conn = places.conn
+    c = conn.cursor()
+    st = time.perf_counter()
+    for i in range(0, len(urls), batch_size):
+        with conn:
+            for url in urls[i:i+batch_size]:
+                places.record_visit(c, url, VisitType.link_clicked, now())
+    return len(urls) / (time.perf_counter() - st)
+
+
+def visit_throughput(num_places=100000, num_visits=20000, seed=42):
+    ''' Compare the throughput of recording visits to existing places with
+    the current lower case triggers and with the ones that fired on every
+    update of places '''
+    rng = random.Random(seed)
+    with tempfile.TemporaryDirectory() as tdir:
+        places = Places(os.path.join(tdir, 'places.sqlite'))
+        print('Creating %d places...' % num_places)
+        create_places(places, num_places, rng)
+        urls = [url for url, in places.conn.cursor().execute('SELECT url FROM places')]
+        urls = [rng.choice(urls) for i in range(num_visits)]
+        # The legacy triggers run first, so they see fewer visits per place
+        # when calculating frecency, which favors them
+        c = places.conn.cursor()
+        c.execute(LEGACY_LOWER_CASE_TRIGGERS)
+        before = time_visits(places, urls)
+        c.execute(SCHEMA_UPGRADES[3])
+        after = time_visits(places, urls)
+        print('on_visit throughput: %.0f visits/sec with triggers on every update, %.0f visits/sec with UPDATE OF triggers' % (
+            before, after))
+        places.close()
+
+
+class Zipf:
+
+    ''' Samples ranks from 0 to n - 1, with the probability of a rank being
+    proportional to 1 / (rank + 1) ** exponent '''
+
+    def __init__(self, n, rng, exponent=1.1):
+        self.rng = rng
+        self.cum_weights = list(itertools.accumulate(1 / (k ** exponent) for k in range(1, n + 1)))
+
+    def __call__(self):
+        return bisect(self.cum_weights, self.rng.random() * self.cum_weights[-1])
+
+
+def generate_history(places, num_places, rng, visits_per_place=3, max_age_days=730):
+    ''' Fill places with a synthetic history of num_places places spread over
+    num_places / 10 hosts, with Zipf distributed visits, hosts and title
+    words. Most hosts have a favicon and one in twenty places also has an
+    http twin. Returns the list of hosts. '''
+    words = [random_word(rng) for i in range(5000)]
+    word = Zipf(len(words), rng)
+    hosts = ['%s%d.%s' % (random_word(rng), i, rng.choice(('com', 'org', 'net', 'io'))) for i in range(max(1, num_places // 10))]
+    host = Zipf(len(hosts), rng)
+    ts = now()
+
+    def age():
+        return int(min(max_age_days, rng.expovariate(1 / 90)) * DAY)
+
+    rows, links = [], []
+    for i in range(num_places):
+        h = host()
+        path = '/'.join(words[word()] for j in range(rng.randint(1, 3)))
+        title = ' '.join(words[word()].capitalize() for j in range(rng.randint(2, 8)))
+        rows.append(('https://%s/%s/%d' % (hosts[h], path, i), title, ts - age()))
+        if h % 5:
+            links.append((h + 1, len(rows)))
+        if rng.random() < 0.05:
+            rows.append(('http://%s/%s/%d' % (hosts[h], path, i), title, ts - age()))
+    # Visits go to places in order of a random popularity ranking
+    popularity = list(range(1, len(rows) + 1))
+    rng.shuffle(popularity)
+    place = Zipf(len(rows), rng)
+    with places.conn:
+        c = places.conn.cursor()
+        c.executemany('INSERT INTO places (url, title, last_visit_date) VALUES (?, ?, ?)', rows)
+        c.executemany('INSERT INTO favicons (url, last_visit_date) VALUES (?, ?)', (('https://%s/favicon.ico' % h, ts) for h in hosts))
+        c.executemany('INSERT INTO favicons_link (favicon_id, place_id) VALUES (?, ?)', links)
+        c.executemany('INSERT INTO visits (place_id, visit_date, type) VALUES (?, ?, ?)', (
+            (popularity[place()], ts - age(), VisitType.typed.value if rng.random() < 0.1 else VisitType.link_clicked.value)
+            for i in range(visits_per_place * num_places)))
+        c.execute(
+            'UPDATE places SET visit_count = v.visit_count, last_visit_date = v.last_visit_date FROM'
+            ' (SELECT place_id, COUNT(*) AS visit_count, MAX(visit_date) AS last_visit_date FROM visits GROUP BY place_id) AS v'
+            ' WHERE places.id = v.place_id')
+    places.reage_frecency(report=None)
+    return hosts
+
+
+def latencies(func, calls):
+    samples = []
+    for args in calls:
+        st = time.perf_counter()
+        func(*args)
+        samples.append(time.perf_counter() - st)
+    return {
+        'calls': len(samples), 'p50_ms': percentile(samples, 50) * 1000, 'p99_ms': percentile(samples, 99) * 1000,
+        'max_ms': max(samples) * 1000}
+
+
+def duration(func, *args, **kw):
+    st = time.perf_counter()
+    changed = func(*args, **kw)
+    return {'seconds': time.perf_counter() - st, 'changed': changed}
+
+
+def benchmark_places(places, hosts, rng, num_queries=500, num_visits=2000):
+    ''' Time the operations of places on the synthetic history created by
+    generate_history(). The operations that change many places run last. '''
+    c = places.conn.cursor()
+    num_places = next(c.execute('SELECT MAX(id) FROM places'))[0]
+    titles = [t for t, in c.execute('SELECT title FROM places WHERE id IN (%s)' % ','.join(
+        str(rng.randint(1, num_places)) for i in range(num_queries)))]
+    results = {}
+
+    def substring_query():
+        q = rng.choice(titles).lower().split()[:rng.randint(1, 2)]
+        return [w[:rng.randint(2, len(w))] for w in q]
+
+    def completions(substrings):
+        # Measure the queries, not the completion cache
+        places.invalidate_caches()
+        for x in places.substring_matches(substrings):
+            pass
+    results['substring_matches'] = latencies(completions, [(substring_query(),) for i in range(num_queries)])
+
+    def subsequence_query():
+        w = rng.choice(titles).lower().replace(' ', '')
+        return ''.join(w[i] for i in sorted(rng.sample(range(len(w)), min(len(w), rng.randint(3, 5)))))
+
+    def subsequence_matches(q):
+        for x in places.subsequence_matches(q):
+            pass
+    results['subsequence_matches'] = latencies(subsequence_matches, [(subsequence_query(),) for i in range(num_queries)])
+
+    results['favicon_urls'] = latencies(places.favicon_urls, [
+        ([rng.randint(1, num_places) for i in range(10)],) for i in range(num_queries)])
+    results['inline_completion'] = latencies(places.inline_completion, [
+        (rng.choice(hosts)[:rng.randint(1, 4)],) for i in range(num_queries)])
+
+    urls = [u for u, in c.execute('SELECT url FROM places WHERE id IN (%s)' % ','.join(
+        str(rng.randint(1, num_places)) for i in range(num_visits)))]
+    urls += ['https://new%d.example.com/' % i for i in range(num_visits // 10)]
+    rng.shuffle(urls)
+    conn = places.conn
+    with conn:
+        # Visits are applied in a transaction per batch by the writer
+        results['on_visit'] = latencies(places.record_visit, [(c, url, VisitType.link_clicked, now()) for url in urls])
+
+    results['merge_https_places'] = duration(places.merge_https_places, report=None)
+    www = set(rng.sample(hosts, max(1, len(hosts) // 20)))
+
+    def add_www(url):
+        parts = url.split('/', 3)
+        if parts[2] in www:
+            parts[2] = 'www.' + parts[2]
+            return True, '/'.join(parts)
+        return False, url
+    results['transform_urls'] = duration(places.transform_urls, add_www, report=None)
+    results['maintain'] = duration(places.maintain, report=None)
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def suite(sizes=(10000, 100000, 1000000), seed=42):
+    ''' Run benchmark_places() on synthetic histories of the specified sizes,
+    returning the results in a form suitable for serializing as JSON '''
+    ans = {
+        'commit': git_commit(), 'timestamp': time.time(), 'python': platform.python_version(),
+        'sqlite': apsw.sqlitelibversion(), 'platform': platform.platform(), 'seed': seed, 'results': {}
+    }
+    for size in sizes:
+        rng = random.Random(seed)
+        with tempfile.TemporaryDirectory() as tdir:
+            places = Places(os.path.join(tdir, 'places.sqlite'))
+            print('Generating a history of %d places...' % size, file=sys.stderr)
+            st = time.perf_counter()
+            hosts = generate_history(places, size, rng)
+            results = {'generate_seconds': time.perf_counter() - st}
+            print('Running benchmarks...', file=sys.stderr)
+            results.update(benchmark_places(places, hosts, rng))
+            ans['results'][str(size)] = results
+            places.close()
+    return ans
+
+
+def main(args=sys.argv[1:]):
+    parser = argparse.ArgumentParser(prog='python -m vise.places_benchmark', description='Benchmark the places database')
+    parser.add_argument(
+        'benchmark', nargs='?', default='suite', choices=('suite', 'completion-latency', 'frecency-reaging', 'visit-throughput'),
+        help='The benchmark to run. The suite outputs its results as JSON.')
+    parser.add_argument('--sizes', default='10000,100000,1000000', help='Comma separated number of places in the histories used by the suite')
+    parser.add_argument('--seed', type=int, default=42, help='Seed for the random number generator')
+    parser.add_argument('--output', '-o', help='Write the results of the suite to this file instead of stdout')
+    args = parser.parse_args(args)
+    if args.benchmark == 'suite':
+        results = json.dumps(suite(tuple(map(int, args.sizes.split(','))), args.seed), indent=2, sort_keys=True)
+        if args.output:
+            with open(args.output, 'w') as f:
+                f.write(results)
+        else:
+            print(results)
+    else:
+        {'completion-latency': completion_latency_under_writes, 'frecency-reaging': frecency_reaging, 'visit-throughput': visit_throughput}[
+            args.benchmark](seed=args.seed)
+
+
+if __name__ == '__main__':
+    main()
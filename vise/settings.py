@@ -15,7 +15,7 @@ from PyQt5.Qt import (
 )
 
 from .config import font_sizes, color
-from .constants import config_dir, appname, cache_dir, DOWNLOADS_URL
+from .constants import config_dir, appname, cache_dir, DOWNLOADS_URL, HISTORY_URL
 from .resources import get_data_as_file
 
 
@@ -147,6 +147,7 @@ def client_script():
     f = get_data_as_file(name)
     src = f.read().decode('utf-8')
     src = src.replace('__DOWNLOADS_URL__', DOWNLOADS_URL)
+    src = src.replace('__HISTORY_URL__', HISTORY_URL)
     src = src.replace('HINT_FONT_SIZE', str(font_sizes().get('hint-size')))
     src = src.replace('SELECTED_HINT_BACKGROUND', color('selected hint background', 'khaki'))
     src = src.replace('HINT_FOREGROUND', color('hint foreground', 'black'))
@@ -9,7 +9,7 @@ import apsw
 from PyQt5.Qt import QUrl
 
 from .constants import config_dir
-from .utils import ascii_lowercase
+from .utils import ascii_lowercase, forget_domain
 
 
 class Permissions:
@@ -45,6 +45,10 @@ class Permissions:
             pass
         return False
 
+    def forget(self, domain):
+        ' Remove the permissions for domain and all its sub-domains '
+        forget_domain(domain, self.temporary, self.conn, 'permissions')
+
     def add_permission(self, qurl_or_domain, permission_type, permanent=True):
         domain = qurl_or_domain
         if isinstance(domain, QUrl):
@@ -254,13 +254,22 @@ def icon_data_for_filename(fname, size=64):
 
 
 def atomic_write(dest, data_or_file):
+    ''' Write data_or_file, which is bytes, a file object or an iterator over
+    chunks of bytes, to dest atomically '''
     tdest = dest + '-atomic'
     try:
         with open(tdest, 'wb') as f:
             if hasattr(data_or_file, 'read'):
                 shutil.copyfileobj(data_or_file, f)
+            elif hasattr(data_or_file, '__next__'):
+                for chunk in data_or_file:
+                    f.write(chunk)
             else:
                 f.write(data_or_file)
+            # Otherwise a crash can leave dest empty or truncated, as the
+            # rename can reach the disk before the data
+            f.flush()
+            os.fsync(f.fileno())
         try:
             shutil.copystat(dest, tdest)
         except FileNotFoundError:
@@ -395,3 +404,13 @@ def choose_files(name, parent=None, title=None, filters=(), all_files=False, sel
 
 def ascii_lowercase(val):
     return re.sub('[%s]' % string.ascii_uppercase, lambda m: m.group().lower(), val)
+
+
+def forget_domain(domain, temporary, conn, table):
+    ''' Remove the entries for domain and all its sub-domains from the dict
+    temporary, keyed by domain, and from table, which has a domain column '''
+    domain = ascii_lowercase(domain)
+    for d in tuple(temporary):
+        if d == domain or d.endswith('.' + domain):
+            del temporary[d]
+    conn.cursor().execute("DELETE FROM %s WHERE domain = ?1 OR substr(domain, -length(?1) - 1) = '.' || ?1" % table, (domain,))
@@ -27,6 +27,7 @@ from .communicate import python_to_js, js_to_python, connect_signal
 from .config import misc_config
 from .constants import FOLLOW_LINK_KEY_MAP
 from .downloads import get_download_dir
+from .history import history_callback
 from .message_box import question_dialog
 from .places import places
 from .popup import Popup
@@ -93,7 +94,7 @@ class WebPage(QWebEnginePage):
         QWebEnginePage.__init__(self, profile, parent)
         self.authenticationRequired.connect(self.authentication_required)
         self.proxyAuthenticationRequired.connect(self.proxy_authentication_required)
-        self.callbacks = {'vise_downloads_page': (self.downloads_callback, (), {})}
+        self.callbacks = {'vise_downloads_page': (self.downloads_callback, (), {}), 'vise_history_page': (history_callback, (), {})}
         self.poll_for_messages.connect(self.check_for_messages_from_js, type=Qt.QueuedConnection)
 
     def register_callback(self, name, func, *args, **kw):
@@ -5,6 +5,7 @@
 from PyQt5.Qt import QWebEngineUrlSchemeHandler, QBuffer
 
 from .downloads import get_downloads_html, filename_icon_data
+from .history import get_history_html
 from .welcome import get_welcome_html
 
 
@@ -18,6 +19,8 @@ class UrlSchemeHandler(QWebEngineUrlSchemeHandler):
         q = url.path()
         if q == 'downloads':
             rq.reply(b'text/html', QBuffer(get_downloads_html(), self))
+        elif q == 'history':
+            rq.reply(b'text/html', QBuffer(get_history_html(), self))
         elif q == 'welcome':
             rq.reply(b'text/html', QBuffer(get_welcome_html(), self))
         elif q.startswith('filename-icon/'):